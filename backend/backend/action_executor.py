@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import multiprocessing
+
+from setproctitle import setproctitle
+from retask.task import Task
+from retask.queue import Queue
+
+from .actions import Action, ActionType, DeleteBuildsBatch
+from .callback import FrontendCallback
+from .helpers import get_redis_connection, invalidate_auto_createrepo_status
+from .dispatcher import JOBGRAB_WAKEUP_QUEUE
+
+# job grabber puts actions here, ActionExecutor runs them
+ACTIONS_QUEUE = "copr-be-actions"
+
+# state of the pool worker process, set by `_init_pool_worker`
+_pool_state = {}
+
+
+def action_projects(action):
+    """
+    Projects ("owner/name") touched by the action. Actions touching the same
+    project are run one by one in the order they were received.
+
+    :param dict action: action as received from the frontend
+    :return set:
+    """
+    action_type = action["action_type"]
+    if action_type == ActionType.CREATEREPO:
+        data = json.loads(action["data"])
+        paths = ["{0}/{1}".format(data["username"], data["projectname"])]
+    elif action_type == ActionType.DELETE:
+        paths = [action["old_value"]]
+    elif action_type == ActionType.RENAME:
+        paths = [action["old_value"], action["new_value"]]
+    else:
+        paths = []
+
+    return set(os.path.normpath(path).strip("/") for path in paths if path)
+
+
+def is_build_deletion(action):
+    return action["action_type"] == ActionType.DELETE and \
+        action["object_type"] in ["build-succeeded", "build-skipped", "build-failed"]
+
+
+def _init_pool_worker(opts, events):
+    setproctitle("CoprActionWorker")
+    _pool_state.update(opts=opts, events=events)
+
+
+def run_action(action):
+    """
+    Executed inside the pool worker process
+
+    :return float: how long the action ran
+    """
+    opts = _pool_state["opts"]
+    events = _pool_state["events"]
+    start = time.time()
+    try:
+        Action(events, action, None, destdir=opts.destdir,
+               frontend_callback=FrontendCallback(opts, events),
+               front_url=opts.frontend_base_url,
+               results_root_url=opts.results_baseurl,
+               createrepo_coalesce=bool(opts.createrepo_debounce),
+               auto_createrepo_cache_ttl=opts.auto_createrepo_cache_ttl,
+               trash_dir=opts.trash_dir).run()
+    finally:
+        # frontend sends an action when the project settings change, builds
+        # finished from now on must ask for the fresh ones
+        rdb = get_redis_connection()
+        for project in action_projects(action):
+            if "/" in project:
+                invalidate_auto_createrepo_status(rdb, *project.split("/", 1))
+    return time.time() - start
+
+
+def run_delete_builds(actions):
+    """
+    Executed inside the pool worker process, runs build deletions
+    of one project as a single `DeleteBuildsBatch`
+
+    :return float: how long the batch ran
+    """
+    opts = _pool_state["opts"]
+    events = _pool_state["events"]
+    start = time.time()
+    DeleteBuildsBatch(events, actions, None, destdir=opts.destdir,
+                      frontend_callback=FrontendCallback(opts, events),
+                      front_url=opts.frontend_base_url,
+                      results_root_url=opts.results_baseurl,
+                      createrepo_coalesce=bool(opts.createrepo_debounce),
+                      auto_createrepo_cache_ttl=opts.auto_createrepo_cache_ttl,
+                      trash_dir=opts.trash_dir).run()
+    return time.time() - start
+
+
+class ActionExecutor(multiprocessing.Process):
+    """
+    Runs actions enqueued by the job grabber in a pool of `actions_workers`
+    processes.  Actions on different projects run concurrently, actions on
+    the same project keep their order.
+
+    At most `actions_workers` * PENDING_PER_WORKER actions are taken from
+    the queue, the rest waits in redis, where the job grabber checks the queue
+    length against `actions_queue_limit`.
+
+    Pending build deletions of one project (up to MAX_DELETE_BATCH) are run
+    together as `DeleteBuildsBatch`.
+
+    Ids of failed actions are sent back to the job grabber, which fetches
+    them from the frontend again.
+    """
+
+    PENDING_PER_WORKER = 10
+    MAX_DELETE_BATCH = 100
+
+    def __init__(self, opts, events):
+        multiprocessing.Process.__init__(self, name="action-executor")
+
+        self.opts = opts
+        self.events = events
+        self.queue = Queue(ACTIONS_QUEUE)
+        self.jobgrab_wakeup = Queue(JOBGRAB_WAKEUP_QUEUE)
+        self.pool = None
+
+        # taken from the queue and not started yet, in the receiving order
+        self.pending = []
+        # first action id -> (actions, projects, AsyncResult, started_on, waited)
+        self.running = {}
+        self.busy_projects = set()
+
+        self.stats = None
+        self.reset_stats()
+
+    def event(self, what):
+        self.events.put({"when": time.time(), "who": "action-executor", "what": what})
+
+    @property
+    def max_pending(self):
+        return self.opts.actions_workers * self.PENDING_PER_WORKER
+
+    def reset_stats(self):
+        self.stats = {"since": time.time(), "done": 0, "failed": 0,
+                      "wait": [], "run": []}
+
+    def fetch_actions(self, timeout=0):
+        """
+        Move actions from the queue into `pending`, wait up to `timeout`
+        seconds for the first one (0 == don't wait)
+        """
+        while len(self.pending) < self.max_pending:
+            if timeout:
+                task = self.queue.wait(timeout)
+                timeout = 0
+            else:
+                task = self.queue.dequeue()
+            if not task:
+                break
+            self.pending.append(task.data)
+
+    def deletion_batch(self, items, projects):
+        """
+        Build deletions following the first one in `items`, stops at another
+        action touching the project to keep the order
+        """
+        batch = []
+        for item in items:
+            if len(batch) + 1 >= self.MAX_DELETE_BATCH:
+                break
+            item_projects = action_projects(item["action"])
+            if not item_projects & projects:
+                continue
+            if item_projects != projects or not is_build_deletion(item["action"]):
+                break
+            batch.append(item)
+        return batch
+
+    def start_runnable(self):
+        """
+        Start pending actions whose projects are not used by running action
+        nor by older pending action
+        """
+        blocked = set(self.busy_projects)
+        still_pending = []
+        batched = set()
+        for index, item in enumerate(self.pending):
+            action = item["action"]
+            if action["id"] in batched:
+                continue
+            projects = action_projects(action)
+            if projects & blocked or len(self.running) >= self.opts.actions_workers:
+                blocked |= projects
+                still_pending.append(item)
+                continue
+
+            batch = [item]
+            if is_build_deletion(action):
+                batch.extend(self.deletion_batch(self.pending[index + 1:], projects))
+                batched.update(i["action"]["id"] for i in batch)
+
+            now = time.time()
+            actions = [i["action"] for i in batch]
+            if len(batch) == 1:
+                result = self.pool.apply_async(run_action, (action,))
+            else:
+                result = self.pool.apply_async(run_delete_builds, (actions,))
+            self.running[action["id"]] = \
+                (actions, projects, result, now,
+                 [now - i["enqueued_on"] for i in batch])
+            self.busy_projects |= projects
+            blocked |= projects
+
+        self.pending = still_pending
+
+    def collect_finished(self):
+        for action_id, (actions, projects, result, started_on, waited) \
+                in list(self.running.items()):
+            if not result.ready():
+                continue
+
+            del self.running[action_id]
+            self.busy_projects -= projects
+            ids = ", ".join(str(action["id"]) for action in actions)
+            try:
+                duration = result.get()
+                self.stats["done"] += len(actions)
+            # pylint: disable=W0703
+            except Exception as e:
+                self.stats["failed"] += len(actions)
+                duration = time.time() - started_on
+                self.event("Action {0} failed: {1}".format(ids, e))
+                self.retry_actions(actions)
+
+            self.stats["wait"].extend(waited)
+            self.stats["run"].extend([duration] * len(actions))
+            self.event("Action {0} (type {1}) waited {2:.1f}s, ran {3:.1f}s"
+                       .format(ids, actions[0]["action_type"], max(waited), duration))
+
+    def retry_actions(self, actions):
+        """
+        Make the job grabber forget `actions`, so they are fetched again
+        """
+        self.jobgrab_wakeup.enqueue(Task({
+            "who": "action-executor",
+            "failed_actions": [action["id"] for action in actions],
+        }))
+
+    def report_stats(self, now=None):
+        """
+        Log summary of action latencies every `actions_stats_interval` seconds
+        """
+        now = now or time.time()
+        if now - self.stats["since"] < self.opts.actions_stats_interval:
+            return
+
+        wait, run = self.stats["wait"], self.stats["run"]
+        self.event(
+            "Actions done: {0}, failed: {1}, wait avg/max: {2:.1f}/{3:.1f}s, "
+            "run avg/max: {4:.1f}/{5:.1f}s, running: {6}, pending: {7}, "
+            "queued: {8}".format(
+                self.stats["done"], self.stats["failed"],
+                sum(wait) / len(wait) if wait else 0, max(wait or [0]),
+                sum(run) / len(run) if run else 0, max(run or [0]),
+                len(self.running), len(self.pending), self.queue.length))
+        self.reset_stats()
+
+    def run(self):
+        setproctitle("CoprActionExecutor")
+        self.queue.connect()
+        self.jobgrab_wakeup.connect()
+        self.pool = multiprocessing.Pool(
+            self.opts.actions_workers, initializer=_init_pool_worker,
+            initargs=(self.opts, self.events))
+        try:
+            while True:
+                self.collect_finished()
+                # when idle wait for new actions inside redis, otherwise
+                # check the running ones every second
+                idle = not self.running and not self.pending
+                self.fetch_actions(self.opts.sleeptime if idle else 1)
+                self.start_runnable()
+                self.report_stats()
+                if len(self.pending) >= self.max_pending:
+                    time.sleep(1)
+        except KeyboardInterrupt:
+            return
+        finally:
+            self.pool.terminate()
@@ -6,6 +6,9 @@ import time
 from bunch import Bunch
 
 from .createrepo import createrepo, createrepo_unsafe
+from .manifest import get_manifest, lookup_package
+from .trash import move_to_trash
+from .sign import invalidate_pubkey
 
 
 class Action(object):
@@ -17,6 +20,10 @@ class Action(object):
         object to post data back to frontend
 
     :param str destdir: filepath with build results
+    :param bool createrepo_coalesce: run createrepo through CreaterepoService
+    :param int auto_createrepo_cache_ttl: cache project auto_createrepo setting
+    :param str trash_dir: deleted directories are moved there,
+        None removes them right away
 
     :param dict action: action job, fields:
         - action_type: main field determining what action to apply
@@ -26,7 +33,8 @@ class Action(object):
 
     def __init__(self, events, action, lock,
                  frontend_callback, destdir,
-                 front_url, results_root_url):
+                 front_url, results_root_url, createrepo_coalesce=False,
+                 auto_createrepo_cache_ttl=0, trash_dir=None):
         super(Action, self).__init__()
         self.frontend_callback = frontend_callback
         self.destdir = destdir
@@ -35,6 +43,9 @@ class Action(object):
         self.lock = lock
         self.front_url = front_url
         self.results_root_url = results_root_url
+        self.createrepo_coalesce = createrepo_coalesce
+        self.auto_createrepo_cache_ttl = auto_createrepo_cache_ttl
+        self.trash_dir = trash_dir
 
     def add_event(self, what):
         self.events.put({"when": time.time(), "who": "action", "what": what})
@@ -55,7 +66,8 @@ class Action(object):
 
             path = os.path.join(self.destdir, username, projectname, chroot)
 
-            errcode, _, err = createrepo_unsafe(path=path, lock=self.lock)
+            errcode, _, err = createrepo_unsafe(path=path, lock=self.lock,
+                                                coalesce=self.createrepo_coalesce)
             if errcode != 0 or err.strip():
                 self.add_event("Error making local repo: {0}".format(err))
                 failure = True
@@ -89,15 +101,27 @@ class Action(object):
         path = os.path.normpath(self.destdir + '/' + project)
         if os.path.exists(path):
             self.add_event("Removing copr {0}".format(path))
-            shutil.rmtree(path)
+            move_to_trash(self.trash_dir, path)
+        if "/" in project:
+            # project created again under the same name gets a new key
+            invalidate_pubkey(*project.strip("/").split("/", 1))
 
     def handle_delete_build(self):
         self.add_event("Action delete build")
+        ext_data = json.loads(self.data["data"])
+        for chroot in self.delete_build_dirs():
+            self.createrepo_after_delete(
+                ext_data["username"], ext_data["projectname"], chroot)
+
+    def delete_build_dirs(self):
+        """
+        Remove the build directories and logs from all chroots
+
+        :return list: chroots where some build directory was removed
+        """
         project = self.data["old_value"]
 
         ext_data = json.loads(self.data["data"])
-        username = ext_data["username"]
-        projectname = ext_data["projectname"]
 
         packages = [os.path.basename(x).replace(".src.rpm", "")
                     for x in ext_data["pkgs"].split()]
@@ -113,9 +137,11 @@ class Action(object):
             # already deleted
             chroot_list = []
 
+        altered = []
         for chroot in chroot_list:
             self.add_event("In chroot {0}".format(chroot))
-            altered = False
+            chroot_path = os.path.join(path, chroot)
+            deleted = []
 
             # We need to delete the files only if they belong
             # to the build. For example if my build fails and I send
@@ -123,33 +149,24 @@ class Action(object):
             # than I delete the failed, it would delete the succeeded
             # files as well - that would be wrong.
             for pkg in packages:
+                pkg_info = lookup_package(chroot_path, pkg)
                 if self.data["object_type"] == "build-succeeded" or (
                         self.data["object_type"] == "build-failed" and
-                        os.path.exists(os.path.join(path, chroot, pkg, "fail"))):
+                        pkg_info["state"] == "fail"):
 
-                    pkg_path = os.path.join(path, chroot, pkg)
-                    if os.path.isdir(pkg_path):
+                    pkg_path = os.path.join(chroot_path, pkg)
+                    if pkg_info["exists"]:
                         self.add_event("Removing build {0}".format(pkg_path))
-                        shutil.rmtree(pkg_path)
-                        altered = True
+                        move_to_trash(self.trash_dir, pkg_path)
+                        deleted.append(pkg)
                     else:
                         self.add_event(
                             "Package {0} dir not found in chroot {1}"
                             .format(pkg, chroot))
 
-            if altered:
-                self.add_event("Running createrepo")
-
-                result_base_url = "/".join(
-                    [self.results_root_url, username, projectname, chroot])
-                _, _, err = createrepo(
-                    path=os.path.join(path, chroot), lock=self.lock,
-                    front_url=self.front_url, base_url=result_base_url,
-                    username=username, projectname=projectname
-                )
-                if err.strip():
-                    self.add_event(
-                        "Error making local repo: {0}".format(err))
+            if deleted:
+                get_manifest(chroot_path).record_deleted(deleted)
+                altered.append(chroot)
 
             log_path = os.path.join(
                 path, chroot,
@@ -159,6 +176,24 @@ class Action(object):
                 self.add_event("Removing log {0}".format(log_path))
                 os.unlink(log_path)
 
+        return altered
+
+    def createrepo_after_delete(self, username, projectname, chroot):
+        self.add_event("Running createrepo")
+
+        result_base_url = "/".join(
+            [self.results_root_url, username, projectname, chroot])
+        _, _, err = createrepo(
+            path=os.path.join(self.destdir, self.data["old_value"], chroot),
+            lock=self.lock, front_url=self.front_url, base_url=result_base_url,
+            username=username, projectname=projectname,
+            coalesce=self.createrepo_coalesce,
+            cache_ttl=self.auto_createrepo_cache_ttl
+        )
+        if err.strip():
+            self.add_event(
+                "Error making local repo: {0}".format(err))
+
     def run(self):
         """ Handle action (other then builds) - like rename or delete of project """
         result = Bunch()
@@ -192,6 +227,46 @@ class Action(object):
             self.frontend_callback.update({"actions": [result]})
 
 
+class DeleteBuildsBatch(object):
+    """
+    Delete builds of one project requested by several actions, run createrepo
+    once per altered chroot and report all the results in one request
+
+    :param list actions: delete build actions of the same project,
+        other parameters are passed to `Action`
+    """
+
+    def __init__(self, events, actions, lock, frontend_callback, destdir,
+                 front_url, results_root_url, **kwargs):
+        self.frontend_callback = frontend_callback
+        self.actions = [
+            Action(events, action, lock, frontend_callback, destdir,
+                   front_url, results_root_url, **kwargs)
+            for action in actions
+        ]
+
+    def run(self):
+        altered = []
+        for action in self.actions:
+            action.add_event("Action delete build (batch of {0})"
+                             .format(len(self.actions)))
+            for chroot in action.delete_build_dirs():
+                if chroot not in altered:
+                    altered.append(chroot)
+
+        if altered:
+            ext_data = json.loads(self.actions[-1].data["data"])
+            for chroot in altered:
+                self.actions[-1].createrepo_after_delete(
+                    ext_data["username"], ext_data["projectname"], chroot)
+
+        now = time.time()
+        results = [Bunch(id=action.data["id"], result=ActionResult.SUCCESS,
+                         job_ended_on=now)
+                   for action in self.actions]
+        self.frontend_callback.update({"actions": results})
+
+
 class ActionType(object):
     DELETE = 0
     RENAME = 1
@@ -0,0 +1,98 @@
+from __future__ import division
+
+import math
+import time
+
+from retask.task import Task
+
+# expected job duration (seconds) until some jobs finish
+DEF_JOB_DURATION = 600
+# number of finished jobs used to estimate job duration
+DURATION_HISTORY = 100
+
+
+def poison_pill():
+    """
+    Task which makes the worker taking it exit cleanly
+    """
+    return Task({"poison_pill": True})
+
+
+def is_poison_pill(task):
+    return bool(task.data.get("poison_pill"))
+
+
+def durations_key(group_id):
+    return "copr-be-{0}-durations".format(group_id)
+
+
+def record_job_duration(rdb, group_id, duration):
+    """
+    Store duration of finished job into the group history kept in redis
+    """
+    key = durations_key(group_id)
+    rdb.lpush(key, duration)
+    rdb.ltrim(key, 0, DURATION_HISTORY - 1)
+
+
+def get_job_durations(rdb, group_id):
+    return [float(d) for d in rdb.lrange(durations_key(group_id), 0, -1)]
+
+
+class WorkerAutoscaler(object):
+    """
+    Decides how many workers a build group should run.
+
+    Backlog is expected to be drained in `autoscale_drain_time` seconds,
+    so more workers are requested when queued jobs multiplied by average job
+    duration don't fit into that time. When the queue stays empty for
+    `autoscale_idle_time` seconds workers are retired one by one down
+    to `min_workers`, one per call.
+
+    :param opts: backend options
+    :param dict group: build group options
+    """
+
+    def __init__(self, opts, group):
+        self.opts = opts
+        self.group = group
+        self.empty_since = None
+
+    def update(self, opts, group):
+        self.opts = opts
+        self.group = group
+
+    @property
+    def enabled(self):
+        return self.group["min_workers"] < self.group["max_workers"]
+
+    def clamp(self, count):
+        return max(self.group["min_workers"], min(self.group["max_workers"], count))
+
+    def desired_workers(self, current, queue_length, durations, now=None):
+        """
+        :param int current: number of running (not retiring) workers
+        :param int queue_length: number of jobs waiting in the group queue
+        :param list durations: durations of recently finished jobs
+        :return int: number of workers the group should have
+        """
+        if not self.enabled:
+            return self.group["max_workers"]
+
+        now = now or time.time()
+
+        if queue_length:
+            self.empty_since = None
+            avg_duration = (sum(durations) / len(durations)
+                            if durations else DEF_JOB_DURATION)
+            needed = int(math.ceil(
+                queue_length * avg_duration / self.opts.autoscale_drain_time))
+            return self.clamp(max(current, needed))
+
+        if self.empty_since is None:
+            self.empty_since = now
+
+        if now - self.empty_since < self.opts.autoscale_idle_time:
+            return self.clamp(current)
+
+        return self.clamp(current - 1)
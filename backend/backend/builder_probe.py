@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+Helper executed on the builder, collects all facts about a finished build
+and prints them as one JSON document, so the backend needs just one
+round trip instead of a command per fact.
+
+It is copied to the builder by :py:class:`backend.mockremote.Builder`
+and must not depend on anything but the standard library and rpm.
+
+Usage::
+
+    builder_probe.py post-build <srpm> <result dir>
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+
+def rpm_query(path, queryformat):
+    """ :return str: rpm -qp output, None when the query fails """
+    handle = subprocess.Popen(["rpm", "-qp", "--qf", queryformat, path],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, _ = handle.communicate()
+    if handle.returncode != 0:
+        return None
+    return stdout.decode("utf-8", "replace")
+
+
+def post_build(srpm, result_dir):
+    """
+    :param srpm: path or url of the source package
+    :param result_dir: mockchain result directory of the package
+    :return dict: pkg_version, success and built_packages
+        ("name version" lines, the same as printed by rpm -qp)
+    """
+    facts = {
+        "pkg_version": rpm_query(srpm, "%{VERSION}\n"),
+        "success": os.path.isfile(os.path.join(result_dir, "success")),
+        "built_packages": None,
+    }
+    if facts["pkg_version"] is not None:
+        facts["pkg_version"] = facts["pkg_version"].strip()
+
+    if facts["success"]:
+        lines = []
+        for name in sorted(os.listdir(result_dir)):
+            if name.endswith(".rpm") and not name.endswith(".src.rpm"):
+                line = rpm_query(os.path.join(result_dir, name),
+                                 "%{NAME} %{VERSION}\n")
+                if line:
+                    lines.append(line)
+        facts["built_packages"] = "".join(lines).rstrip("\n")
+
+    return facts
+
+
+def main(args):
+    if len(args) == 3 and args[0] == "post-build":
+        facts = post_build(args[1], args[2])
+    else:
+        sys.stderr.write(__doc__)
+        return 2
+
+    sys.stdout.write(json.dumps(facts) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
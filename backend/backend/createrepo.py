@@ -1,11 +1,94 @@
 import os
+import math
+import time
+import fcntl
+import errno
+import shutil
+import hashlib
+import threading
 import subprocess
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen
 
+from setproctitle import setproctitle
+from retask.task import Task
+from retask.queue import Queue
+
 from .helpers import get_auto_createrepo_status
 
+try:
+    import createrepo_c as cr
+except ImportError:
+    cr = None  # createrepo_c bindings are optional, see BindingsEngine
+
+# requests for CreaterepoService
+CREATEREPO_QUEUE = "copr-be-createrepo"
+# how long requester waits for CreaterepoService before running createrepo itself
+CREATEREPO_REQUEST_TIMEOUT = 1800
+# lock files of repositories, one per repository path, kept out of
+# the results tree served over HTTP
+REPO_LOCK_DIR = "/var/run/copr-backend/createrepo"
+
+
+class RepoLock(object):
+    """
+    Exclusive lock of one repository directory, held while createrepo_c runs.
 
-def createrepo_unsafe(path, lock=None, dest_dir=None, base_url=None):
+    Uses flock(2) on a file in REPO_LOCK_DIR named by the directory path,
+    so it works across all backend processes (and threads, every instance
+    opens its own file) and repositories of different projects and chroots
+    don't block each other.  Directory which doesn't exist is not locked.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+
+    @property
+    def lock_path(self):
+        name = hashlib.sha1(os.path.normpath(self.path).encode("utf-8")).hexdigest()
+        return os.path.join(REPO_LOCK_DIR, name)
+
+    def __enter__(self):
+        if os.path.isdir(self.path):
+            try:
+                os.makedirs(REPO_LOCK_DIR)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+            self.handle = open(self.lock_path, "a")
+            fcntl.flock(self.handle, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.handle:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+            self.handle.close()
+            self.handle = None
+
+
+def request_createrepo(path, dest_dir=None, base_url=None,
+                       timeout=CREATEREPO_REQUEST_TIMEOUT):
+    """
+    Ask CreaterepoService to regenerate the repository and wait for the result
+
+    :return tuple: (return_code,  stdout, stderr) or None when the service
+        is not reachable or didn't answer in `timeout` seconds
+    """
+    queue = Queue(CREATEREPO_QUEUE)
+    if not queue.connect():
+        return None
+
+    job = queue.enqueue(Task({"path": path, "dest_dir": dest_dir,
+                              "base_url": base_url}))
+    if not job or not job.wait(timeout):
+        return None
+    return tuple(job.result)
+
+
+def createrepo_unsafe(path, lock=None, dest_dir=None, base_url=None, coalesce=False):
     """
         Run createrepo_c on the given path
 
@@ -13,13 +96,21 @@ def createrepo_unsafe(path, lock=None, dest_dir=None, base_url=None):
         In most cases use `createrepo(...)`
 
     :param string path: target location to create repo
-    :param lock: [optional]
+    :param lock: [optional] lock held during the createrepo_c run in addition to
+        RepoLock of the path
     :param str dest_dir: [optional] relative to path location for repomd, in most cases
         you should also provide base_url.
     :param str base_url: optional parameter for createrepo_c, "--baseurl"
+    :param bool coalesce: let CreaterepoService run createrepo_c, merged with
+        other requests for the same repository, run it here when the service
+        doesn't answer
 
     :return tuple: (return_code,  stdout, stderr)
     """
+    if coalesce:
+        result = request_createrepo(path, dest_dir, base_url)
+        if result is not None:
+            return result
 
     comm = ['/usr/bin/createrepo_c', '--database', '--ignore-lock']
     if os.path.exists(path + '/repodata/repomd.xml'):
@@ -39,18 +130,20 @@ def createrepo_unsafe(path, lock=None, dest_dir=None, base_url=None):
 
     comm.append(path)
 
-    if lock:
-        with lock:
+    with RepoLock(path):
+        if lock:
+            with lock:
+                cmd = Popen(comm, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                out, err = cmd.communicate()
+        else:
             cmd = Popen(comm, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             out, err = cmd.communicate()
-    else:
-        cmd = Popen(comm, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = cmd.communicate()
 
     return cmd.returncode, out, err
 
 
-def createrepo(path, front_url, username, projectname, base_url=None, lock=None):
+def createrepo(path, front_url, username, projectname, base_url=None, lock=None,
+               coalesce=False, cache_ttl=0):
     """
         Creates repo depending on the project setting "auto_createrepo".
         When enabled creates `repodata` at the provided path, otherwise
@@ -60,7 +153,9 @@ def createrepo(path, front_url, username, projectname, base_url=None, lock=None)
     :param username: copr project owner username
     :param projectname: copr project name
     :param base_url: base_url to access rpms independently of repomd location
-    :param Multiprocessing.Lock lock:  [optional] global copr-backend lock
+    :param lock: [optional] see `createrepo_unsafe`
+    :param bool coalesce: [optional] see `createrepo_unsafe`
+    :param int cache_ttl: [optional] see `get_auto_createrepo_status`
 
     :return: tuple(returncode, stdout, stderr) produced by `createrepo_c`
     """
@@ -68,7 +163,279 @@ def createrepo(path, front_url, username, projectname, base_url=None, lock=None)
 
     base_url = base_url or ""
 
-    if get_auto_createrepo_status(front_url, username, projectname):
-        return createrepo_unsafe(path, lock)
+    if get_auto_createrepo_status(front_url, username, projectname, cache_ttl):
+        return createrepo_unsafe(path, lock, coalesce=coalesce)
     else:
-        return createrepo_unsafe(path, lock, base_url=base_url, dest_dir="devel")
+        return createrepo_unsafe(path, lock, base_url=base_url, dest_dir="devel",
+                                 coalesce=coalesce)
+
+
+class BindingsEngine(object):
+    """
+    Generates repodata using createrepo_c python bindings, keeping parsed
+    packages of the last `max_repos` repositories in memory.  Next run on
+    the same repository reads only RPMs which were added or changed
+    (by mtime and size) since the previous one, the rest of the metadata is
+    written from the cache.
+
+    Whenever the bindings are missing, the repository needs checksums older
+    than sha256 (epel-5) or anything fails, createrepo_c binary is run
+    by `createrepo_unsafe` instead.
+
+    :param callable log: takes a message
+    """
+
+    CHANGELOG_LIMIT = 10
+
+    def __init__(self, max_repos, log):
+        self.max_repos = max_repos
+        self.log = log
+        # path -> {relative path of rpm: (mtime, size, createrepo_c.Package)}
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+
+    @staticmethod
+    def available():
+        return cr is not None
+
+    def get_cached(self, path):
+        with self.cache_lock:
+            packages = self.cache.pop(path, {})
+            self.cache[path] = packages
+            while len(self.cache) > self.max_repos:
+                self.cache.popitem(last=False)
+            return packages
+
+    def forget(self, path):
+        with self.cache_lock:
+            self.cache.pop(path, None)
+
+    @staticmethod
+    def list_rpms(path):
+        """
+        :return dict: relative path -> (mtime, size) of all RPMs under `path`
+        """
+        rpms = {}
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if d != "repodata" and not d.startswith(".")]
+            for name in files:
+                if not name.endswith(".rpm"):
+                    continue
+                full_path = os.path.join(root, name)
+                stat = os.stat(full_path)
+                rpms[os.path.relpath(full_path, path)] = (stat.st_mtime, stat.st_size)
+        return rpms
+
+    def update_packages(self, path):
+        """
+        Sync cached packages of the repository with RPMs on disk
+
+        :return tuple: (packages sorted by location, number of newly read RPMs)
+        """
+        cached = self.get_cached(path)
+        rpms = self.list_rpms(path)
+
+        for href in list(cached):
+            if href not in rpms:
+                del cached[href]
+
+        read = 0
+        for href, (mtime, size) in rpms.items():
+            if href in cached and cached[href][:2] == (mtime, size):
+                continue
+            pkg = cr.package_from_rpm(os.path.join(path, href),
+                                      checksum_type=cr.SHA256,
+                                      location_href=href,
+                                      changelog_limit=self.CHANGELOG_LIMIT)
+            cached[href] = (mtime, size, pkg)
+            read += 1
+
+        return [cached[href][2] for href in sorted(cached)], read
+
+    @staticmethod
+    def write_repodata(out_dir, packages, base_url=None):
+        """
+        Write complete repodata into `out_dir`/repodata, replacing the old one
+        only when the new one is complete
+        """
+        repodata = os.path.join(out_dir, "repodata")
+        new_repodata = os.path.join(out_dir, ".repodata.new")
+        old_repodata = os.path.join(out_dir, ".repodata.old")
+        for stale in [new_repodata, old_repodata]:
+            if os.path.exists(stale):
+                shutil.rmtree(stale)
+        os.makedirs(new_repodata)
+
+        def md_path(name):
+            return os.path.join(new_repodata, name)
+
+        xml_files = [
+            ("primary", md_path("primary.xml.gz"), cr.PrimaryXmlFile),
+            ("filelists", md_path("filelists.xml.gz"), cr.FilelistsXmlFile),
+            ("other", md_path("other.xml.gz"), cr.OtherXmlFile),
+        ]
+        db_files = [
+            ("primary_db", md_path("primary.sqlite"), cr.PrimarySqlite),
+            ("filelists_db", md_path("filelists.sqlite"), cr.FilelistsSqlite),
+            ("other_db", md_path("other.sqlite"), cr.OtherSqlite),
+        ]
+        xmls = [cls(md_file) for _, md_file, cls in xml_files]
+        dbs = [cls(md_file) for _, md_file, cls in db_files]
+
+        for xml in xmls:
+            xml.set_num_of_pkgs(len(packages))
+        for pkg in packages:
+            pkg.location_base = base_url or None
+            for md in xmls + dbs:
+                md.add_pkg(pkg)
+        for xml in xmls:
+            xml.close()
+
+        repomd = cr.Repomd()
+        # databases store checksum of their xml counterpart
+        for (name, md_file, _), db in zip(xml_files, dbs):
+            record = cr.RepomdRecord(name, md_file)
+            record.fill(cr.SHA256)
+            db.dbinfo_update(record.checksum)
+            db.close()
+            repomd.set_record(record)
+        for name, md_file, _ in db_files:
+            record = cr.RepomdRecord(name, md_file)
+            record.fill(cr.SHA256)
+            repomd.set_record(record)
+
+        with open(md_path("repomd.xml"), "w") as handle:
+            handle.write(repomd.xml_dump())
+
+        if os.path.exists(repodata):
+            os.rename(repodata, old_repodata)
+        os.rename(new_repodata, repodata)
+        if os.path.exists(old_repodata):
+            shutil.rmtree(old_repodata)
+
+    def createrepo(self, path, dest_dir=None, base_url=None):
+        """
+        Same as `createrepo_unsafe`
+
+        :return tuple: (return_code,  stdout, stderr)
+        """
+        if not self.available() or "epel-5" in path:
+            return createrepo_unsafe(path, dest_dir=dest_dir, base_url=base_url)
+
+        out_dir = os.path.join(path, dest_dir) if dest_dir else path
+        try:
+            with RepoLock(path):
+                packages, read = self.update_packages(path)
+                self.write_repodata(out_dir, packages, base_url)
+        # pylint: disable=W0703
+        except Exception as e:
+            self.log("createrepo_c bindings failed on {0}: {1}, running createrepo_c"
+                     .format(path, e))
+            self.forget(path)
+            return createrepo_unsafe(path, dest_dir=dest_dir, base_url=base_url)
+
+        return 0, "{0} packages, {1} read".format(len(packages), read), ""
+
+
+class CreaterepoService(multiprocessing.Process):
+    """
+    Runs createrepo_c for workers and actions.
+
+    Requests for the same repository (path, dest_dir, base_url) received
+    within `createrepo_debounce` seconds since the first of them are merged
+    into a single createrepo_c run and all requesters get its result.
+    Requests received while createrepo_c runs start a new window, so
+    packages added meanwhile are never missed.
+
+    Up to `createrepo_workers` repositories are regenerated at once,
+    runs for the same repository are serialized by RepoLock.
+
+    With `createrepo_engine` = bindings, repositories are regenerated
+    by BindingsEngine living in this process.
+    """
+
+    def __init__(self, opts, events):
+        multiprocessing.Process.__init__(self, name="createrepo-service")
+
+        self.opts = opts
+        self.events = events
+        self.queue = Queue(CREATEREPO_QUEUE)
+        self.pool = None
+        self.engine = None
+        if opts.createrepo_engine == "bindings":
+            self.engine = BindingsEngine(opts.createrepo_cache_repos, self.event)
+        # (path, dest_dir, base_url) -> {"since": first request, "tasks": [...]}
+        self.pending = OrderedDict()
+
+    def event(self, what):
+        self.events.put({"when": time.time(), "who": "createrepo", "what": what})
+
+    def add_request(self, task, now=None):
+        data = task.data
+        key = (data["path"], data.get("dest_dir"), data.get("base_url"))
+        if key not in self.pending:
+            self.pending[key] = {"since": now or time.time(), "tasks": []}
+        self.pending[key]["tasks"].append(task)
+
+    def due_requests(self, now=None):
+        """
+        :return list: keys of repositories whose debounce window is over
+        """
+        now = now or time.time()
+        return [key for key, request in self.pending.items()
+                if now - request["since"] >= self.opts.createrepo_debounce]
+
+    def next_timeout(self, now=None):
+        """
+        Seconds to wait for new requests before some window is over
+        """
+        if not self.pending:
+            return self.opts.sleeptime
+        now = now or time.time()
+        first = min(request["since"] for request in self.pending.values())
+        left = first + self.opts.createrepo_debounce - now
+        # BRPOP takes whole seconds and 0 means forever
+        return max(1, int(math.ceil(left)))
+
+    def regenerate(self, key, tasks):
+        """
+        Run createrepo_c once for all `tasks` and send them the result
+        """
+        path, dest_dir, base_url = key
+
+        start = time.time()
+        try:
+            if self.engine:
+                result = self.engine.createrepo(path, dest_dir, base_url)
+            else:
+                result = createrepo_unsafe(path, dest_dir=dest_dir, base_url=base_url)
+        except OSError as e:
+            result = (1, "", str(e))
+
+        self.event("createrepo {0} for {1} requests took {2:.1f}s".format(
+            path, len(tasks), time.time() - start))
+
+        for task in tasks:
+            self.queue.send(task, list(result))
+
+    def run(self):
+        setproctitle("CoprCreaterepoService")
+        if self.engine and not self.engine.available():
+            self.event("createrepo_c python bindings not installed, "
+                       "running createrepo_c binary")
+        self.queue.connect()
+        self.pool = ThreadPool(self.opts.createrepo_workers)
+        try:
+            while True:
+                task = self.queue.wait(self.next_timeout())
+                while task:
+                    self.add_request(task)
+                    task = self.queue.dequeue()
+
+                for key in self.due_requests():
+                    request = self.pending.pop(key)
+                    self.pool.apply_async(self.regenerate, (key, request["tasks"]))
+        except KeyboardInterrupt:
+            return
+        finally:
+            self.pool.terminate()
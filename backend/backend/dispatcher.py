@@ -1,40 +1,34 @@
-import re
 import os
 import sys
+import json
 import time
 import fcntl
-import json
-import subprocess
 import multiprocessing
 
 import ansible
-import ansible.runner
 import ansible.utils
 from ansible import callbacks
 
 from setproctitle import setproctitle
-from IPy import IP
+from retask.task import Task
 from retask.queue import Queue
 
 from .exceptions import MockRemoteError, CoprWorkerError
 from .job import BuildJob
 
 from .mockremote import MockRemote, CliLogCallBack
+from .manifest import lookup_package
 from .callback import FrontendCallback
-
-ansible_playbook = "ansible-playbook"
+from .vm_manage import VmProvisioner, BuilderPool
+from .autoscale import is_poison_pill, record_job_duration
 
 try:
     import fedmsg
 except ImportError:
     pass  # fedmsg is optional
 
-
-def ans_extra_vars_encode(extra_vars, name):
-    """ transform dict into --extra-vars="json string" """
-    if not extra_vars:
-        return ""
-    return "--extra-vars='{{\"{0}\": {1}}}'".format(name, json.dumps(extra_vars))
+# workers put anything here to make CoprJobGrab poll the frontend right away
+JOBGRAB_WAKEUP_QUEUE = "copr-be-jobgrab-wakeup"
 
 
 class SilentPlaybookCallbacks(callbacks.PlaybookCallbacks):
@@ -134,6 +128,8 @@ class Worker(multiprocessing.Process):
         # job management stuff
         self.task_queue = Queue("copr-be-{0}".format(str(group_id)))
         self.task_queue.connect()
+        self.jobgrab_wakeup = Queue(JOBGRAB_WAKEUP_QUEUE)
+        self.jobgrab_wakeup.connect()
         # event queue for communicating back to dispatcher
         self.events = events
         self.worker_num = worker_num
@@ -146,6 +142,9 @@ class Worker(multiprocessing.Process):
         self.create = create
         self.lock = lock
         self.spawn_in_advance = self.opts.spawn_in_advance
+        self.leased_vm = None
+        # builder kept after the last job, see `keep_builder`
+        self.kept_builder = None
         self.frontend_callback = FrontendCallback(opts, events)
         if not self.callback:
             log_name = "worker-{0}-{1}.log".format(
@@ -155,8 +154,17 @@ class Worker(multiprocessing.Process):
             self.logfile = os.path.join(self.opts.worker_logdir, log_name)
             self.callback = WorkerCallback(logfile=self.logfile)
 
+        self.vm_provisioner = VmProvisioner(opts, group_id, self.callback)
+
+        self.builder_pool = None
+        if self.opts.build_groups[self.group_id]["pool_min_idle"]:
+            self.builder_pool = BuilderPool(group_id)
+            self.builder_pool.connect()
+
         if ip:
             self.callback.log("creating worker: {0}".format(ip))
+        elif self.builder_pool:
+            self.callback.log("creating worker: builders from pool")
         else:
             self.callback.log("creating worker: dynamic ip")
 
@@ -217,11 +225,17 @@ class Worker(multiprocessing.Process):
 
         self.event("chroot.start", template, content)
 
-    def _announce_end(self, job, ip="none"):
+    def _announce_end(self, job, ip="none", ran_build=True):
         """
         Announce everywhere that a build process ended now.
+
+        :param bool ran_build: the package was really built, only then the
+            duration counts into the job durations used by the autoscaler
         """
         job.ended_on = time.time()
+        if ran_build and job.started_on:
+            record_job_duration(self.task_queue.rdb, self.group_id,
+                                job.ended_on - job.started_on)
 
         self.return_results(job)
         self.callback.log("worker finished build: {0}".format(ip))
@@ -236,35 +250,9 @@ class Worker(multiprocessing.Process):
 
     def run_ansible_playbook(self, args, name="running playbook", attempts=9):
         """
-        call ansible playbook
-            - well mostly we run out of space in OpenStack so we rather try
-              multiple times (attempts param)
-            - dump any attempt failure
+        call ansible playbook, see :py:meth:`VmProvisioner.run_ansible_playbook`
         """
-
-        # Ansible playbook python API does not work here, dunno why.  See:
-        # https://groups.google.com/forum/#!topic/ansible-project/DNBD2oHv5k8
-
-        command = "{0} {1}".format(ansible_playbook, args)
-
-        for i in range(0, attempts):
-            try:
-                attempt_desc = ": retry: " if i else ": begin: "
-                self.callback.log(name + attempt_desc + command)
-
-                result = subprocess.check_output(command, shell=True)
-                self.callback.log("Raw playbook output:\n{0}\n".format(result))
-                break
-
-            except subprocess.CalledProcessError as e:
-                result = None
-                self.callback.log("CalledProcessError: \n{0}\n".format(e.output))
-                sys.stderr.write("{0}\n".format(e.output))
-                # FIXME: this is not purpose of opts.sleeptime
-                time.sleep(self.opts.sleeptime)
-
-        self.callback.log(name + ": end")
-        return result
+        return self.vm_provisioner.run_ansible_playbook(args, name, attempts)
 
     def spawn_instance(self, job):
         """
@@ -272,96 +260,177 @@ class Worker(multiprocessing.Process):
         get an IP and test if the builder responds
         repeat this until you get an IP of working builder
         """
+        ip, self.vm_name = self.vm_provisioner.spawn_instance(job.chroot)
+        return ip
 
-        start = time.time()
-
-        # Ansible playbook python API does not work here, dunno why.  See:
-        # https://groups.google.com/forum/#!topic/ansible-project/DNBD2oHv5k8
+    def terminate_instance(self, instance_ip):
+        """call the terminate playbook to destroy the building instance"""
+        self.vm_provisioner.terminate_instance(instance_ip, self.vm_name)
 
-        extra_vars = {}
-        if self.opts.spawn_vars:
-            for i in self.opts.spawn_vars.split(","):
-                if i == 'chroot':
-                    extra_vars['chroot'] = job['chroot']
+    def get_task(self):
+        """
+        Take the next task from the group queue.
 
-        try:
-            spawn_playbook = self.opts.build_groups[self.group_id]["spawn_playbook"]
-        except KeyError:
-            return None
+        With `blocking_dequeue` enabled waits inside redis (BRPOP) up to
+        `sleeptime` seconds, so the worker gets a task right after
+        it is enqueued, otherwise polls the queue and sleeps when it is empty.
 
-        args = "-c ssh {0} {1}".format(
-            spawn_playbook, ans_extra_vars_encode(extra_vars, "copr_task"))
+        When a builder is kept from the last job, tasks for the same chroot
+        and owner are preferred.
 
-        i = 0
-        while True:
-            i += 1
-            self.callback.log("Spawning a builder. Try No. {0}".format(i))
-            result = self.run_ansible_playbook(args, "spawning instance")
-            if not result:
-                self.callback.log("No result, trying again")
-                continue
+        :return: retask.task.Task or None
+        """
+        if self.kept_builder:
+            task = self.take_matching_task()
+            if task:
+                return task
+            if self.kept_builder_expired():
+                self.drop_kept_builder()
+
+        task = None
+        if self.opts.blocking_dequeue:
+            task = self.task_queue.wait(self.opts.sleeptime)
+        else:
+            # this sometimes caused TypeError in random worker
+            # when another one  picekd up a task to build
+            # why?
+            try:
+                task = self.task_queue.dequeue()
+            except TypeError:
+                pass
 
-            match = re.search(r'IP=([^\{\}"]+)', result, re.MULTILINE)
-            if not match:
-                self.callback.log("No ip in the result, trying again")
-                continue
-            ipaddr = match.group(1)
+            if not task:
+                time.sleep(self.opts.sleeptime)
 
-            match = re.search(r'vm_name=([^\{\}"]+)', result, re.MULTILINE)
-            if match:
-                self.vm_name = match.group(1)
+        return task or None
 
-            self.callback.log("got instance ip: {0}".format(ipaddr))
-            self.callback.log(
-                "Instance spawn/provision took {0} sec".format(time.time() - start))
+    def take_matching_task(self):
+        """
+        Pick the oldest queued task which can be built on the kept builder.
+        Group queue holds only a few tasks (see `scheduler_queue_depth`)
+        so it is cheap to scan it whole.
 
-            try:
-                IP(ipaddr)
-            except ValueError:
-                # if we get here we"re in trouble
-                self.callback.log(
-                    "Invalid IP back from spawn_instance - dumping cache output")
-                self.callback.log(str(result))
+        :return: retask.task.Task or None
+        """
+        # retask queue is LPUSH/RPOP, the oldest task is at the end
+        queue_key = self.task_queue._name
+        rdb = self.task_queue.rdb
+        for raw in reversed(rdb.lrange(queue_key, 0, -1)):
+            task = Task()
+            task.__dict__ = json.loads(raw)
+            if is_poison_pill(task) or not self.builder_matches(task.data):
                 continue
+            # LREM argument order differs between redis-py versions
+            if rdb.execute_command("LREM", queue_key, 1, raw):
+                return task
+            # somebody else took it meanwhile
+        return None
 
-            # we were getting some dead instancies
-            # that's why I'm testing the conncectivity here
-            connection = ansible.runner.Runner(
-                remote_user="root",
-                host_list="{},".format(ipaddr),
-                pattern=ipaddr,
-                forks=1,
-                transport="ssh",
-                timeout=500
-            )
-            connection.module_name = "shell"
-            connection.module_args = "echo hello"
-            res = connection.run()
+    def builder_matches(self, task_data):
+        """
+        Kept builder may be used only for the same chroot and the same
+        owner, builds of different owners must not share a builder
+        """
+        return (self.kept_builder is not None and
+                task_data.get("chroot") == self.kept_builder["chroot"] and
+                task_data.get("project_owner") == self.kept_builder["owner"])
 
-            if res["contacted"]:
-                return ipaddr
+    def kept_builder_expired(self):
+        return time.time() - self.kept_builder["since"] >= \
+            self.opts.builder_reuse_max_time
 
-            else:
-                self.callback.log(
-                    "Worker is not responding to"
-                    "the testing playbook. Spawning another one.")
-                self.terminate_instance(ipaddr)
+    def keep_builder(self, job, ip):
+        """
+        Decide whether the builder used for `job` is kept for the next job,
+        clean it when so.  Builder is kept for at most `builder_reuse_max_jobs`
+        jobs and `builder_reuse_max_time` seconds.
 
-    def terminate_instance(self, instance_ip):
-        """call the terminate playbook to destroy the building instance"""
+        :return bool: True when the builder was kept
+        """
+        if self.opts.builder_reuse_max_jobs <= 1 or self.ip:
+            return False
+
+        kept = self.kept_builder or {
+            "ip": ip,
+            "chroot": job.chroot,
+            "owner": job.project_owner,
+            "since": time.time(),
+            "jobs": 0,
+        }
+        kept["jobs"] += 1
+        self.kept_builder = kept
+
+        if kept["jobs"] >= self.opts.builder_reuse_max_jobs or \
+                self.kept_builder_expired():
+            self.kept_builder = None
+            return False
+
+        if not self.vm_provisioner.clean_builder(ip):
+            self.callback.log("could not clean builder {0}, not reusing it".format(ip))
+            self.kept_builder = None
+            return False
+
+        self.callback.log("keeping builder {0} for {1} jobs of {2} in {3}".format(
+            ip, kept["jobs"], kept["owner"], kept["chroot"]))
+        return True
+
+    def take_kept_builder(self, job):
+        """
+        :return str: ip of the kept builder when it can be used for `job`
+        """
+        if not self.kept_builder:
+            return None
+
+        task_data = {"chroot": job.chroot, "project_owner": job.project_owner}
+        if self.builder_matches(task_data) and not self.kept_builder_expired():
+            self.callback.log("reusing builder {0}".format(self.kept_builder["ip"]))
+            return self.kept_builder["ip"]
 
-        term_args = {}
-        if self.opts.terminate_vars:
-            for i in self.opts.terminate_vars.split(","):
-                if i == "ip":
-                    term_args["ip"] = instance_ip
-                if i == "vm_name":
-                    term_args["vm_name"] = self.vm_name
+        self.drop_kept_builder()
+        return None
 
-        args = "-c ssh -i '{0},' {1} {2}".format(
-            instance_ip, self.opts.build_groups[self.group_id]["terminate_playbook"],
-            ans_extra_vars_encode(term_args, "copr_task"))
-        self.run_ansible_playbook(args, "terminate instance")
+    def drop_kept_builder(self):
+        if not self.kept_builder:
+            return
+        ip = self.kept_builder["ip"]
+        self.kept_builder = None
+        self.callback.log("releasing kept builder {0}".format(ip))
+        self.release_builder(ip)
+
+    def wake_up_jobgrab(self, job):
+        """
+        Tell job grabber the job is done, so it can schedule more tasks,
+        and ask for new tasks when our queue is drained
+        """
+        self.jobgrab_wakeup.enqueue(Task({
+            "who": self.worker_num,
+            "group_id": self.group_id,
+            "task_id": getattr(job, "task_id", None),
+            "drained": self.task_queue.length == 0,
+        }))
+
+    def lease_builder(self):
+        """
+        Take a ready builder from the group pool, wait until some appears
+        """
+        while not self.kill_received:
+            vm = self.builder_pool.lease(self.opts.sleeptime)
+            if vm:
+                self.callback.log("leased builder {0} from the pool".format(vm["ip"]))
+                self.vm_name = vm.get("vm_name")
+                self.leased_vm = vm
+                return vm["ip"]
+        raise CoprWorkerError("Worker killed while waiting for a builder")
+
+    def release_builder(self, ip):
+        """
+        Get rid of the builder used for the last job
+        """
+        if self.leased_vm:
+            self.builder_pool.dispose(self.leased_vm)
+            self.leased_vm = None
+        else:
+            self.terminate_instance(ip)
 
     def mark_started(self, job):
         """
@@ -422,12 +491,8 @@ class Worker(multiprocessing.Process):
         """
         s_pkg = os.path.basename(pkgs[0])
         pdn = s_pkg.replace(".src.rpm", "")
-        resdir = "{0}/{1}/{2}".format(destdir, chroot, pdn)
-        resdir = os.path.normpath(resdir)
-        if os.path.exists(resdir):
-            if os.path.exists(os.path.join(resdir, "success")):
-                return True
-        return False
+        chroot_dir = os.path.normpath(os.path.join(destdir, chroot))
+        return lookup_package(chroot_dir, pdn)["state"] == "success"
 
     def __spawn_with_check(self, job):
         """ Wrapper around self.spawn_instance() with exception checking """
@@ -447,26 +512,24 @@ class Worker(multiprocessing.Process):
         for each job it takes from the jobs queue
         run opts.setup_playbook to create the instance
         do the build (mockremote)
-        terminate the instance.
+        terminate the instance (or keep it for the next job, see `keep_builder`).
         """
 
+        # builder spawned in advance (spawn_in_advance)
+        advance_ip = None
         while not self.kill_received:
             setproctitle("worker-{0} {1}  No task".format(
                 self.opts.build_groups[self.group_id]["name"],
                 self.worker_num))
 
-            # this sometimes caused TypeError in random worker
-            # when another one  picekd up a task to build
-            # why?
-            try:
-                task = self.task_queue.dequeue()
-            except TypeError:
-                pass
-
+            task = self.get_task()
             if not task:
-                time.sleep(self.opts.sleeptime)
                 continue
 
+            if is_poison_pill(task):
+                self.callback.log("got poison pill, worker is retiring")
+                break
+
             job = BuildJob(task.data, self.opts)
 
             setproctitle("worker-{0} {1}  Task: {2}".format(
@@ -477,6 +540,7 @@ class Worker(multiprocessing.Process):
 
             # Checking whether the build is not cancelled
             if not self.starting_build(job):
+                self.wake_up_jobgrab(job)
                 continue
 
             # Initialize Fedmsg
@@ -500,19 +564,26 @@ class Worker(multiprocessing.Process):
                     .format(' '.join(job.pkgs)))
 
                 job.status = 5  # skipped
-                self._announce_end(job)
+                self._announce_end(job, ran_build=False)
+                self.wake_up_jobgrab(job)
                 continue
             # FIXME
             # this is our best place to sanity check the job before starting
             # up any longer process
 
             if self.create and not self.ip:
-                if not self.spawn_in_advance:
-                    ip = self.__spawn_with_check(job)
-                # else we get ip from similar calling at the enf of this while-loop
+                ip = self.take_kept_builder(job)
+                if not ip and self.builder_pool:
+                    ip = self.lease_builder()
+                elif not ip:
+                    # advance_ip is spawned at the end of the previous loop
+                    ip = advance_ip or self.__spawn_with_check(job)
+                advance_ip = None
             else:
                 ip = self.ip
 
+            finished = False
+            ran_build = False
             try:
                 self._announce_start(job, ip)
 
@@ -580,9 +651,18 @@ class Worker(multiprocessing.Process):
                             callback=CliLogCallBack(
                                 quiet=True, logfn=chrootlogfile),
                             front_url=self.opts.frontend_base_url,
-                            results_base_url=self.opts.results_baseurl
+                            results_base_url=self.opts.results_baseurl,
+                            createrepo_coalesce=bool(self.opts.createrepo_debounce),
+                            auto_createrepo_cache_ttl=self.opts.auto_createrepo_cache_ttl,
+                            sign_workers=self.opts.sign_workers,
+                            sign_rate_limit=self.opts.sign_rate_limit,
+                            sign_batch_size=self.opts.sign_batch_size,
+                            ssh_control_dir=self.opts.ssh_control_dir,
+                            ssh_control_persist=self.opts.ssh_control_persist,
+                            poll_max_interval=self.opts.build_poll_max_interval,
                         )
 
+                        ran_build = True
                         build_details = mr.build_pkgs(job.pkgs)
 
                         if self.opts.do_sign:
@@ -610,11 +690,19 @@ class Worker(multiprocessing.Process):
                             job.chroot, str(job.repos)))
 
                 job.status = status
-                self._announce_end(job, ip)
+                self._announce_end(job, ip, ran_build=ran_build)
+                self.wake_up_jobgrab(job)
+                finished = True
 
             finally:
                 # clean up the instance
-                if self.create:
-                    self.terminate_instance(ip)
-            if self.create and not self.ip and self.spawn_in_advance:
-                ip = self.__spawn_with_check(job)
+                if self.create and not (finished and self.keep_builder(job, ip)):
+                    self.kept_builder = None
+                    self.release_builder(ip)
+            if self.create and not self.ip and self.spawn_in_advance \
+                    and not self.builder_pool and not self.kept_builder:
+                advance_ip = self.__spawn_with_check(job)
+
+        self.drop_kept_builder()
+        if advance_ip:
+            self.terminate_instance(advance_ip)
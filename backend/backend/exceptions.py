@@ -63,7 +63,7 @@ class CoprKeygenRequestError(MockRemoteError):
         out = super(CoprKeygenRequestError, self).__str__()
         out += "\nrequest to copr-keygen: {0}\n".format(self.request)
         if self.response:
-            out += "status code: {1}\n" "response content: {2}\n" \
+            out += "status code: {0}\n" "response content: {1}\n" \
                 .format(self.response.status_code, self.response.content)
         return out
 
@@ -3,16 +3,23 @@ from __future__ import unicode_literals
 from __future__ import division
 from __future__ import absolute_import
 
+from collections import OrderedDict
 from operator import methodcaller
 import optparse
 import ConfigParser
+import multiprocessing
 import os
+import time
 
+import redis
 from bunch import Bunch
 from copr.client import CoprClient
 
 from .exceptions import CoprBackendError
 
+# longest wait between build status polls, the fixed interval used to be 10s
+DEF_POLL_MAX_INTERVAL = 10
+
 
 class SortedOptParser(optparse.OptionParser):
 
@@ -54,6 +61,65 @@ def _get_conf(cp, section, option, default, mode=None):
     return default
 
 
+class BoundedIdSet(object):
+    """
+    Set of recently seen ids with O(1) membership test.
+
+    Ids are evicted in insertion order when the set grows over `max_size`
+    or when they are older than `max_age` seconds, so the memory used by
+    long running processes stays bounded.
+
+    :param int max_size: maximum number of remembered ids
+    :param int max_age: [optional] seconds after which an id is forgotten
+    """
+
+    def __init__(self, max_size, max_age=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._items = OrderedDict()
+
+    def __contains__(self, item):
+        if item not in self._items:
+            return False
+        if self.max_age is not None and \
+                time.time() - self._items[item] > self.max_age:
+            del self._items[item]
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item):
+        if item in self._items:
+            del self._items[item]
+        self._items[item] = time.time()
+        self.evict()
+
+    def discard(self, item):
+        self._items.pop(item, None)
+
+    def retain(self, items):
+        """
+        Forget every id not present in `items`
+        """
+        keep = set(items)
+        for item in [i for i in self._items if i not in keep]:
+            del self._items[item]
+
+    def evict(self):
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+        if self.max_age is not None:
+            limit = time.time() - self.max_age
+            while self._items:
+                item, added = next(iter(self._items.items()))
+                if added >= limit:
+                    break
+                del self._items[item]
+
+
 class BackendConfigReader(object):
     def __init__(self, config_file=None, ext_opts=None):
         self.config_file = config_file or "/etc/copr/copr-be.conf"
@@ -99,6 +165,22 @@ class BackendConfigReader(object):
 
         opts.do_sign = _get_conf(
             cp, "backend", "do_sign", False, mode="bool")
+        opts.sign_workers = _get_conf(
+            cp, "backend", "sign_workers", 4, mode="int")
+        opts.sign_rate_limit = _get_conf(
+            cp, "backend", "sign_rate_limit", 10, mode="int")
+        opts.sign_batch_size = _get_conf(
+            cp, "backend", "sign_batch_size", 50, mode="int")
+
+        opts.ssh_control_dir = _get_conf(
+            cp, "backend", "ssh_control_dir", "/var/run/copr-backend/ssh",
+            mode="path")
+        opts.ssh_control_persist = _get_conf(
+            cp, "backend", "ssh_control_persist", 600, mode="int")
+
+        opts.build_poll_max_interval = _get_conf(
+            cp, "backend", "build_poll_max_interval", DEF_POLL_MAX_INTERVAL,
+            mode="int")
 
         opts.build_groups_count = _get_conf(
             cp, "backend", "build_groups", 1, mode="int")
@@ -120,11 +202,24 @@ class BackendConfigReader(object):
                     default="/srv/copr-work/provision/terminatepb-PC.yml"),
                 "max_workers": _get_conf(
                     cp, "backend", "group{0}_max_workers".format(group_id),
-                    default=8, mode="int")
+                    default=8, mode="int"),
+                "pool_min_idle": _get_conf(
+                    cp, "backend", "group{0}_pool_min_idle".format(group_id),
+                    default=0, mode="int"),
             }
+            group["min_workers"] = _get_conf(
+                cp, "backend", "group{0}_min_workers".format(group_id),
+                default=group["max_workers"], mode="int")
+            group["pool_max_total"] = _get_conf(
+                cp, "backend", "group{0}_pool_max_total".format(group_id),
+                default=group["max_workers"] + group["pool_min_idle"], mode="int")
             opts.build_groups.append(group)
 
         opts.destdir = _get_conf(cp, "backend", "destdir", None, mode="path")
+        opts.trash_dir = _get_conf(
+            cp, "backend", "trash_dir", "/var/lib/copr/trash", mode="path")
+        opts.trash_reap_rate = _get_conf(
+            cp, "backend", "trash_reap_rate", 1000, mode="int")
 
         opts.exit_on_worker = _get_conf(
             cp, "backend", "exit_on_worker", False, mode="bool")
@@ -132,6 +227,23 @@ class BackendConfigReader(object):
             cp, "backend", "fedmsg_enabled", False, mode="bool")
         opts.sleeptime = _get_conf(
             cp, "backend", "sleeptime", 10, mode="int")
+        opts.blocking_dequeue = _get_conf(
+            cp, "backend", "blocking_dequeue", True, mode="bool")
+        opts.waiting_resync_interval = _get_conf(
+            cp, "backend", "waiting_resync_interval", 600, mode="int")
+        opts.added_jobs_max_size = _get_conf(
+            cp, "backend", "added_jobs_max_size", 100000, mode="int")
+        opts.added_jobs_max_age = _get_conf(
+            cp, "backend", "added_jobs_max_age", 7 * 24 * 3600, mode="int")
+
+        opts.scheduler_owner_weights = _get_conf(
+            cp, "backend", "scheduler_owner_weights", None)
+        opts.scheduler_owner_limit = _get_conf(
+            cp, "backend", "scheduler_owner_limit", 0, mode="int")
+        opts.scheduler_queue_depth = _get_conf(
+            cp, "backend", "scheduler_queue_depth", 0, mode="int")
+        opts.scheduler_bulk_threshold = _get_conf(
+            cp, "backend", "scheduler_bulk_threshold", 100, mode="int")
         opts.timeout = _get_conf(
             cp, "builder", "timeout", 1800, mode="int")
         opts.logfile = _get_conf(
@@ -144,11 +256,45 @@ class BackendConfigReader(object):
         opts.terminate_vars = _get_conf(cp, "backend", "terminate_vars", None)
 
         opts.prune_days = _get_conf(cp, "backend", "prune_days", None, mode="int")
-        opts.prune_script = _get_conf(cp, "backend", "prune_script", None, mode="path")
+        opts.prune_workers = _get_conf(
+            cp, "backend", "prune_workers", multiprocessing.cpu_count(), mode="int")
+        opts.prune_index = _get_conf(
+            cp, "backend", "prune_index", "/var/lib/copr/prune_index.json", mode="path")
 
         opts.spawn_in_advance = _get_conf(
             cp, "backend", "spawn_in_advance", False, mode="bool")
 
+        opts.pool_check_interval = _get_conf(
+            cp, "backend", "pool_check_interval", 300, mode="int")
+
+        opts.builder_reuse_max_jobs = _get_conf(
+            cp, "backend", "builder_reuse_max_jobs", 1, mode="int")
+        opts.builder_reuse_max_time = _get_conf(
+            cp, "backend", "builder_reuse_max_time", 1800, mode="int")
+
+        opts.createrepo_debounce = _get_conf(
+            cp, "backend", "createrepo_debounce", 5, mode="int")
+        opts.createrepo_workers = _get_conf(
+            cp, "backend", "createrepo_workers", multiprocessing.cpu_count(), mode="int")
+        opts.createrepo_engine = _get_conf(
+            cp, "backend", "createrepo_engine", "subprocess")
+        opts.createrepo_cache_repos = _get_conf(
+            cp, "backend", "createrepo_cache_repos", 50, mode="int")
+        opts.auto_createrepo_cache_ttl = _get_conf(
+            cp, "backend", "auto_createrepo_cache_ttl", 600, mode="int")
+
+        opts.actions_workers = _get_conf(
+            cp, "backend", "actions_workers", 4, mode="int")
+        opts.actions_queue_limit = _get_conf(
+            cp, "backend", "actions_queue_limit", 1000, mode="int")
+        opts.actions_stats_interval = _get_conf(
+            cp, "backend", "actions_stats_interval", 300, mode="int")
+
+        opts.autoscale_drain_time = _get_conf(
+            cp, "backend", "autoscale_drain_time", 3600, mode="int")
+        opts.autoscale_idle_time = _get_conf(
+            cp, "backend", "autoscale_idle_time", 600, mode="int")
+
         # thoughts for later
         # ssh key for connecting to builders?
         # cloud key stuff?
@@ -156,11 +302,52 @@ class BackendConfigReader(object):
         return opts
 
 
-def get_auto_createrepo_status(front_url, username, projectname):
+def get_redis_connection():
+    """ Connection to the redis holding retask queues """
+    return redis.Redis()
+
+
+def auto_createrepo_key(username, projectname):
+    return "copr-be-auto-createrepo-{0}/{1}".format(username, projectname)
+
+
+def get_auto_createrepo_status(front_url, username, projectname, cache_ttl=0):
+    """
+    :param int cache_ttl: [optional] remember the value in redis for `cache_ttl`
+        seconds, shared by all backend processes, 0 disables the cache
+    """
+    rdb = get_redis_connection() if cache_ttl else None
+    key = auto_createrepo_key(username, projectname)
+    if rdb:
+        try:
+            cached = rdb.get(key)
+            if cached is not None:
+                return bool(int(cached))
+        except redis.RedisError:
+            rdb = None
+
     client = CoprClient(copr_url=front_url)
     result = client.get_project_details(projectname, username)
 
     if "auto_createrepo" in result.data["detail"]:
-        return bool(result.data["detail"]["auto_createrepo"])
+        status = bool(result.data["detail"]["auto_createrepo"])
     else:
-        return True
+        status = True
+
+    if rdb:
+        try:
+            rdb.set(key, int(status), ex=cache_ttl)
+        except redis.RedisError:
+            pass
+    return status
+
+
+def invalidate_auto_createrepo_status(rdb, username, projectname):
+    """
+    Drop cached value of `get_auto_createrepo_status`, e.g. when the project
+    was modified
+    """
+    try:
+        rdb.delete(auto_createrepo_key(username, projectname))
+    except redis.RedisError:
+        pass
@@ -0,0 +1,218 @@
+"""
+Per chroot index of package directories in the results tree, so the backend
+doesn't have to stat the (possibly NFS mounted) results storage to find
+out whether and how a package was built.
+
+Each chroot directory holds an append-only log MANIFEST_FILE, one JSON
+record per line:
+
+    {"pkg": "foo-1.0-1.fc22", "state": "success",
+     "rpms": {"foo-1.0-1.fc22.x86_64.rpm": "<sha256>", ...}, "time": ...}
+
+where state is "success", "fail", "deleted" or null (forget what was known
+about the package).  The last record of the package wins.  Packages missing
+in the manifest (built before the manifest existed, being rebuilt) are
+looked up on the filesystem.
+
+The log stays in the chroot directory, so it follows the project when it
+is renamed or deleted.  Its files are not RPMs, so createrepo skips them,
+and conf/lighttpd/access.conf keeps them from being served.
+"""
+
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+MANIFEST_FILE = ".manifest"
+MANIFEST_LOCK_FILE = ".manifest.lock"
+
+# rewrite the log when it has this many superseded records
+COMPACT_SLACK = 200
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    checksum = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class ChrootManifest(object):
+    """
+    Manifest of one chroot directory.  Records appended by other processes
+    are read incrementally, lookups are dict accesses.
+
+    Use `get_manifest` to share instances inside the process.
+    """
+
+    def __init__(self, chroot_path):
+        self.chroot_path = chroot_path
+        self.path = os.path.join(chroot_path, MANIFEST_FILE)
+        self.lock_path = os.path.join(chroot_path, MANIFEST_LOCK_FILE)
+
+        self.entries = {}
+        self.records = 0
+        self._inode = None
+        self._offset = 0
+
+    def _parse(self, data):
+        for line in data.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # interrupted write, following records are fine
+                continue
+            self.records += 1
+            if record.get("state") is None:
+                self.entries.pop(record["pkg"], None)
+            else:
+                self.entries[record["pkg"]] = record
+
+    def refresh(self):
+        """
+        Read records appended since the last refresh, everything when
+        the log was compacted
+
+        :return bool: whether the manifest exists
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.entries, self.records = {}, 0
+            self._inode, self._offset = None, 0
+            return False
+
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            self.entries, self.records = {}, 0
+            self._inode, self._offset = stat.st_ino, 0
+
+        if stat.st_size > self._offset:
+            with open(self.path, "rb") as handle:
+                handle.seek(self._offset)
+                data = handle.read()
+            # keep incomplete last line for the next refresh
+            complete = data.rfind(b"\n") + 1
+            self._parse(data[:complete].decode("utf-8"))
+            self._offset += complete
+        return True
+
+    def get(self, pkg):
+        """
+        :return dict: last record of the package, None when not known
+        """
+        self.refresh()
+        return self.entries.get(pkg)
+
+    def _append(self, records):
+        if not os.path.isdir(self.chroot_path):
+            return
+        data = "".join(json.dumps(record) + "\n" for record in records)
+        with open(self.lock_path, "a") as lock_handle:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX)
+            with open(self.path, "a") as handle:
+                handle.write(data)
+            self.refresh()
+            if self.records - len(self.entries) > COMPACT_SLACK:
+                self._compact()
+
+    def _compact(self):
+        """ Rewrite the log with the last record of each package, lock held """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as handle:
+            for record in self.entries.values():
+                handle.write(json.dumps(record) + "\n")
+        os.rename(tmp_path, self.path)
+        self.refresh()
+
+    def record(self, pkg, state, rpms=None):
+        self._append([{"pkg": pkg, "state": state, "rpms": rpms or {},
+                       "time": time.time()}])
+
+    def record_dir(self, pkg):
+        """
+        Record state and RPMs (with checksums) of the downloaded package directory
+        """
+        pkg_path = os.path.join(self.chroot_path, pkg)
+        try:
+            files = os.listdir(pkg_path)
+        except OSError:
+            self.record(pkg, "deleted")
+            return
+
+        if "success" in files:
+            state = "success"
+        elif "fail" in files:
+            state = "fail"
+        else:
+            self.forget(pkg)
+            return
+
+        rpms = dict((name, file_checksum(os.path.join(pkg_path, name)))
+                    for name in files if name.endswith(".rpm"))
+        self.record(pkg, state, rpms)
+
+    def record_deleted(self, pkgs):
+        now = time.time()
+        self._append([{"pkg": pkg, "state": "deleted", "rpms": {}, "time": now}
+                      for pkg in pkgs])
+
+    def forget(self, pkg):
+        """ Package directory is going to change, look it up on filesystem """
+        self.record(pkg, None)
+
+
+# manifests of the last MAX_CACHED_MANIFESTS chroots, long running processes
+# would keep every chroot they ever touched otherwise
+MAX_CACHED_MANIFESTS = 64
+_manifests = OrderedDict()
+
+
+def get_manifest(chroot_path):
+    chroot_path = os.path.normpath(chroot_path)
+    manifest = _manifests.pop(chroot_path, None)
+    if manifest is None:
+        manifest = ChrootManifest(chroot_path)
+    _manifests[chroot_path] = manifest
+    while len(_manifests) > MAX_CACHED_MANIFESTS:
+        _manifests.popitem(last=False)
+    return manifest
+
+
+def lookup_package(chroot_path, pkg):
+    """
+    State of the package directory in the chroot, from the manifest or
+    from the filesystem when the manifest doesn't know the package
+
+    :return dict: exists (bool), state ("success", "fail" or None)
+        and rpms (list of RPM file names)
+    """
+    entry = get_manifest(chroot_path).get(pkg)
+    if entry is not None:
+        exists = entry["state"] != "deleted"
+        return {"exists": exists,
+                "state": entry["state"] if exists else None,
+                "rpms": sorted(entry["rpms"])}
+
+    pkg_path = os.path.join(chroot_path, pkg)
+    try:
+        files = os.listdir(pkg_path)
+    except OSError:
+        return {"exists": False, "state": None, "rpms": []}
+
+    state = None
+    if "success" in files:
+        state = "success"
+    elif "fail" in files:
+        state = "fail"
+    return {"exists": True, "state": state,
+            "rpms": sorted(name for name in files if name.endswith(".rpm"))}
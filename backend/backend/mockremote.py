@@ -30,9 +30,11 @@ from __future__ import division
 from __future__ import absolute_import
 
 import sys
+import json
 import time
 import fcntl
 import pipes
+import hashlib
 import socket
 import urllib
 import subprocess
@@ -40,18 +42,32 @@ import os
 
 import ansible.runner
 
-from .helpers import SortedOptParser
-from .exceptions import MockRemoteError, BuilderError
-from .sign import sign_rpms_in_dir, get_pubkey
+from .helpers import SortedOptParser, DEF_POLL_MAX_INTERVAL
+from .exceptions import MockRemoteError, BuilderError, CoprSignNoKeyError
+from .sign import sign_rpms_in_dir, get_pubkey, request_user_keys
+from .manifest import get_manifest, lookup_package
+from .sshcontrol import ssh_command
+from . import builder_probe
 
 
 # where we should execute mockchain from on the remote
 mockchain = "/usr/bin/mockchain"
 # rsync path
 rsync = "/usr/bin/rsync"
+# python running the builder probe on the remote
+remote_python = "/usr/bin/python"
+
+# builder probe script copied to the builders
+PROBE_SOURCE = os.path.splitext(builder_probe.__file__)[0] + ".py"
+# exit code of the probe command when the probe is not on the builder
+PROBE_MISSING_RC = 199
+# (hostname, username, remote path) of the probes already copied to builders
+_deployed_probes = set()
 
 DEF_REMOTE_BASEDIR = "/var/tmp"
 DEF_TIMEOUT = 3600
+# seconds before the first wait between build status polls
+DEF_POLL_FIRST_INTERVAL = 1
 DEF_REPOS = []
 DEF_CHROOT = None
 DEF_USER = "mockbuilder"
@@ -62,6 +78,19 @@ DEF_BUILDROOT_PKGS = ""
 from .createrepo import createrepo
 
 
+def poll_intervals(first=DEF_POLL_FIRST_INTERVAL,
+                   maximum=DEF_POLL_MAX_INTERVAL, factor=2):
+    """
+    Waits between polls of a running command: short at first, so short
+    builds are noticed soon after they finish, then exponentially
+    longer up to `maximum` seconds
+    """
+    interval = first
+    while True:
+        yield min(interval, maximum)
+        interval *= factor
+
+
 def read_list_from_file(fn):
     lst = []
     f = open(fn, "r")
@@ -252,24 +281,23 @@ class Builder(object):
         if self._tempdir:
             return self._tempdir
 
-        cmd = "/bin/mktemp -d {0}/{1}-XXXXX".format(
-            self.mockremote.remote_basedir, "mockremote")
+        cmd = "tempdir=$(/bin/mktemp -d {0}/{1}-XXXXX) && " \
+              "/bin/chmod 755 $tempdir && echo $tempdir".format(
+                  self.mockremote.remote_basedir, "mockremote")
 
         self.conn.module_name = "shell"
         self.conn.module_args = str(cmd)
         results = self.conn.run()
         tempdir = None
         for _, resdict in results["contacted"].items():
-            tempdir = resdict["stdout"]
+            if resdict.get("rc") == 0:
+                tempdir = resdict["stdout"]
 
         # if still nothing then we"ve broken
         if not tempdir:
             raise BuilderError("Could not make tmpdir on {0}".format(
                 self.hostname))
 
-        cmd = "/bin/chmod 755 {0}".format(tempdir)
-        self.conn.module_args = str(cmd)
-        self.conn.run()
         self._tempdir = tempdir
 
         return self._tempdir
@@ -291,6 +319,61 @@ class Builder(object):
 
         return remote_pkg_dir
 
+    @property
+    def probe_path(self):
+        """ Path of the builder probe on the builder, changes with its content """
+        with open(PROBE_SOURCE, "rb") as handle:
+            digest = hashlib.sha1(handle.read()).hexdigest()[:12]
+        return os.path.join(self.mockremote.remote_basedir,
+                            "copr-builder-probe-{0}.py".format(digest))
+
+    def _deploy_probe(self, remote_path):
+        self.conn.module_name = "copy"
+        self.conn.module_args = "src={0} dest={1} mode=0755".format(
+            PROBE_SOURCE, remote_path)
+        results = self.conn.run()
+        is_err, err_results = check_for_ans_error(
+            results, self.hostname, success_codes=[0])
+        if is_err:
+            raise BuilderError("Failed to copy builder probe to {0}: {1}"
+                               .format(self.hostname, err_results))
+        _deployed_probes.add((self.hostname, self.username, remote_path))
+
+    def probe(self, *args):
+        """
+        Runs the builder probe, copies it to the builder first if needed
+
+        :return dict: facts printed by the probe
+        :raises BuilderError: probe failed or its output is not valid
+        """
+        remote_path = self.probe_path
+        if (self.hostname, self.username, remote_path) not in _deployed_probes:
+            self._deploy_probe(remote_path)
+
+        cmd = "/usr/bin/test -f {0} || exit {1}; {2} {0} {3}".format(
+            remote_path, PROBE_MISSING_RC, remote_python,
+            " ".join(pipes.quote(arg) for arg in args))
+        for _ in range(2):
+            self.conn.module_name = "shell"
+            self.conn.module_args = cmd
+            results = self.conn.run()
+            myresults = get_ans_results(results, self.hostname)
+            if myresults.get("rc") != PROBE_MISSING_RC:
+                break
+            # builder was cleaned up
+            self._deploy_probe(remote_path)
+
+        is_err, err_results = check_for_ans_error(
+            results, self.hostname, success_codes=[0])
+        if is_err:
+            raise BuilderError("Builder probe failed on {0}: {1}"
+                               .format(self.hostname, err_results))
+        try:
+            return json.loads(myresults["stdout"])
+        except (KeyError, ValueError) as e:
+            raise BuilderError("Invalid output of builder probe on {0}: {1}"
+                               .format(self.hostname, e))
+
     def modify_base_buildroot(self):
         """
         Modify mock config for current chroot.
@@ -328,6 +411,27 @@ class Builder(object):
             myresults = get_ans_results(results, self.hostname)
             self.mockremote.callback.log("{0}".format(myresults))
 
+    def wait_for_async(self, poller):
+        """
+        Polls the asynchronous command until it finishes or self.timeout
+        expires, see :py:func:`poll_intervals`
+
+        :return dict: ansible results, None on timeout
+        """
+        deadline = time.time() + self.timeout
+        intervals = poll_intervals(maximum=self.mockremote.poll_max_interval)
+        while True:
+            results = poller.poll()
+
+            if results["contacted"] or results["dark"]:
+                return results
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+
+            time.sleep(min(next(intervals), remaining))
+
     def build(self, pkg):
 
         # build the pkg passed in
@@ -358,14 +462,6 @@ class Builder(object):
         else:
             dest = pkg
 
-        # srpm version
-        self.conn.module_name = "shell"
-        self.conn.module_args = "rpm -qp --qf \"%{VERSION}\n\" {}".format(pkg)
-        self.mockremote.callback.log("Getting package information: version")
-        results = self.conn.run()
-        if "contacted" in results:
-            build_details["pkg_version"] = results["contacted"].itervalues().next()[u"stdout"]
-
         # construct the mockchain command
         buildcmd = "{0} -r {1} -l {2} ".format(
             mockchain, pipes.quote(self.chroot),
@@ -391,24 +487,27 @@ class Builder(object):
 
         _, poller = self.conn.run_async(self.timeout)
 
-        waited = 0
-        while True:
-            results = poller.poll()
-
-            if results["contacted"] or results["dark"]:
-                break
-
-            if waited >= self.timeout:
-                self.mockremote.callback.log("Build timeout expired.")
-                return False, "", "Timeout expired", build_details
-
-            time.sleep(10)
-            waited += 10
+        results = self.wait_for_async(poller)
+        if results is None:
+            self.mockremote.callback.log("Build timeout expired.")
+            return False, "", "Timeout expired", build_details
 
         is_err, err_results = check_for_ans_error(
             results, self.hostname, success_codes=[0],
             return_on_error=["stdout", "stderr"])
 
+        # srpm version, success and built packages in one round trip
+        facts = {}
+        if self.hostname not in results["dark"]:
+            self.mockremote.callback.log("Getting build results")
+            try:
+                facts = self.probe("post-build", dest,
+                                   self._get_remote_pkg_dir(pkg))
+            except BuilderError as e:
+                self.mockremote.callback.error(str(e))
+        if facts.get("pkg_version"):
+            build_details["pkg_version"] = facts["pkg_version"]
+
         if is_err:
             return (success, err_results.get("stdout", ""),
                     err_results.get("stderr", ""), build_details)
@@ -419,27 +518,9 @@ class Builder(object):
         out = myresults.get("stdout", "")
         err = myresults.get("stderr", "")
 
-        successfile = os.path.join(self._get_remote_pkg_dir(pkg), "success")
-        testcmd = "/usr/bin/test -f {0}".format(successfile)
-        self.conn.module_name = "shell"
-        self.conn.module_args = testcmd
-        results = self.conn.run()
-        is_err, err_results = check_for_ans_error(
-            results, self.hostname, success_codes=[0])
-
-        if not is_err:
+        if facts.get("success"):
             success = True
-
-            self.mockremote.callback.log("Listing built binary packages")
-            self.conn.module_name = "shell"
-            self.conn.module_args = (
-                "cd {0} && "
-                "for f in `ls *.rpm |grep -v \"src.rpm$\"`; do"
-                "   rpm -qp --qf \"%{{NAME}} %{{VERSION}}\n\" $f; "
-                "done").format(pipes.quote(self._get_remote_pkg_dir(pkg)))
-
-            results = self.conn.run()
-            build_details["built_packages"] = results["contacted"].itervalues().next()[u"stdout"]
+            build_details["built_packages"] = facts["built_packages"]
             self.mockremote.callback.log("Packages:\n{}".format(build_details["built_packages"]))
 
         return success, out, err, build_details
@@ -454,7 +535,11 @@ class Builder(object):
         destdir = "'" + destdir.replace("'", "'\\''") + "'"
         # build rsync command line from the above
         remote_src = "{0}@{1}:{2}".format(self.username, self.hostname, rpd)
-        ssh_opts = "'ssh -o PasswordAuthentication=no -o StrictHostKeyChecking=no'"
+        if self.mockremote.ssh_control_dir and self.mockremote.ssh_control_persist:
+            ssh_opts = pipes.quote(ssh_command(self.mockremote.ssh_control_dir,
+                                               self.mockremote.ssh_control_persist))
+        else:
+            ssh_opts = "'ssh -o PasswordAuthentication=no -o StrictHostKeyChecking=no'"
         command = "{0} -avH -e {1} {2} {3}/".format(
             rsync, ssh_opts, remote_src, destdir)
 
@@ -542,7 +627,10 @@ class MockRemote(object):
                  cont=False, recurse=False, repos=None, callback=None,
                  remote_basedir=DEF_REMOTE_BASEDIR, remote_tempdir=None,
                  macros=None, lock=None, do_sign=False,
-                 front_url=None, results_base_url=None):
+                 front_url=None, results_base_url=None, createrepo_coalesce=False,
+                 auto_createrepo_cache_ttl=0, sign_workers=1, sign_rate_limit=0,
+                 sign_batch_size=1, ssh_control_dir=None, ssh_control_persist=0,
+                 poll_max_interval=DEF_POLL_MAX_INTERVAL):
 
         """
 
@@ -575,6 +663,16 @@ class MockRemote(object):
             signer host and correct /etc/sign.conf
 
         :param str front_url: url to the copr frontend
+        :param bool createrepo_coalesce: run createrepo through CreaterepoService
+        :param int auto_createrepo_cache_ttl: cache project auto_createrepo setting
+        :param int sign_workers: number of rpms signed at once
+        :param int sign_rate_limit: sign requests per second allowed to the signer
+        :param int sign_batch_size: maximum of rpms signed by one sign call
+        :param str ssh_control_dir: directory with shared ssh connections
+        :param int ssh_control_persist: seconds to keep the shared ssh
+            connection, 0 disables the sharing
+        :param int poll_max_interval: longest wait between polls of
+            the running build
 
         """
 
@@ -596,6 +694,14 @@ class MockRemote(object):
         self.do_sign = do_sign
         self.front_url = front_url
         self.results_base_url = results_base_url or u''
+        self.createrepo_coalesce = createrepo_coalesce
+        self.auto_createrepo_cache_ttl = auto_createrepo_cache_ttl
+        self.sign_workers = sign_workers
+        self.sign_rate_limit = sign_rate_limit
+        self.sign_batch_size = sign_batch_size
+        self.ssh_control_dir = ssh_control_dir
+        self.ssh_control_persist = ssh_control_persist
+        self.poll_max_interval = poll_max_interval
 
         if not self.callback:
             self.callback = DefaultCallBack()
@@ -645,6 +751,28 @@ class MockRemote(object):
                 "failed to retrieve pubkey for user {} project {} due to: \n"
                 "{}".format(user, project, e))
 
+    def request_sign_keys(self):
+        """
+            Asks copr-keygen to generate the project key-pair while
+            the packages are being built, signing then doesn't wait for it
+        """
+        user = self.job.project_owner
+        project = self.job.project_name
+        try:
+            get_pubkey(user, project)
+        except CoprSignNoKeyError:
+            try:
+                request_user_keys(user, project)
+                self.callback.log("Requested key-pair for user {} project {}"
+                                  .format(user, project))
+            except Exception as e:
+                # signing tries again
+                self.callback.log("failed to request key-pair for user {} "
+                                  "project {}: {}".format(user, project, e))
+        except Exception as e:
+            self.callback.log("failed to check pubkey for user {} project {}: "
+                              "{}".format(user, project, e))
+
     def sign_built_packages(self, chroot_dir, pkg):
         """
             Sign built rpms
@@ -664,7 +792,10 @@ class MockRemote(object):
             sign_rpms_in_dir(self.job.project_owner,
                              self.job.project_name,
                              get_target_dir(chroot_dir, pkg),
-                             callback=self.callback)
+                             callback=self.callback,
+                             workers=self.sign_workers,
+                             rate_limit=self.sign_rate_limit,
+                             batch_size=self.sign_batch_size)
         except Exception as e:
             self.callback.log(
                 "failed to sign packages "
@@ -704,6 +835,8 @@ class MockRemote(object):
             username=self.job.project_owner,
             projectname=self.job.project_name,
             lock=self.lock,
+            coalesce=self.createrepo_coalesce,
+            cache_ttl=self.auto_createrepo_cache_ttl,
         )
         if err.strip():
             self.callback.error(
@@ -723,6 +856,9 @@ class MockRemote(object):
 
         build_details = {}
 
+        if self.do_sign:
+            self.request_sign_keys()
+
         try_again = True
         to_be_built = pkgs
         while try_again:
@@ -738,10 +874,16 @@ class MockRemote(object):
                     just_built.append(pkg)
 
                 p_path = self._get_pkg_destpath(pkg)
+                manifest = get_manifest(os.path.dirname(p_path))
+                pdn = os.path.basename(p_path)
 
                 # if it's marked as fail, nuke the failure and try to rebuild it
-                if os.path.exists(os.path.join(p_path, "fail")):
-                    os.unlink(os.path.join(p_path, "fail"))
+                if lookup_package(manifest.chroot_path, pdn)["state"] == "fail":
+                    try:
+                        os.unlink(os.path.join(p_path, "fail"))
+                    except OSError:
+                        pass
+                manifest.forget(pdn)
 
                 # off to the builder object
                 # building
@@ -786,6 +928,7 @@ class MockRemote(object):
 
                 # checking where to stick stuff
                 if not b_status:
+                    manifest.record_dir(pdn)
                     if self.recurse:
                         self.failed.append(pkg)
                         self.callback.error(
@@ -806,6 +949,7 @@ class MockRemote(object):
                     if self.do_sign:
                         self.sign_built_packages(chroot_dir, pkg)
 
+                    manifest.record_dir(pdn)
                     built_pkgs.append(pkg)
                     # createrepo with the new pkgs
                     self.do_createrepo(chroot_dir, )
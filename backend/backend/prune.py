@@ -0,0 +1,295 @@
+"""
+Removal of old builds from the results directory, a python replacement
+of the copr_prune_old_builds.sh script.
+
+Per chroot of a project:
+  - failed builds older than `prune_days` are removed,
+  - successful builds older than `prune_days` are removed unless they
+    provide the latest version of some package in the repository,
+  - chroot without repodata (and without devel repo) is removed altogether.
+
+Createrepo runs only for chroots where something was removed.
+"""
+
+from __future__ import absolute_import
+
+import os
+import re
+import gzip
+import json
+import time
+import logging
+from xml.etree import cElementTree as ElementTree
+
+try:
+    import rpm
+except ImportError:
+    rpm = None
+
+from .createrepo import createrepo_unsafe
+from .manifest import get_manifest
+from .trash import move_to_trash
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+DEF_DAYS = 14
+# days after which settings of a project skipped for disabled auto_createrepo
+# are checked again
+SETTINGS_RECHECK_DAYS = 7
+
+REPO_NS = "{http://linux.duke.edu/metadata/repo}"
+COMMON_NS = "{http://linux.duke.edu/metadata/common}"
+
+
+def _vercmp_segments(first, second):
+    """ rpmvercmp() from librpm, used when rpm bindings are not installed """
+    if first == second:
+        return 0
+
+    segment_re = re.compile(r"([0-9]+|[a-zA-Z]+|~|\^)")
+    first_segs = segment_re.findall(first)
+    second_segs = segment_re.findall(second)
+
+    while first_segs or second_segs:
+        one = first_segs.pop(0) if first_segs else None
+        two = second_segs.pop(0) if second_segs else None
+
+        # tilde sorts before everything, even the end of version
+        if one == "~" or two == "~":
+            if one != two:
+                return -1 if one == "~" else 1
+            continue
+        # caret sorts after the end of version but before anything else
+        if one == "^" or two == "^":
+            if one is None:
+                return -1
+            if two is None:
+                return 1
+            if one != two:
+                return -1 if one == "^" else 1
+            continue
+
+        if one is None:
+            return -1
+        if two is None:
+            return 1
+
+        one_digit, two_digit = one.isdigit(), two.isdigit()
+        if one_digit != two_digit:
+            # numeric segment is newer than alpha
+            return 1 if one_digit else -1
+        if one_digit:
+            one, two = int(one), int(two)
+        if one != two:
+            return 1 if one > two else -1
+
+    return 0
+
+
+def label_compare(evr1, evr2):
+    """
+    Compare (epoch, version, release) tuples like rpm.labelCompare
+
+    :return int: -1, 0 or 1
+    """
+    if rpm is not None:
+        return rpm.labelCompare(evr1, evr2)
+
+    for one, two in zip(evr1, evr2):
+        result = _vercmp_segments(one or "0", two or "0")
+        if result:
+            return result
+    return 0
+
+
+def read_primary(chroot_path):
+    """
+    Packages listed in the repository metadata
+
+    :return list: of dicts with name, arch, evr and location keys,
+        None when there is no repodata
+    """
+    repomd_path = os.path.join(chroot_path, "repodata", "repomd.xml")
+    if not os.path.exists(repomd_path):
+        return None
+
+    primary_href = None
+    for data in ElementTree.parse(repomd_path).getroot().iter(REPO_NS + "data"):
+        if data.get("type") == "primary":
+            primary_href = data.find(REPO_NS + "location").get("href")
+    if primary_href is None:
+        return None
+
+    primary_path = os.path.join(chroot_path, primary_href)
+    opener = gzip.open if primary_path.endswith(".gz") else open
+    packages = []
+    with opener(primary_path, "rb") as handle:
+        for _, elem in ElementTree.iterparse(handle):
+            if elem.tag != COMMON_NS + "package":
+                continue
+            version = elem.find(COMMON_NS + "version")
+            packages.append({
+                "name": elem.findtext(COMMON_NS + "name"),
+                "arch": elem.findtext(COMMON_NS + "arch"),
+                "evr": (version.get("epoch"), version.get("ver"), version.get("rel")),
+                "location": elem.find(COMMON_NS + "location").get("href"),
+            })
+            elem.clear()
+    return packages
+
+
+def latest_packages(packages):
+    """
+    File names of the latest version of every name.arch, the same set
+    `repoquery -a` lists
+
+    :return set:
+    """
+    latest = {}
+    for pkg in packages:
+        key = (pkg["name"], pkg["arch"])
+        if key not in latest or label_compare(pkg["evr"], latest[key]["evr"]) > 0:
+            latest[key] = pkg
+    return set(os.path.basename(pkg["location"]) for pkg in latest.values())
+
+
+def _older_than(path, cutoff):
+    try:
+        return os.path.getmtime(path) < cutoff
+    except OSError:
+        return False
+
+
+def list_builds(chroot_path):
+    return [os.path.join(chroot_path, name) for name in sorted(os.listdir(chroot_path))
+            if name != "repodata" and not name.startswith(".") and
+            os.path.isdir(os.path.join(chroot_path, name))]
+
+
+def prune_chroot(chroot_path, cutoff, trash_dir=None):
+    """
+    Remove old builds from the chroot directory
+
+    :param float cutoff: builds finished before this time are pruned
+    :param str trash_dir: move removed directories there, see `move_to_trash`
+    :return list: removed paths
+    """
+    removed = []
+    for build_path in list_builds(chroot_path):
+        if _older_than(os.path.join(build_path, "fail"), cutoff):
+            move_to_trash(trash_dir, build_path)
+            removed.append(build_path)
+
+    packages = read_primary(chroot_path)
+    if packages is None:
+        # broken or never created repository, keep it while it can still
+        # receive its first build
+        if not os.path.exists(os.path.join(chroot_path, "devel")) and \
+                _older_than(chroot_path, cutoff):
+            move_to_trash(trash_dir, chroot_path)
+            return removed + [chroot_path]
+    else:
+        latest = latest_packages(packages)
+        for build_path in list_builds(chroot_path):
+            if not _older_than(os.path.join(build_path, "success"), cutoff):
+                continue
+            if latest.intersection(os.listdir(build_path)):
+                continue
+            move_to_trash(trash_dir, build_path)
+            removed.append(build_path)
+
+    if removed:
+        get_manifest(chroot_path).record_deleted(
+            [os.path.basename(path) for path in removed])
+    return removed
+
+
+def newest_build_time(project_path):
+    """
+    Time of the last change in the project chroots.  Chroot directory mtime
+    changes with every added or removed build (and log or repodata), so
+    there is no need to look into builds.
+    """
+    newest = 0
+    for name in os.listdir(project_path):
+        path = os.path.join(project_path, name)
+        if os.path.isdir(path):
+            newest = max(newest, os.path.getmtime(path))
+    return newest
+
+
+class PruneIndex(object):
+    """
+    Remembers when each project was pruned and the newest build it had then,
+    stored as JSON in `path`.
+
+    Project whose newest build was already older than `prune_days` when it was
+    last pruned and which got no build since then has nothing left to prune.
+    Project skipped because of disabled auto_createrepo is not asked about
+    its settings again for SETTINGS_RECHECK_DAYS, unless it got a build.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.projects = {}
+
+    def load(self):
+        try:
+            with open(self.path) as handle:
+                self.projects = json.load(handle)
+        except (IOError, ValueError) as error:
+            log.info("Prune index {0} not loaded: {1}".format(self.path, error))
+            self.projects = {}
+        return self
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as handle:
+                json.dump(self.projects, handle)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as error:
+            log.error("Failed to save prune index {0}: {1}".format(self.path, error))
+
+    def update(self, project, pruned_on, newest, auto_createrepo=True):
+        """
+        :param float pruned_on: when the project was pruned, or its settings
+            checked when it was skipped
+        :param bool auto_createrepo: project setting checked before pruning
+        """
+        self.projects[project] = {"pruned_on": pruned_on, "newest": newest,
+                                  "auto_createrepo": auto_createrepo}
+
+    def is_untouched(self, project, newest, days):
+        entry = self.projects.get(project)
+        if not entry or entry["newest"] != newest:
+            return False
+        if not entry.get("auto_createrepo", True):
+            return time.time() - entry["pruned_on"] < SETTINGS_RECHECK_DAYS * 24 * 3600
+        return newest + days * 24 * 3600 < entry["pruned_on"]
+
+
+def prune_project(project_path, days, coalesce=False, trash_dir=None):
+    """
+    Prune all chroots of the project and regenerate repodata of the altered ones
+
+    :return tuple: (removed paths, list of createrepo errors)
+    """
+    cutoff = time.time() - days * 24 * 3600
+    removed, errors = [], []
+    for name in sorted(os.listdir(project_path)):
+        chroot_path = os.path.join(project_path, name)
+        if not os.path.isdir(chroot_path):
+            continue
+
+        chroot_removed = prune_chroot(chroot_path, cutoff, trash_dir)
+        removed.extend(chroot_removed)
+        if not chroot_removed or chroot_path in chroot_removed:
+            continue
+
+        retcode, _, stderr = createrepo_unsafe(chroot_path, coalesce=coalesce)
+        if retcode != 0:
+            errors.append("{0}: {1}".format(chroot_path, stderr))
+
+    return removed, errors
@@ -0,0 +1,226 @@
+from __future__ import division
+
+import time
+from collections import deque, defaultdict
+
+
+def scheduled_key(group_id):
+    """
+    Redis key with number of tasks held by the scheduler of the group
+    """
+    return "copr-be-{0}-scheduled".format(group_id)
+
+
+def parse_owner_weights(value):
+    """
+    Parse "owner:weight,owner:weight" config value into dict
+    """
+    weights = {}
+    if not value:
+        return weights
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        owner, weight = item.rsplit(":", 1)
+        weights[owner.strip()] = float(weight)
+    return weights
+
+
+# priority class of the tasks of owners with a large backlog
+BULK_PRIORITY = 1
+
+
+def default_priority(task):
+    """
+    Priority class of the task, lower goes first.
+    Frontend may send "priority" within the task, default class is 0.
+    """
+    return task.get("priority") or 0
+
+
+class FairShareScheduler(object):
+    """
+    Orders build tasks of one build group between the job grabber and
+    the workers.
+
+    Tasks are picked by priority class first (lower class first), inside the
+    class by weighted fair queueing across owners and then across projects
+    of the owner, inside the project in the order they were added.
+    Every owner has a virtual time which grows by 1/weight with each
+    dispatched task, the owner with the lowest virtual time goes next.
+    Owners which reached their concurrency limit are skipped until some of
+    their tasks finish.
+
+    Tasks added while their owner already has `bulk_threshold` tasks
+    waiting get at least BULK_PRIORITY class, so small submitters go
+    before the rest of a large backlog.
+
+    Projects without waiting tasks and owners without waiting and running
+    tasks are forgotten.
+
+    :param dict owner_weights: owner -> weight, missing owners use `default_weight`
+    :param int owner_limit: max dispatched and unfinished tasks per owner,
+        0 means unlimited
+    :param int bulk_threshold: waiting tasks of one owner after which its
+        next tasks are bulk, 0 disables it
+    :param callable priority_fn: task -> priority class
+    """
+
+    def __init__(self, owner_weights=None, default_weight=1.0, owner_limit=0,
+                 bulk_threshold=0, priority_fn=default_priority):
+        self.owner_weights = owner_weights or {}
+        self.default_weight = default_weight
+        self.owner_limit = owner_limit
+        self.bulk_threshold = bulk_threshold
+        self.priority_fn = priority_fn
+
+        # priority -> owner -> project -> deque of tasks
+        self.pending = {}
+        self.owner_vtime = defaultdict(float)
+        self.project_vtime = defaultdict(float)
+        # owner -> virtual time of the last dispatched project of the owner
+        self.project_vclock = defaultdict(float)
+        # virtual time of the last dispatched task
+        self.vclock = 0.0
+        self.running_by_owner = defaultdict(int)
+        self.pending_by_owner = defaultdict(int)
+        self.pending_by_project = defaultdict(int)
+        # task_id -> (owner, dispatched_on)
+        self.running = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def weight(self, owner):
+        return self.owner_weights.get(owner, self.default_weight)
+
+    def priority(self, task):
+        priority = self.priority_fn(task)
+        if self.bulk_threshold and \
+                self.pending_by_owner.get(task["project_owner"], 0) >= self.bulk_threshold:
+            priority = max(priority, BULK_PRIORITY)
+        return priority
+
+    def add(self, task):
+        """
+        :param dict task: task as received from the frontend
+        """
+        owner = task["project_owner"]
+        project = (owner, task["project_name"])
+        priority = self.priority(task)
+
+        owners = self.pending.setdefault(priority, {})
+        if not self.has_pending(owner):
+            # owner returning after a while must not get credit for the time
+            # it had nothing to build
+            self.owner_vtime[owner] = max(self.owner_vtime[owner], self.vclock)
+
+        projects = owners.setdefault(owner, {})
+        if not self.pending_by_project.get(project):
+            self.project_vtime[project] = max(self.project_vtime[project],
+                                              self.project_vclock[owner])
+        projects.setdefault(project, deque()).append(task)
+        self.pending_by_owner[owner] += 1
+        self.pending_by_project[project] += 1
+        self.size += 1
+
+    def has_pending(self, owner):
+        return bool(self.pending_by_owner.get(owner))
+
+    def _forget_project(self, project):
+        """
+        Drop the state of `project` without waiting tasks, it starts from
+        the virtual time of its owner when it returns
+        """
+        if not self.pending_by_project.get(project):
+            self.pending_by_project.pop(project, None)
+            self.project_vtime.pop(project, None)
+
+    def _forget_owner(self, owner):
+        """
+        Drop the state of `owner` without waiting and running tasks, it
+        starts from the current virtual time when it returns
+        """
+        if self.pending_by_owner.get(owner) or self.running_by_owner.get(owner):
+            return
+        self.pending_by_owner.pop(owner, None)
+        self.owner_vtime.pop(owner, None)
+        self.project_vclock.pop(owner, None)
+
+    def can_run(self, owner):
+        return not self.owner_limit or \
+            self.running_by_owner.get(owner, 0) < self.owner_limit
+
+    def pop(self):
+        """
+        Take the next task to be built
+
+        :return dict: task or None when nothing can be dispatched now
+        """
+        for priority in sorted(self.pending):
+            owners = self.pending[priority]
+            eligible = [owner for owner in owners if self.can_run(owner)]
+            if not eligible:
+                continue
+
+            owner = min(eligible, key=lambda o: (self.owner_vtime[o], o))
+            projects = owners[owner]
+            project = min(projects, key=lambda p: (self.project_vtime[p], p))
+            tasks = projects[project]
+            task = tasks.popleft()
+
+            if not tasks:
+                del projects[project]
+            if not projects:
+                del owners[owner]
+            if not owners:
+                del self.pending[priority]
+
+            self.vclock = self.owner_vtime[owner]
+            self.project_vclock[owner] = self.project_vtime[project]
+            self.owner_vtime[owner] += 1.0 / self.weight(owner)
+            self.project_vtime[project] += 1.0
+            self.pending_by_owner[owner] -= 1
+            self.pending_by_project[project] -= 1
+            self.size -= 1
+            self.task_started(task)
+            self._forget_project(project)
+            return task
+
+        return None
+
+    def task_ids(self):
+        """
+        :return set: ids of waiting and dispatched unfinished tasks
+        """
+        ids = set(self.running)
+        for owners in self.pending.values():
+            for projects in owners.values():
+                for tasks in projects.values():
+                    ids.update(task["task_id"] for task in tasks)
+        return ids
+
+    def task_started(self, task):
+        self.running[task["task_id"]] = (task["project_owner"], time.time())
+        self.running_by_owner[task["project_owner"]] += 1
+
+    def task_finished(self, task_id):
+        if task_id not in self.running:
+            return
+        owner, _ = self.running.pop(task_id)
+        self.running_by_owner[owner] -= 1
+        if not self.running_by_owner[owner]:
+            del self.running_by_owner[owner]
+            self._forget_owner(owner)
+
+    def expire_running(self, max_age):
+        """
+        Forget dispatched tasks older than `max_age` seconds, in case
+        the worker died without reporting them finished
+        """
+        limit = time.time() - max_age
+        for task_id, (_, dispatched_on) in list(self.running.items()):
+            if dispatched_on < limit:
+                self.task_finished(task_id)
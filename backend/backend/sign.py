@@ -6,22 +6,54 @@ Wrapper for /bin/sign from obs-sign package
 """
 
 from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
 import json
+import math
+import time
+import base64
+import hashlib
+import struct
 
 import os
+import redis
 from requests import request
 
 from .exceptions import CoprSignError, CoprSignNoKeyError, \
     CoprKeygenRequestError, \
     MockRemoteError
+from .manifest import lookup_package
+from .helpers import get_redis_connection
 
 
 SIGN_BINARY = "/bin/sign"
+# /bin/sign is run through sudo, benchmarks replace it by a stub
+SIGN_CMD_PREFIX = ["sudo"]
+# obs-sign configuration with the signer host
+SIGN_CONF = "/etc/sign.conf"
 DOMAIN = "fedorahosted.org"
 
+# counter of sign requests sent to the signer host in one second
+SIGN_RATE_KEY = "copr-be-sign-rate-{0}-{1}"
+# redis hash: gpg email -> json with fingerprint, armored public key
+# and the time it was cached
+PUBKEY_CACHE_KEY = "copr-be-pubkeys"
+# seconds after which the cached public key is asked for again, in case
+# it was replaced on the signer
+PUBKEY_CACHE_TTL = 24 * 3600
+
+# rpm lead is followed by the signature header starting with this magic
+RPM_LEAD_SIZE = 96
+RPM_HEADER_MAGIC = b"\x8e\xad\xe8\x01"
+# signature header tags of gpg signatures: DSA and RSA header, PGP and GPG
+RPM_GPG_SIGNATURE_TAGS = frozenset([267, 268, 1002, 1005])
+
 # TODO: discover from config
 # COPR_KEYGEN_URL = "http://127.0.0.1:3872/gen_key"
 COPR_KEYGEN_URL = "http://209.132.184.124/gen_key"
+# seconds between polls of the asynchronous key generation job
+KEYGEN_POLL_INTERVAL = 5
+# seconds to wait for the key generation job
+KEYGEN_TIMEOUT = 600
 
 
 def create_gpg_email(username, projectname):
@@ -31,17 +63,119 @@ def create_gpg_email(username, projectname):
     return "{}_{}@copr.{}".format(username, projectname, DOMAIN)
 
 
+def pubkey_fingerprint(armored):
+    """
+    Fingerprint of the first (primary) key in the armored OpenPGP public key,
+    SHA1 over the v4 public key packet as defined by RFC 4880, section 12.2
+
+    :return str: upper case hex fingerprint, None when it can't be parsed
+    """
+    lines = armored.strip().splitlines()
+    try:
+        start = lines.index("") + 1
+        body = [line for line in lines[start:]
+                if not line.startswith(("=", "-----"))]
+        data = bytearray(base64.b64decode("".join(body)))
+
+        tag = data[0]
+        if tag & 0x40:
+            # new packet format
+            if data[1] < 192:
+                length, offset = data[1], 2
+            elif data[1] < 224:
+                length, offset = ((data[1] - 192) << 8) + data[2] + 192, 3
+            else:
+                length, offset = struct.unpack(">I", bytes(data[2:6]))[0], 6
+            tag &= 0x3f
+        else:
+            length_type = tag & 0x03
+            size = {0: 1, 1: 2, 2: 4}[length_type]
+            length = int(struct.unpack(
+                {1: ">B", 2: ">H", 4: ">I"}[size], bytes(data[1:1 + size]))[0])
+            offset = 1 + size
+            tag = (tag >> 2) & 0x0f
+    except (ValueError, IndexError, KeyError, TypeError, struct.error):
+        return None
+
+    packet = data[offset:offset + length]
+    if tag != 6 or len(packet) != length or not packet or packet[0] != 4:
+        return None
+    digest = hashlib.sha1(b"\x99" + struct.pack(">H", length) + bytes(packet))
+    return digest.hexdigest().upper()
+
+
+def _write_if_changed(path, content):
+    try:
+        with open(path) as handle:
+            if handle.read() == content:
+                return
+    except IOError:
+        pass
+    with open(path, "w") as handle:
+        handle.write(content)
+
+
+def _get_cached_pubkey(rdb, usermail):
+    try:
+        cached = rdb.hget(PUBKEY_CACHE_KEY, usermail)
+    except redis.RedisError:
+        return None
+    if not cached:
+        return None
+    cached = json.loads(cached)
+    if time.time() - cached.get("cached_on", 0) > PUBKEY_CACHE_TTL:
+        return None
+    return cached["pubkey"]
+
+
+def _cache_pubkey(rdb, usermail, pubkey):
+    try:
+        rdb.hset(PUBKEY_CACHE_KEY, usermail, json.dumps({
+            "fingerprint": pubkey_fingerprint(pubkey), "pubkey": pubkey,
+            "cached_on": time.time()}))
+    except redis.RedisError:
+        pass
+
+
+def invalidate_pubkey(username, projectname):
+    """
+    Drop the cached public key, called when the key-pair is created
+    or the project is deleted
+    """
+    try:
+        get_redis_connection().hdel(PUBKEY_CACHE_KEY,
+                                    create_gpg_email(username, projectname))
+    except redis.RedisError:
+        pass
+
+
 def get_pubkey(username, projectname, outfile=None):
     """
     Retrieves public key for user/project from signer host.
+    Keys are cached in redis for PUBKEY_CACHE_TTL seconds, so the signer
+    is asked only once in a while per project.
 
-    :param outfile: [optional] file to write obtained key
+    :param outfile: [optional] file to write obtained key, written only
+        when its content differs
     :return: public keys
 
     :raises: CoprSignError or CoprSignNoKeyError
     """
     usermail = create_gpg_email(username, projectname)
-    cmd = ["sudo", SIGN_BINARY, "-u", usermail, "-p"]
+    rdb = get_redis_connection()
+    pubkey = _get_cached_pubkey(rdb, usermail)
+    if pubkey is None:
+        pubkey = _get_pubkey_from_signer(username, usermail)
+        _cache_pubkey(rdb, usermail, pubkey)
+
+    if outfile:
+        _write_if_changed(outfile, pubkey)
+
+    return pubkey
+
+
+def _get_pubkey_from_signer(username, usermail):
+    cmd = SIGN_CMD_PREFIX + [SIGN_BINARY, "-u", usermail, "-p"]
 
     try:
         handle = Popen(cmd, stdout=PIPE, stderr=PIPE)
@@ -62,15 +196,34 @@ def get_pubkey(username, projectname, outfile=None):
             return_code=handle.returncode,
             cmd=cmd, stdout=stdout, stderr=stderr)
 
-    if outfile:
-        with open(outfile, "w") as handle:
-            handle.write(stdout)
-
     return stdout
 
 
+def rpm_is_signed(path):
+    """
+    Look for a gpg signature in the signature header of the rpm, without
+    running rpm
+
+    :return bool: False also when the file is not a readable rpm
+    """
+    try:
+        with open(path, "rb") as handle:
+            handle.seek(RPM_LEAD_SIZE)
+            intro = handle.read(16)
+            if len(intro) != 16 or intro[:4] != RPM_HEADER_MAGIC:
+                return False
+            count = struct.unpack(">I", intro[8:12])[0]
+            index = handle.read(count * 16)
+    except IOError:
+        return False
+
+    tags = set(struct.unpack(">I", index[i:i + 4])[0]
+               for i in range(0, len(index) - 15, 16))
+    return bool(tags & RPM_GPG_SIGNATURE_TAGS)
+
+
 def _sign_one(path, email, callback=None):
-    cmd = ["sudo", SIGN_BINARY, "-u", email, "-r", path]
+    cmd = SIGN_CMD_PREFIX + [SIGN_BINARY, "-u", email, "-r", path]
 
     try:
         handle = Popen(cmd, stdout=PIPE, stderr=PIPE)
@@ -97,7 +250,81 @@ def _sign_one(path, email, callback=None):
     return stdout, stderr
 
 
-def sign_rpms_in_dir(username, projectname, path, callback=None):
+def _sign_batch(paths, email):
+    """
+    Signs all `paths` by one /bin/sign call, which saves sudo and process
+    startup for each rpm.  Relies on obs-sign taking several files,
+    ``sign [-u user] -r <file>...`` signs them one after another and stops
+    at the first failure.
+
+    :raises CoprSignError: when any of the rpms fails, `rpm_is_signed` tells
+        which ones are done
+    """
+    cmd = SIGN_CMD_PREFIX + [SIGN_BINARY, "-u", email, "-r"] + paths
+
+    try:
+        handle = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = handle.communicate()
+    except Exception as e:
+        raise CoprSignError(
+            msg="Failed to invoke sign of {} rpms by user {} with error {}"
+            .format(len(paths), email, e))
+
+    if handle.returncode != 0:
+        raise CoprSignError(
+            msg="Failed to sign {} rpms by user {}".format(len(paths), email),
+            return_code=handle.returncode,
+            cmd=cmd, stdout=stdout, stderr=stderr)
+
+    return stdout, stderr
+
+
+def get_signer_host(conf_path=SIGN_CONF):
+    """
+    Signer host from the obs-sign configuration, "localhost" when
+    it can't be read
+    """
+    try:
+        with open(conf_path) as handle:
+            for line in handle:
+                key, _, value = line.partition(":")
+                if key.strip() == "server" and value.strip():
+                    return value.strip()
+    except IOError:
+        pass
+    return "localhost"
+
+
+class SignRateLimiter(object):
+    """
+    Allows at most `rate` sign requests per second to the signer host,
+    counted in redis so the limit is shared by all backend processes.
+    Signing is not limited when redis is not available.
+    """
+
+    def __init__(self, rate, host=None, rdb=None):
+        self.rate = rate
+        self.host = host or get_signer_host()
+        self.rdb = rdb or get_redis_connection()
+
+    def wait(self):
+        while True:
+            now = time.time()
+            key = SIGN_RATE_KEY.format(self.host, int(now))
+            try:
+                pipe = self.rdb.pipeline()
+                pipe.incr(key)
+                pipe.expire(key, 2)
+                count = pipe.execute()[0]
+            except redis.RedisError:
+                return
+            if count <= self.rate:
+                return
+            time.sleep(int(now) + 1 - now)
+
+
+def sign_rpms_in_dir(username, projectname, path, callback=None,
+                     workers=1, rate_limit=0, batch_size=1):
     """
     Signs rpms using obs-signd.
 
@@ -111,11 +338,18 @@ def sign_rpms_in_dir(username, projectname, path, callback=None):
 
     :param .mockremote.DefaultCallBack callback: object to log progress,
         two methods are utilised: ``log`` and ``error``
+    :param int workers: number of rpms signed at once
+    :param int rate_limit: maximum of sign requests per second sent to
+        the signer host from all processes, 0 means unlimited
+    :param int batch_size: maximum of rpms signed by one /bin/sign call,
+        rpms of a failed batch which are still unsigned are signed again
+        one by one
     """
+    path = os.path.normpath(path)
     rpm_list = [
         os.path.join(path, filename)
-        for filename in os.listdir(path)
-        if filename.endswith("rpm")
+        for filename in lookup_package(os.path.dirname(path),
+                                       os.path.basename(path))["rpms"]
     ]
 
     try:
@@ -123,8 +357,12 @@ def sign_rpms_in_dir(username, projectname, path, callback=None):
     except CoprSignNoKeyError:
         create_user_keys(username, projectname)
 
-    errors = []  # tuples (rpm_filepath, exception)
-    for rpm in rpm_list:
+    limiter = SignRateLimiter(rate_limit) if rate_limit else None
+
+    def sign_one(rpm):
+        """ :return tuple: (rpm_filepath, exception) on failure """
+        if limiter:
+            limiter.wait()
         try:
             _sign_one(rpm,
                       create_gpg_email(username, projectname),
@@ -134,17 +372,61 @@ def sign_rpms_in_dir(username, projectname, path, callback=None):
                 callback.log("signed rpm: {}".format(rpm))
 
         except CoprSignError as e:
-            errors.append((rpm, e))
+            return rpm, e
+
+    def sign_batch(batch):
+        """ :return list: (rpm_filepath, exception) tuples of failures """
+        if len(batch) > 1:
+            if limiter:
+                for _ in batch:
+                    limiter.wait()
+            try:
+                _sign_batch(batch, create_gpg_email(username, projectname))
+                if callback:
+                    for rpm in batch:
+                        callback.log("signed rpm: {}".format(rpm))
+                return []
+            except CoprSignError as e:
+                signed = [rpm for rpm in batch if rpm_is_signed(rpm)]
+                batch = [rpm for rpm in batch if rpm not in signed]
+                if callback:
+                    for rpm in signed:
+                        callback.log("signed rpm: {}".format(rpm))
+                    callback.log("batch sign failed, signing the {} unsigned "
+                                 "rpms one by one: {}".format(len(batch), e))
+        return [error for error in map(sign_one, batch) if error]
+
+    # batches evenly distributed between the workers
+    size = max(min(batch_size, int(math.ceil(len(rpm_list) / float(workers)))), 1)
+    batches = [rpm_list[i:i + size] for i in range(0, len(rpm_list), size)]
+
+    if workers > 1 and len(batches) > 1:
+        pool = ThreadPool(min(workers, len(batches)))
+        try:
+            results = pool.map(sign_batch, batches)
+        finally:
+            pool.terminate()
+    else:
+        results = [sign_batch(batch) for batch in batches]
+
+    errors = [error for batch_errors in results for error in batch_errors]
 
     if errors:
         raise MockRemoteError("Rpm sign failed, affected rpms: {}"
                               .format([err[0] for err in errors]))
 
 
-def create_user_keys(username, projectname):
+def request_user_keys(username, projectname):
+    """
+    Asks copr-keygen to generate key-pair in background
+
+    :return str: url of the key generation job,
+        None when the key-pair already exists
+    """
     data = json.dumps({
         "name_real": "{}_{}".format(username, projectname),
-        "name_email": create_gpg_email(username, projectname)
+        "name_email": create_gpg_email(username, projectname),
+        "async": True,
     })
 
     query = dict(url=COPR_KEYGEN_URL, data=data, method="post")
@@ -161,3 +443,56 @@ def create_user_keys(username, projectname):
             msg="Failed to create key-pair for user: {}, project:{}"
             .format(username, projectname),
             request=query, response=response)
+
+    if response.status_code != 202:
+        # key exists, or keygen without async support generated it
+        return None
+
+    return "{}/{}".format(COPR_KEYGEN_URL, response.json()["id"])
+
+
+def wait_for_user_keys(job_url, timeout=KEYGEN_TIMEOUT,
+                       poll_interval=KEYGEN_POLL_INTERVAL):
+    """
+    Polls the key generation job until it is finished
+
+    :raises CoprKeygenRequestError: job failed or didn't finish in `timeout`
+    """
+    query = dict(url=job_url, method="get")
+    deadline = time.time() + timeout
+    while True:
+        try:
+            response = request(**query)
+        except Exception as e:
+            raise CoprKeygenRequestError(
+                msg="Failed to get key generation job state: {}".format(e),
+                request=query)
+
+        if response.status_code != 200:
+            raise CoprKeygenRequestError(
+                msg="Failed to get key generation job state",
+                request=query, response=response)
+
+        state = response.json()["state"]
+        if state == "done":
+            return
+        if state == "failed":
+            raise CoprKeygenRequestError(
+                msg="Key generation failed: {}".format(response.json()["error"]),
+                request=query, response=response)
+
+        if time.time() + poll_interval > deadline:
+            raise CoprKeygenRequestError(
+                msg="Key generation not finished in {}s".format(timeout),
+                request=query, response=response)
+        time.sleep(poll_interval)
+
+
+def create_user_keys(username, projectname):
+    """
+    Creates key-pair at copr-keygen, blocks until it is generated
+    """
+    job_url = request_user_keys(username, projectname)
+    if job_url:
+        wait_for_user_keys(job_url)
+    invalidate_pubkey(username, projectname)
@@ -0,0 +1,75 @@
+# coding: utf-8
+
+"""
+Shared ssh connections to the builders.
+
+All ssh clients talking to a builder - ansible commands and copies,
+ansible playbooks and rsync downloads - connect through one ssh
+ControlMaster connection per builder and remote user.  The master is kept
+``persist`` seconds after the last client disconnects, so a build makes
+one ssh handshake instead of one for each command.
+"""
+
+from __future__ import absolute_import
+
+import os
+import glob
+import pipes
+import subprocess
+
+import ansible.constants
+
+# %r remote user, %h host, %p port; expanded by ssh the same way
+# for every client, so the clients find the master without coordination
+CONTROL_PATH = "%r@%h:%p"
+
+
+def ssh_options(control_dir, persist):
+    """
+    :return list: ssh command line options using the shared connections
+    """
+    return [
+        "-o", "ControlMaster=auto",
+        "-o", "ControlPersist={0}s".format(persist),
+        "-o", "ControlPath={0}".format(os.path.join(control_dir, CONTROL_PATH)),
+        "-o", "PasswordAuthentication=no",
+        "-o", "StrictHostKeyChecking=no",
+    ]
+
+
+def ssh_command(control_dir, persist):
+    """
+    :return str: ssh command for `rsync -e`
+    """
+    return " ".join(["ssh"] + [pipes.quote(option)
+                               for option in ssh_options(control_dir, persist)])
+
+
+def setup_ssh_control(control_dir, persist):
+    """
+    Make ansible runners of this process and its children, and ansible
+    playbooks started by them, use the shared connections
+    """
+    if not os.path.isdir(control_dir):
+        os.makedirs(control_dir, 0o700)
+
+    ssh_args = " ".join(ssh_options(control_dir, persist))
+    ansible.constants.ANSIBLE_SSH_ARGS = ssh_args
+    # read by ansible-playbook at its start
+    os.environ["ANSIBLE_SSH_ARGS"] = ssh_args
+
+
+def close_connections(control_dir, hostname):
+    """
+    Stop the master connections to `hostname` of all remote users,
+    e.g. when the builder is terminated
+
+    :return int: number of stopped masters
+    """
+    closed = 0
+    for path in glob.glob(os.path.join(control_dir, "*@{0}:*".format(hostname))):
+        cmd = ["ssh", "-o", "ControlPath={0}".format(path), "-O", "exit", hostname]
+        with open(os.devnull, "w") as devnull:
+            if subprocess.call(cmd, stdout=devnull, stderr=devnull) == 0:
+                closed += 1
+    return closed
@@ -0,0 +1,189 @@
+"""
+Deferred removal of results.  Directories are atomically renamed into
+the trash directory (on the same filesystem as destdir, outside of
+the results served over HTTP), so the action
+deleting them finishes immediately, and TrashReaper removes them later
+at a limited rate.
+"""
+
+from __future__ import absolute_import
+
+import os
+import time
+import uuid
+import errno
+import shutil
+import subprocess
+import multiprocessing
+
+from setproctitle import setproctitle
+
+from .helpers import get_redis_connection
+
+# redis hash with reaper progress
+TRASH_STATS_KEY = "copr-be-trash-stats"
+
+
+def move_to_trash(trash_dir, path):
+    """
+    Move `path` out of the results tree, remove it right away when
+    there is no trash directory or it is on another filesystem
+
+    :return str: path inside the trash, None when nothing was moved
+    """
+    if not trash_dir:
+        _remove(path)
+        return None
+
+    try:
+        os.makedirs(trash_dir)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+
+    # entries sort by the time they were trashed
+    target = os.path.join(trash_dir, "{0:.6f}-{1}-{2}".format(
+        time.time(), uuid.uuid4().hex[:8], os.path.basename(path.rstrip("/"))))
+    try:
+        os.rename(path, target)
+    except OSError as error:
+        if error.errno == errno.ENOENT:
+            return None
+        if error.errno == errno.EXDEV:
+            _remove(path)
+            return None
+        raise
+    return target
+
+
+def _remove(path):
+    """ Remove `path` right away, it is fine when it is already gone """
+    try:
+        shutil.rmtree(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+
+class TrashReaper(multiprocessing.Process):
+    """
+    Removes trashed directories, oldest first, unlinking at most
+    `trash_reap_rate` files per second under the idle I/O class.
+
+    Reclaimed space and progress are kept in the TRASH_STATS_KEY redis hash
+    and logged after each removed directory.
+    """
+
+    def __init__(self, opts, events):
+        multiprocessing.Process.__init__(self, name="trash-reaper")
+
+        self.opts = opts
+        self.events = events
+        self.rdb = None
+
+        self.stats = {"reclaimed_bytes": 0, "reclaimed_files": 0,
+                      "reaped_dirs": 0, "pending_dirs": 0,
+                      "current": "", "updated_on": 0}
+        self._window_start = None
+        self._window_count = 0
+
+    def event(self, what):
+        self.events.put({"when": time.time(), "who": "trash-reaper", "what": what})
+
+    def pending_entries(self):
+        try:
+            return [os.path.join(self.opts.trash_dir, name)
+                    for name in sorted(os.listdir(self.opts.trash_dir))]
+        except OSError:
+            return []
+
+    def throttle(self):
+        """ Sleep to keep the unlink rate under `trash_reap_rate` """
+        rate = self.opts.trash_reap_rate
+        if not rate:
+            return
+        now = time.time()
+        if self._window_start is None or now - self._window_start > 1:
+            # start a new window after idle time, don't catch up
+            self._window_start, self._window_count = now, 0
+        self._window_count += 1
+        ahead = self._window_count / float(rate) - (now - self._window_start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def _unlink(self, path):
+        try:
+            size = os.lstat(path).st_size
+            os.unlink(path)
+        except OSError:
+            return
+        self.stats["reclaimed_bytes"] += size
+        self.stats["reclaimed_files"] += 1
+        self.throttle()
+
+    def reap_entry(self, entry):
+        """
+        Remove one trashed directory (or file)
+
+        :return tuple: (removed files, removed bytes)
+        """
+        files, size = self.stats["reclaimed_files"], self.stats["reclaimed_bytes"]
+        if os.path.isdir(entry) and not os.path.islink(entry):
+            for root, dirs, names in os.walk(entry, topdown=False):
+                for name in names:
+                    self._unlink(os.path.join(root, name))
+                for name in dirs:
+                    path = os.path.join(root, name)
+                    if os.path.islink(path):
+                        self._unlink(path)
+                    else:
+                        try:
+                            os.rmdir(path)
+                        except OSError:
+                            pass
+            os.rmdir(entry)
+        else:
+            self._unlink(entry)
+
+        self.stats["reaped_dirs"] += 1
+        return (self.stats["reclaimed_files"] - files,
+                self.stats["reclaimed_bytes"] - size)
+
+    def publish_stats(self):
+        self.stats["updated_on"] = time.time()
+        if self.rdb is not None:
+            self.rdb.hmset(TRASH_STATS_KEY, dict(self.stats))
+
+    def reap_once(self):
+        entries = self.pending_entries()
+        for index, entry in enumerate(entries):
+            self.stats["pending_dirs"] = len(entries) - index
+            self.stats["current"] = os.path.basename(entry)
+            self.publish_stats()
+
+            start = time.time()
+            try:
+                files, size = self.reap_entry(entry)
+            except OSError as error:
+                self.event("Failed to remove {0} from trash: {1}".format(entry, error))
+                continue
+            self.event("Removed {0} from trash: {1} files, {2} bytes in {3:.1f}s"
+                       .format(entry, files, size, time.time() - start))
+
+        self.stats["pending_dirs"] = 0
+        self.stats["current"] = ""
+        self.publish_stats()
+
+    def run(self):
+        setproctitle("CoprTrashReaper")
+        try:
+            subprocess.call(["ionice", "-c", "3", "-p", str(os.getpid())])
+        except OSError:
+            pass
+        self.rdb = get_redis_connection()
+        try:
+            while True:
+                self.reap_once()
+                time.sleep(self.opts.sleeptime)
+        except KeyboardInterrupt:
+            return
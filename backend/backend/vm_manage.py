@@ -0,0 +1,416 @@
+import re
+import sys
+import time
+import json
+import subprocess
+import multiprocessing
+
+import ansible
+import ansible.runner
+import ansible.errors
+
+from setproctitle import setproctitle
+from IPy import IP
+from retask.task import Task
+from retask.queue import Queue
+
+from .mockremote import DEF_REMOTE_BASEDIR
+from .sshcontrol import close_connections
+
+ansible_playbook = "ansible-playbook"
+
+
+def ans_extra_vars_encode(extra_vars, name):
+    """ transform dict into --extra-vars="json string" """
+    if not extra_vars:
+        return ""
+    return "--extra-vars='{{\"{0}\": {1}}}'".format(name, json.dumps(extra_vars))
+
+
+class VmProvisioner(object):
+    """
+    Spawns, checks and terminates builder instances of one build group
+    using the group's spawn/terminate playbooks.
+
+    :param opts: backend options
+    :param int group_id: build group
+    :param callback: object with ``log(msg)`` method
+    """
+
+    def __init__(self, opts, group_id, callback):
+        self.opts = opts
+        self.group_id = group_id
+        self.callback = callback
+
+    @property
+    def group(self):
+        return self.opts.build_groups[self.group_id]
+
+    def run_ansible_playbook(self, args, name="running playbook", attempts=9):
+        """
+        call ansible playbook
+            - well mostly we run out of space in OpenStack so we rather try
+              multiple times (attempts param)
+            - dump any attempt failure
+        """
+
+        # Ansible playbook python API does not work here, dunno why.  See:
+        # https://groups.google.com/forum/#!topic/ansible-project/DNBD2oHv5k8
+
+        command = "{0} {1}".format(ansible_playbook, args)
+
+        for i in range(0, attempts):
+            try:
+                attempt_desc = ": retry: " if i else ": begin: "
+                self.callback.log(name + attempt_desc + command)
+
+                result = subprocess.check_output(command, shell=True)
+                self.callback.log("Raw playbook output:\n{0}\n".format(result))
+                break
+
+            except subprocess.CalledProcessError as e:
+                result = None
+                self.callback.log("CalledProcessError: \n{0}\n".format(e.output))
+                sys.stderr.write("{0}\n".format(e.output))
+                # FIXME: this is not purpose of opts.sleeptime
+                time.sleep(self.opts.sleeptime)
+
+        self.callback.log(name + ": end")
+        return result
+
+    def is_healthy(self, ipaddr):
+        """
+        Check that the builder responds over ssh
+        """
+        connection = ansible.runner.Runner(
+            remote_user="root",
+            host_list="{},".format(ipaddr),
+            pattern=ipaddr,
+            forks=1,
+            transport="ssh",
+            timeout=500
+        )
+        connection.module_name = "shell"
+        connection.module_args = "echo hello"
+        res = connection.run()
+
+        return bool(res["contacted"])
+
+    def clean_builder(self, ipaddr):
+        """
+        Remove results and temporary directories of previous builds,
+        so the builder can be used for another job
+
+        :return bool: True when the builder was cleaned
+        """
+        connection = ansible.runner.Runner(
+            remote_user="root",
+            host_list="{},".format(ipaddr),
+            pattern=ipaddr,
+            forks=1,
+            transport="ssh",
+            timeout=500
+        )
+        connection.module_name = "shell"
+        connection.module_args = "rm -rf /var/lib/mock/*/result {0}/mockremote-*" \
+            .format(DEF_REMOTE_BASEDIR)
+        try:
+            res = connection.run()
+        except ansible.errors.AnsibleError as e:
+            self.callback.log("failed to clean builder {0}: {1}".format(ipaddr, e))
+            return False
+
+        result = res["contacted"].get(ipaddr)
+        return bool(result) and not result.get("rc") and not result.get("failed")
+
+    def spawn_instance(self, chroot=None):
+        """
+        call the spawn playbook to startup/provision a building instance
+        get an IP and test if the builder responds
+        repeat this until you get an IP of working builder
+
+        :param str chroot: [optional] passed to the playbook when `spawn_vars`
+            contains ``chroot``
+        :return tuple: (ip, vm_name), (None, None) when the group has no
+            spawn playbook
+        """
+
+        start = time.time()
+
+        extra_vars = {}
+        if self.opts.spawn_vars:
+            for i in self.opts.spawn_vars.split(","):
+                if i == "chroot" and chroot:
+                    extra_vars["chroot"] = chroot
+
+        try:
+            spawn_playbook = self.group["spawn_playbook"]
+        except KeyError:
+            return None, None
+
+        args = "-c ssh {0} {1}".format(
+            spawn_playbook, ans_extra_vars_encode(extra_vars, "copr_task"))
+
+        i = 0
+        while True:
+            i += 1
+            self.callback.log("Spawning a builder. Try No. {0}".format(i))
+            result = self.run_ansible_playbook(args, "spawning instance")
+            if not result:
+                self.callback.log("No result, trying again")
+                continue
+
+            match = re.search(r'IP=([^\{\}"]+)', result, re.MULTILINE)
+            if not match:
+                self.callback.log("No ip in the result, trying again")
+                continue
+            ipaddr = match.group(1)
+
+            vm_name = None
+            match = re.search(r'vm_name=([^\{\}"]+)', result, re.MULTILINE)
+            if match:
+                vm_name = match.group(1)
+
+            self.callback.log("got instance ip: {0}".format(ipaddr))
+            self.callback.log(
+                "Instance spawn/provision took {0} sec".format(time.time() - start))
+
+            try:
+                IP(ipaddr)
+            except ValueError:
+                # if we get here we"re in trouble
+                self.callback.log(
+                    "Invalid IP back from spawn_instance - dumping cache output")
+                self.callback.log(str(result))
+                continue
+
+            # we were getting some dead instancies
+            # that's why I'm testing the conncectivity here
+            if self.is_healthy(ipaddr):
+                return ipaddr, vm_name
+
+            else:
+                self.callback.log(
+                    "Worker is not responding to"
+                    "the testing playbook. Spawning another one.")
+                self.terminate_instance(ipaddr, vm_name)
+
+    def terminate_instance(self, instance_ip, vm_name=None):
+        """
+        call the terminate playbook to destroy the building instance,
+        stop the shared ssh connections to it, so a new builder getting
+        the same ip doesn't reuse them
+        """
+
+        term_args = {}
+        if self.opts.terminate_vars:
+            for i in self.opts.terminate_vars.split(","):
+                if i == "ip":
+                    term_args["ip"] = instance_ip
+                if i == "vm_name":
+                    term_args["vm_name"] = vm_name
+
+        args = "-c ssh -i '{0},' {1} {2}".format(
+            instance_ip, self.group["terminate_playbook"],
+            ans_extra_vars_encode(term_args, "copr_task"))
+        self.run_ansible_playbook(args, "terminate instance")
+        if self.opts.ssh_control_persist:
+            close_connections(self.opts.ssh_control_dir, instance_ip)
+
+
+class BuilderPool(object):
+    """
+    Redis backed pool of ready builders for one build group.
+
+    Idle builders wait in a retask queue, so a worker gets one with
+    a single (blocking) pop.  Builders which are no longer wanted are put
+    into the dispose queue and terminated by :class:`BuilderPoolManager`,
+    every builder owned by the pool is recorded in a redis hash.
+
+    Builder is represented by dict with fields:
+        - ip
+        - vm_name
+        - spawned_on
+        - checked_on
+    """
+
+    def __init__(self, group_id):
+        self.group_id = group_id
+        self.idle_queue = Queue("copr-vm-pool-{0}".format(group_id))
+        self.dispose_queue = Queue("copr-vm-pool-{0}-dispose".format(group_id))
+        self.vms_key = "copr-vm-pool-{0}-vms".format(group_id)
+
+    def connect(self):
+        self.idle_queue.connect()
+        self.dispose_queue.connect()
+
+    @property
+    def rdb(self):
+        return self.idle_queue.rdb
+
+    @property
+    def idle(self):
+        return self.idle_queue.length
+
+    @property
+    def total(self):
+        return self.rdb.hlen(self.vms_key)
+
+    def all_vms(self):
+        return [json.loads(value) for value in self.rdb.hvals(self.vms_key)]
+
+    def add(self, vm):
+        """ Register new builder and offer it to the workers """
+        self.rdb.hset(self.vms_key, vm["ip"], json.dumps(vm))
+        self.give_back(vm)
+
+    def forget(self, vm):
+        self.rdb.hdel(self.vms_key, vm["ip"])
+
+    def lease(self, timeout=0):
+        """
+        Take an idle builder, wait up to `timeout` seconds (0 == forever)
+
+        :return dict: builder or None when nothing became available
+        """
+        task = self.idle_queue.wait(timeout)
+        if not task:
+            return None
+        return task.data
+
+    def take_idle(self):
+        """ Non-blocking variant of `lease` """
+        task = self.idle_queue.dequeue()
+        if not task:
+            return None
+        return task.data
+
+    def give_back(self, vm):
+        self.idle_queue.enqueue(Task(vm))
+
+    def dispose(self, vm):
+        """ Hand the builder over to the pool manager for termination """
+        self.dispose_queue.enqueue(Task(vm))
+
+
+class PoolCallback(object):
+    """ Sends pool log messages into the backend events queue """
+
+    def __init__(self, events, group_name):
+        self.events = events
+        self.who = "vm-pool-{0}".format(group_name)
+
+    def log(self, msg):
+        self.events.put({"when": time.time(), "who": self.who, "what": msg})
+
+
+class BuilderPoolManager(multiprocessing.Process):
+    """
+    Keeps `pool_min_idle` ready builders for one build group,
+    never owning more then `pool_max_total` of them, re-checks idle
+    builders every `pool_check_interval` seconds and terminates disposed ones.
+    """
+
+    def __init__(self, opts, events, group_id):
+        multiprocessing.Process.__init__(self, name="vm-pool-manager")
+
+        self.opts = opts
+        self.events = events
+        self.group_id = group_id
+        self.group = opts.build_groups[group_id]
+        self.callback = PoolCallback(events, self.group["name"])
+        self.provisioner = VmProvisioner(opts, group_id, self.callback)
+        self.pool = BuilderPool(group_id)
+        self.last_check = 0
+        self.kill_received = False
+
+    def terminate_vm(self, vm):
+        try:
+            self.provisioner.terminate_instance(vm["ip"], vm.get("vm_name"))
+        finally:
+            self.pool.forget(vm)
+
+    def cleanup_orphans(self):
+        """
+        Builders leased before backend restart are not idle nor used by anybody
+        """
+        idle_ips = set()
+        for _ in range(self.pool.idle):
+            vm = self.pool.take_idle()
+            if vm is None:
+                break
+            idle_ips.add(vm["ip"])
+            self.pool.give_back(vm)
+
+        for vm in self.pool.all_vms():
+            if vm["ip"] not in idle_ips:
+                self.callback.log("Terminating orphaned builder {0}".format(vm["ip"]))
+                self.terminate_vm(vm)
+
+    def terminate_disposed(self):
+        while True:
+            task = self.pool.dispose_queue.dequeue()
+            if not task:
+                break
+            vm = task.data
+            self.callback.log("Terminating disposed builder {0}".format(vm["ip"]))
+            self.terminate_vm(vm)
+
+    def recheck_idle(self):
+        if time.time() - self.last_check < self.opts.pool_check_interval:
+            return
+        self.last_check = time.time()
+
+        for _ in range(self.pool.idle):
+            vm = self.pool.take_idle()
+            if vm is None:
+                break
+
+            if self.provisioner.is_healthy(vm["ip"]):
+                vm["checked_on"] = time.time()
+                self.pool.give_back(vm)
+            else:
+                self.callback.log("Idle builder {0} is not responding, terminating"
+                                  .format(vm["ip"]))
+                self.terminate_vm(vm)
+
+    def refill(self):
+        """ Spawn one builder if the pool needs it """
+        if self.pool.idle >= self.group["pool_min_idle"]:
+            return
+        if self.pool.total >= self.group["pool_max_total"]:
+            return
+
+        try:
+            ip, vm_name = self.provisioner.spawn_instance()
+        except ansible.errors.AnsibleError as e:
+            self.callback.log("failure to setup instance: {0}".format(e))
+            return
+
+        if not ip:
+            self.callback.log("No IP found from creating instance")
+            return
+
+        now = time.time()
+        self.pool.add({"ip": ip, "vm_name": vm_name,
+                       "spawned_on": now, "checked_on": now})
+        self.callback.log("Builder {0} added to the pool, idle: {1}, total: {2}"
+                          .format(ip, self.pool.idle, self.pool.total))
+
+    def run(self):
+        setproctitle("vm-pool-manager {0}".format(self.group["name"]))
+        self.pool.connect()
+        self.cleanup_orphans()
+        self.last_check = time.time()
+
+        try:
+            while not self.kill_received:
+                self.terminate_disposed()
+                self.recheck_idle()
+                self.refill()
+
+                if self.pool.idle >= self.group["pool_min_idle"] or \
+                        self.pool.total >= self.group["pool_max_total"]:
+                    time.sleep(self.opts.sleeptime)
+        except KeyboardInterrupt:
+            return
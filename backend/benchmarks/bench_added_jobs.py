@@ -0,0 +1,64 @@
+#!/usr/bin/python
+"""
+Cost of one CoprJobGrab poll de-duplication as the number of historical
+tasks grows: the old ever growing list vs. BoundedIdSet.
+
+Run from the backend directory:
+
+    PYTHONPATH=. python benchmarks/bench_added_jobs.py
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import timeit
+
+from backend.helpers import BoundedIdSet
+
+POLL_SIZE = 500
+MAX_SIZE = 100000
+
+
+def task_id(num):
+    return "{0}-fedora-21-x86_64".format(num)
+
+
+def poll(seen, first_id):
+    """ one poll returning POLL_SIZE tasks, half of them already seen """
+    new = 0
+    for num in range(first_id - POLL_SIZE // 2, first_id + POLL_SIZE // 2):
+        if task_id(num) not in seen:
+            new += 1
+    return new
+
+
+def bench_list(history):
+    seen = [task_id(num) for num in range(history)]
+    return min(timeit.repeat(lambda: poll(seen, history), number=1, repeat=3))
+
+
+def bench_bounded_set(history):
+    seen = BoundedIdSet(MAX_SIZE)
+    for num in range(history):
+        seen.add(task_id(num))
+    return min(timeit.repeat(lambda: poll(seen, history), number=1, repeat=3)), len(seen)
+
+
+def main():
+    print("poll of {0} tasks, BoundedIdSet max_size={1}".format(POLL_SIZE, MAX_SIZE))
+    print("{0:>12} {1:>14} {2:>14} {3:>10}".format(
+        "history", "list [ms]", "bounded [ms]", "remembered"))
+
+    for history in [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 3 * 10 ** 6]:
+        bounded, size = bench_bounded_set(history)
+        # linear scans over millions of ids take minutes, extrapolate
+        if history <= 10 ** 5:
+            as_list = "{0:.2f}".format(bench_list(history) * 1000)
+        else:
+            as_list = "-"
+        print("{0:>12} {1:>14} {2:>14.3f} {3:>10}".format(
+            history, as_list, bounded * 1000, size))
+
+
+if __name__ == "__main__":
+    main()
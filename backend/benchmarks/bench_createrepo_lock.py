@@ -0,0 +1,91 @@
+#!/usr/bin/python
+"""
+Throughput of concurrent createrepo runs on different repositories:
+the former global backend lock vs. RepoLock of each repository.
+
+By default createrepo_c is replaced by a stub which sleeps for
+STUB_DURATION seconds, so the result shows lock contention only. With
+--real the installed /usr/bin/createrepo_c runs over empty repositories.
+
+Run from the backend directory:
+
+    PYTHONPATH=. python benchmarks/bench_createrepo_lock.py [--real]
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+import backend.createrepo
+from backend.createrepo import createrepo_unsafe
+
+PROCESSES = 8
+REPOS = 16
+RUNS_PER_REPO = 4
+STUB_DURATION = 0.2
+
+
+class StubPopen(object):
+    """ Stands for createrepo_c run """
+
+    def __init__(self, *args, **kwargs):
+        self.returncode = 0
+
+    def communicate(self):
+        time.sleep(STUB_DURATION)
+        return "", ""
+
+
+def worker(paths, lock):
+    for path in paths:
+        createrepo_unsafe(path, lock)
+
+
+def measure(paths, lock):
+    chunks = [paths[num::PROCESSES] for num in range(PROCESSES)]
+    procs = [multiprocessing.Process(target=worker, args=(chunk, lock))
+             for chunk in chunks]
+    start = time.time()
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    return time.time() - start
+
+
+def main():
+    if "--real" not in sys.argv:
+        backend.createrepo.Popen = StubPopen
+
+    root = tempfile.mkdtemp(prefix="bench_createrepo_")
+    backend.createrepo.REPO_LOCK_DIR = os.path.join(root, "locks")
+    try:
+        repos = []
+        for num in range(REPOS):
+            path = os.path.join(root, "user{0}".format(num), "project", "fedora-21-x86_64")
+            os.makedirs(path)
+            repos.append(path)
+        # requests for the same repository are spread over the processes
+        paths = repos * RUNS_PER_REPO
+
+        print("{0} processes, {1} repositories, {2} runs each, {3}".format(
+            PROCESSES, REPOS, RUNS_PER_REPO,
+            "createrepo_c" if "--real" in sys.argv
+            else "stub createrepo_c {0}s".format(STUB_DURATION)))
+        for name, lock in [("global lock", multiprocessing.Lock()),
+                           ("RepoLock", None)]:
+            took = measure(paths, lock)
+            print("{0:<12} {1:>7.2f}s {2:>8.1f} runs/s".format(
+                name, took, len(paths) / took))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
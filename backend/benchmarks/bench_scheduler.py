@@ -0,0 +1,139 @@
+#!/usr/bin/python
+"""
+Simulation of one build group: a single owner submits a large backlog while
+other owners keep submitting a few builds each. Reports how long tasks of
+the small owners wait for a worker with plain FIFO queue (previous behavior)
+and with FairShareScheduler.
+
+Run from the backend directory:
+
+    PYTHONPATH=. python benchmarks/bench_scheduler.py
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import heapq
+import random
+from collections import deque
+
+from backend.scheduler import FairShareScheduler
+
+WORKERS = 20
+BIG_BACKLOG = 2000
+BIG_DURATION = 900
+SMALL_OWNERS = 100
+SMALL_DURATION = 300
+SUBMIT_WINDOW = 8 * 3600
+
+
+class FifoQueue(object):
+    def __init__(self):
+        self.tasks = deque()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, task):
+        self.tasks.append(task)
+
+    def pop(self):
+        return self.tasks.popleft() if self.tasks else None
+
+    def task_finished(self, task_id):
+        pass
+
+
+def generate_tasks(seed=42):
+    rnd = random.Random(seed)
+    tasks = []
+    for num in range(BIG_BACKLOG):
+        tasks.append({"submitted": 0, "project_owner": "big", "project_name": "mass",
+                      "duration": rnd.uniform(0.5, 1.5) * BIG_DURATION})
+
+    for owner in range(SMALL_OWNERS):
+        for _ in range(rnd.randint(1, 3)):
+            tasks.append({"submitted": rnd.uniform(0, SUBMIT_WINDOW),
+                          "project_owner": "user{0}".format(owner),
+                          "project_name": "proj",
+                          "duration": rnd.uniform(0.5, 1.5) * SMALL_DURATION})
+
+    tasks.sort(key=lambda t: t["submitted"])
+    for num, task in enumerate(tasks):
+        task["build_id"] = num
+        task["task_id"] = "{0}-fedora-21-x86_64".format(num)
+    return tasks
+
+
+def simulate(queue, tasks):
+    arrivals = deque(tasks)
+    running = []  # heap of (end, task_id)
+    free = WORKERS
+    now = 0.0
+    waits = {}
+    finished_on = {}
+
+    while arrivals or len(queue) or running:
+        while arrivals and arrivals[0]["submitted"] <= now:
+            queue.add(arrivals.popleft())
+
+        while free:
+            task = queue.pop()
+            if task is None:
+                break
+            free -= 1
+            waits[task["task_id"]] = (task["project_owner"], now - task["submitted"])
+            heapq.heappush(running, (now + task["duration"], task["task_id"]))
+
+        next_events = []
+        if arrivals:
+            next_events.append(arrivals[0]["submitted"])
+        if running:
+            next_events.append(running[0][0])
+        if not next_events:
+            break
+        now = max(now, min(next_events))
+
+        while running and running[0][0] <= now:
+            _, task_id = heapq.heappop(running)
+            queue.task_finished(task_id)
+            finished_on[task_id] = now
+            free += 1
+
+    return waits, max(finished_on.values())
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def report(name, waits, makespan):
+    small = [wait for owner, wait in waits.values() if owner != "big"]
+    big = [wait for owner, wait in waits.values() if owner == "big"]
+    print("{0:<12} {1:>8.1f} {2:>8.1f} {3:>8.1f} {4:>8.1f} {5:>10.1f} {6:>10.1f}".format(
+        name,
+        percentile(small, 50) / 60, percentile(small, 95) / 60,
+        percentile(small, 99) / 60, max(small) / 60,
+        max(big) / 3600, makespan / 3600))
+
+
+def main():
+    tasks = generate_tasks()
+    print("{0} workers, owner 'big' submits {1} builds at once, {2} other owners "
+          "submit {3} builds over {4} h".format(
+              WORKERS, BIG_BACKLOG, SMALL_OWNERS,
+              len(tasks) - BIG_BACKLOG, SUBMIT_WINDOW // 3600))
+    print("{0:<12} {1:>8} {2:>8} {3:>8} {4:>8} {5:>10} {6:>10}".format(
+        "", "p50[min]", "p95[min]", "p99[min]", "max[min]", "big max[h]", "total[h]"))
+    print("{0:<12} {1:^35} {2:>10} {3:>10}".format("", "small owners wait", "", ""))
+
+    report("fifo", *simulate(FifoQueue(), [dict(t) for t in tasks]))
+    report("fair-share", *simulate(FairShareScheduler(), [dict(t) for t in tasks]))
+    report("fair+limit", *simulate(FairShareScheduler(owner_limit=WORKERS // 2),
+                                   [dict(t) for t in tasks]))
+
+
+if __name__ == "__main__":
+    main()
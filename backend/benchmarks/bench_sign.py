@@ -0,0 +1,78 @@
+#!/usr/bin/python
+"""
+Throughput of sign_rpms_in_dir for various numbers of RPMs, sizes
+of the signing pool and sizes of the sign batches.
+
+/bin/sign is replaced by a stub shell script which sleeps STUB_STARTUP
+seconds (sudo, process startup) plus STUB_DURATION seconds for each rpm
+(a round trip to the signer host), sudo is not used.
+
+Run from the backend directory:
+
+    PYTHONPATH=. python benchmarks/bench_sign.py
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import stat
+import time
+import shutil
+import tempfile
+
+import backend.sign
+from backend.sign import sign_rpms_in_dir
+
+STUB_STARTUP = 0.08
+STUB_DURATION = 0.02
+RPM_COUNTS = [1, 4, 16, 32]
+WORKERS = [1, 4]
+BATCH_SIZES = [1, 50]
+
+STUB = """#!/bin/sh
+# sign -u <email> -r <rpm>...
+sleep $(awk -v n=$(($# - 3)) 'BEGIN {{ print {0} + n * {1} }}')
+""".format(STUB_STARTUP, STUB_DURATION)
+
+
+def make_build_dir(root, rpms):
+    pkg_dir = os.path.join(root, "fedora-22-x86_64", "foo-{0}".format(rpms))
+    os.makedirs(pkg_dir)
+    for i in range(rpms):
+        open(os.path.join(pkg_dir, "foo-sub{0}-1.0-1.x86_64.rpm".format(i)), "w").close()
+    return pkg_dir
+
+
+def main():
+    tmp_dir = tempfile.mkdtemp()
+    stub_path = os.path.join(tmp_dir, "sign")
+    with open(stub_path, "w") as handle:
+        handle.write(STUB)
+    os.chmod(stub_path, os.stat(stub_path).st_mode | stat.S_IEXEC)
+
+    backend.sign.SIGN_BINARY = stub_path
+    backend.sign.SIGN_CMD_PREFIX = []
+
+    setups = [(w, b) for w in WORKERS for b in BATCH_SIZES]
+
+    print("stub sign startup {0}s, {1}s per rpm, rpms/s:"
+          .format(STUB_STARTUP, STUB_DURATION))
+    print("{0:>6} ".format("rpms") + " ".join(
+        "{0:>18}".format("workers={0},batch={1}".format(w, b)) for w, b in setups))
+    try:
+        for rpms in RPM_COUNTS:
+            pkg_dir = make_build_dir(tmp_dir, rpms)
+            row = []
+            for workers, batch_size in setups:
+                start = time.time()
+                sign_rpms_in_dir("foo", "bar", pkg_dir, workers=workers,
+                                 batch_size=batch_size)
+                row.append(rpms / (time.time() - start))
+            print("{0:>6} ".format(rpms) + " ".join("{0:>18.1f}".format(r) for r in row))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
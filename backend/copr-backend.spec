@@ -89,6 +89,7 @@ popd
 install -d %{buildroot}%{_sharedstatedir}/copr
 install -d %{buildroot}%{_sharedstatedir}/copr/jobs
 install -d %{buildroot}%{_sharedstatedir}/copr/public_html/results
+install -d %{buildroot}%{_sharedstatedir}/copr/trash
 install -d %{buildroot}%{_var}/log/copr
 install -d %{buildroot}%{_var}/log/copr/workers/
 install -d %{buildroot}%{_pkgdocdir}/lighttpd/
@@ -152,6 +153,7 @@ useradd -r -g copr -G lighttpd -s /bin/bash -c "COPR user" copr
 %dir %attr(0755, copr, copr) %{_sharedstatedir}/copr/jobs/
 %dir %attr(0755, copr, copr) %{_sharedstatedir}/copr/public_html/
 %dir %attr(0755, copr, copr) %{_sharedstatedir}/copr/public_html/results
+%dir %attr(0755, copr, copr) %{_sharedstatedir}/copr/trash
 %dir %attr(0755, copr, copr) %{_var}/log/copr
 %dir %attr(0755, copr, copr) %{_var}/log/copr/workers
 %dir %attr(0755, copr, copr) %{_var}/run/copr-backend
@@ -27,10 +27,15 @@ from retask.queue import Queue
 from retask import ConnectionError
 
 from backend.exceptions import CoprBackendError
-from backend.dispatcher import Worker
-from backend.actions import Action
-from backend.callback import FrontendCallback
-from backend.helpers import BackendConfigReader
+from backend.dispatcher import Worker, JOBGRAB_WAKEUP_QUEUE
+from backend.vm_manage import BuilderPoolManager
+from backend.autoscale import WorkerAutoscaler, get_job_durations, poison_pill
+from backend.scheduler import FairShareScheduler, parse_owner_weights, scheduled_key
+from backend.action_executor import ActionExecutor, ACTIONS_QUEUE
+from backend.createrepo import CreaterepoService, CREATEREPO_QUEUE
+from backend.trash import TrashReaper
+from backend.sshcontrol import setup_ssh_control
+from backend.helpers import BackendConfigReader, BoundedIdSet
 
 
 def _get_conf(cp, section, option, default, mode=None):
@@ -60,10 +65,12 @@ class CoprJobGrab(multiprocessing.Process):
 
     """
     Fetch jobs from the Frontend
+    - order them by FairShareScheduler of the build group
     - submit them to the jobs queue for workers
+    - submit actions to the queue for ActionExecutor
     """
 
-    def __init__(self, opts, events, lock):
+    def __init__(self, opts, events):
         # base class initialization
         multiprocessing.Process.__init__(self, name="jobgrab")
 
@@ -73,18 +80,89 @@ class CoprJobGrab(multiprocessing.Process):
         for group in self.opts.build_groups:
             self.task_queues.append(Queue("copr-be-{0}".format(group["id"])))
             self.task_queues[group["id"]].connect()
-        self.added_jobs = []
-        self.lock = lock
+        self.wakeup_queue = Queue(JOBGRAB_WAKEUP_QUEUE)
+        self.wakeup_queue.connect()
+        self.actions_queue = Queue(ACTIONS_QUEUE)
+        self.actions_queue.connect()
+        # ids of tasks already put into task queues
+        self.added_jobs = BoundedIdSet(self.opts.added_jobs_max_size,
+                                       self.opts.added_jobs_max_age)
+        # ids of actions already put into actions queue
+        self.added_actions = BoundedIdSet(self.opts.added_jobs_max_size,
+                                          self.opts.added_jobs_max_age)
+
+        owner_weights = parse_owner_weights(self.opts.scheduler_owner_weights)
+        self.schedulers = {}
+        for group in self.opts.build_groups:
+            self.schedulers[group["id"]] = FairShareScheduler(
+                owner_weights=owner_weights,
+                owner_limit=self.opts.scheduler_owner_limit,
+                bulk_threshold=self.opts.scheduler_bulk_threshold)
+        self.poll_now = False
+        self.last_poll = 0
+
+        # incremental /waiting/ feed state
+        self.builds_cursor = 0
+        self.actions_cursor = 0
+        self.etag = None
+        self.last_full_fetch = 0
 
     def event(self, what):
         self.events.put({"when": time.time(), "who": "jobgrab", "what": what})
 
+    def fetch_waiting(self):
+        """
+        Ask frontend for new tasks and actions.
+
+        Only tasks and actions newer than those seen so far (and tasks running
+        for too long) are requested and unchanged feed is answered by
+        304 Not Modified. Once per
+        `waiting_resync_interval` seconds the full list is downloaded to pick
+        up tasks whose ids were committed out of order.
+
+        :return: dict with "builds" and "actions" or None when nothing changed
+        """
+        params = {}
+        headers = {}
+        full_fetch = time.time() - self.last_full_fetch > self.opts.waiting_resync_interval
+        if not full_fetch:
+            params["builds_since"] = self.builds_cursor
+            params["actions_since"] = self.actions_cursor
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+
+        r = requests.get(
+            "{0}/waiting/".format(self.opts.frontend_url),
+            auth=("user", self.opts.frontend_auth),
+            params=params, headers=headers)
+
+        if r.status_code == 304:
+            return None
+
+        r_json = r.json()
+        self.etag = r.headers.get("ETag")
+        if full_fetch:
+            # the full list leaves out recently started tasks, so only tasks
+            # missing there and not waiting or running here are finished
+            keep = set(task["task_id"] for task in r_json.get("builds", [])
+                       if "task_id" in task)
+            for scheduler in self.schedulers.values():
+                keep |= scheduler.task_ids()
+            self.added_jobs.retain(keep)
+            self.added_actions.retain(
+                action["id"] for action in r_json.get("actions", []))
+        # older frontend doesn't know cursors, stay with full fetches
+        if "builds_cursor" in r_json and "actions_cursor" in r_json:
+            self.builds_cursor = max(self.builds_cursor, r_json["builds_cursor"])
+            self.actions_cursor = max(self.actions_cursor, r_json["actions_cursor"])
+            if full_fetch:
+                self.last_full_fetch = time.time()
+
+        return r_json
+
     def load_tasks(self):
         try:
-            r = requests.get(
-                "{0}/waiting/".format(self.opts.frontend_url),
-                auth=("user", self.opts.frontend_auth))
-            r_json = r.json()
+            r_json = self.fetch_waiting()
 
         except requests.RequestException as e:
             self.event("Error retrieving jobs from {0}: {1}".format(
@@ -96,6 +174,9 @@ class CoprJobGrab(multiprocessing.Process):
                        .format(e))
             return
 
+        if r_json is None:
+            return
+
         if "builds" in r_json and r_json["builds"]:
             self.event("{0} jobs returned".format(len(r_json["builds"])))
             count = 0
@@ -106,9 +187,8 @@ class CoprJobGrab(multiprocessing.Process):
                     arch = task["chroot"].split("-")[2]
                     for group in self.opts.build_groups:
                         if arch in group["archs"]:
-                            self.added_jobs.append(task["task_id"])
-                            task_obj = Task(task)
-                            self.task_queues[group["id"]].enqueue(task_obj)
+                            self.added_jobs.add(task["task_id"])
+                            self.schedulers[group["id"]].add(task)
                             count += 1
                             break
             if count:
@@ -118,20 +198,101 @@ class CoprJobGrab(multiprocessing.Process):
             self.event("{0} actions returned".format(
                 len(r_json["actions"])))
 
-            for action in r_json["actions"]:
-                ao = Action(self.events, action, self.lock, destdir=self.opts.destdir,
-                            frontend_callback=FrontendCallback(self.opts, self.events),
-                            front_url=self.opts.frontend_base_url,
-                            results_root_url=self.opts.results_baseurl)
-                ao.run()
+            self.enqueue_actions(r_json["actions"])
+
+    def enqueue_actions(self, actions):
+        """
+        Hand actions over to ActionExecutor.  When the executor falls behind
+        by more than `actions_queue_limit` actions, the rest is left
+        in the frontend and fetched again later.
+        """
+        count = 0
+        for num, action in enumerate(actions):
+            if action["id"] in self.added_actions:
+                continue
+
+            if self.actions_queue.length >= self.opts.actions_queue_limit:
+                postponed = [a["id"] for a in actions[num:]
+                             if a["id"] not in self.added_actions]
+                self.event("Actions queue is full, postponing {0} actions"
+                           .format(len(postponed)))
+                self.actions_cursor = min(self.actions_cursor, min(postponed) - 1)
+                # make the next fetch return them again
+                self.etag = None
+                break
+
+            self.added_actions.add(action["id"])
+            self.actions_queue.enqueue(Task({"action": action,
+                                             "enqueued_on": time.time()}))
+            count += 1
+
+        if count:
+            self.event("New actions: {0}".format(count))
+
+    def feed_queues(self):
+        """
+        Move tasks from schedulers into task queues, keep at most
+        `scheduler_queue_depth` (default group max_workers) tasks queued
+        """
+        for group in self.opts.build_groups:
+            queue = self.task_queues[group["id"]]
+            scheduler = self.schedulers[group["id"]]
+            # dispatched task can't run longer, its worker probably died
+            scheduler.expire_running(2 * self.opts.timeout)
+
+            depth = self.opts.scheduler_queue_depth or group["max_workers"]
+            while len(scheduler) and queue.length < depth:
+                task = scheduler.pop()
+                if task is None:
+                    # all owners with waiting tasks are at their limit
+                    break
+                queue.enqueue(Task(task))
+
+            queue.rdb.set(scheduled_key(group["id"]), len(scheduler))
+
+    def handle_wakeup(self, message):
+        """
+        :param dict message: sent by worker after each job, fields:
+            - group_id, task_id: finished task
+            - drained: True when the worker found its queue empty
+            or by ActionExecutor:
+            - failed_actions: ids of actions to be fetched again
+        """
+        if "task_id" in message and message.get("group_id") in self.schedulers:
+            self.schedulers[message["group_id"]].task_finished(message["task_id"])
+        failed_actions = message.get("failed_actions")
+        if failed_actions:
+            for action_id in failed_actions:
+                self.added_actions.discard(action_id)
+            # retried on the next regular poll
+            self.actions_cursor = min(self.actions_cursor, min(failed_actions) - 1)
+            self.etag = None
+        if message.get("drained"):
+            self.poll_now = True
+
+    def wait_for_wakeup(self):
+        """
+        Sleep up to `sleeptime` seconds, return earlier when some worker
+        finished a job
+        """
+        task = self.wakeup_queue.wait(self.opts.sleeptime)
+        # coalesce wake-ups sent by several workers at once
+        while task:
+            self.handle_wakeup(task.data)
+            task = self.wakeup_queue.dequeue()
 
     def run(self):
         setproctitle.setproctitle("CoprJobGrab")
         abort = False
         try:
             while not abort:
-                self.load_tasks()
-                time.sleep(self.opts.sleeptime)
+                if self.poll_now or \
+                        time.time() - self.last_poll >= self.opts.sleeptime:
+                    self.poll_now = False
+                    self.last_poll = time.time()
+                    self.load_tasks()
+                self.feed_queues()
+                self.wait_for_wakeup()
         except KeyboardInterrupt:
             return
 
@@ -208,12 +369,19 @@ class CoprBackend(object):
         self.ext_opts = ext_opts  # to stow our cli options for read_conf()
         self.workers_by_group_id = defaultdict(list)
         self.max_worker_num_by_group_id = defaultdict(int)
+        # poison pills sent and not yet taken by workers
+        self.retiring_by_group_id = defaultdict(int)
+        self.autoscalers = {}
+        self.pool_managers = []
 
         self.config_reader = BackendConfigReader(self.config_file, self.ext_opts)
         self.opts = None
         self.update_conf()
 
-        self.lock = multiprocessing.Lock()
+        # inherited by all the backend processes
+        if self.opts.ssh_control_persist:
+            setup_ssh_control(self.opts.ssh_control_dir,
+                              self.opts.ssh_control_persist)
 
         self.task_queues = []
         try:
@@ -224,6 +392,10 @@ class CoprBackend(object):
         except ConnectionError:
             raise CoprBackendError(
                 "Could not connect to a task queue. Is Redis running?")
+        self.actions_queue = Queue(ACTIONS_QUEUE)
+        self.actions_queue.connect()
+        self.createrepo_queue = Queue(CREATEREPO_QUEUE)
+        self.createrepo_queue.connect()
 
         # make sure there is nothing in our task queues
         self.clean_task_queues()
@@ -238,10 +410,32 @@ class CoprBackend(object):
 
         self.event("Starting up Job Grabber")
         # create job grabber
-        self._jobgrab = CoprJobGrab(self.opts, self.events, self.lock)
+        self._jobgrab = CoprJobGrab(self.opts, self.events)
         self._jobgrab.start()
         self.abort = False
 
+        self.event("Starting up Action Executor")
+        self._action_executor = ActionExecutor(self.opts, self.events)
+        self._action_executor.start()
+
+        self._createrepo_service = None
+        if self.opts.createrepo_debounce:
+            self.event("Starting up Createrepo Service")
+            self._createrepo_service = CreaterepoService(self.opts, self.events)
+            self._createrepo_service.start()
+
+        self.event("Starting up Trash Reaper")
+        self._trash_reaper = TrashReaper(self.opts, self.events)
+        self._trash_reaper.start()
+
+        for group in self.opts.build_groups:
+            if group["pool_min_idle"]:
+                self.event("Starting up builder pool manager for {0}"
+                           .format(group["name"]))
+                manager = BuilderPoolManager(self.opts, self.events, group["id"])
+                self.pool_managers.append(manager)
+                manager.start()
+
         if not os.path.exists(self.opts.worker_logdir):
             os.makedirs(self.opts.worker_logdir, mode=0o750)
 
@@ -253,7 +447,8 @@ class CoprBackend(object):
 
     def clean_task_queues(self):
         try:
-            for queue in self.task_queues:
+            for queue in self.task_queues + [self.actions_queue,
+                                             self.createrepo_queue]:
                 while queue.length:
                     queue.dequeue()
         except ConnectionError:
@@ -268,35 +463,60 @@ class CoprBackend(object):
 
             for group in self.opts.build_groups:
                 group_id = group["id"]
+                queue = self.task_queues[group_id]
+                # tasks held back by the job grabber scheduler are backlog too
+                queue_length = queue.length + \
+                    int(queue.rdb.get(scheduled_key(group_id)) or 0)
                 self.event(
                     "# jobs in {0} queue: {1}"
-                    .format(group["name"], self.task_queues[group_id].length)
+                    .format(group["name"], queue_length)
                 )
+
+                if group_id not in self.autoscalers:
+                    self.autoscalers[group_id] = WorkerAutoscaler(self.opts, group)
+                autoscaler = self.autoscalers[group_id]
+                autoscaler.update(self.opts, group)
+
+                active = len(self.workers_by_group_id[group_id]) - \
+                    self.retiring_by_group_id[group_id]
+                desired = autoscaler.desired_workers(
+                    active, queue_length,
+                    get_job_durations(queue.rdb, group_id))
+
                 # this handles starting/growing the number of workers
-                if len(self.workers_by_group_id[group_id]) < group["max_workers"]:
+                if active < desired:
                     self.event("Spinning up more workers")
-                    for _ in range(group["max_workers"] - len(self.workers_by_group_id[group_id])):
+                    for _ in range(desired - active):
                         self.max_worker_num_by_group_id[group_id] += 1
                         w = Worker(
                             self.opts, self.events,
                             self.max_worker_num_by_group_id[group_id],
-                            group_id, lock=self.lock
+                            group_id
                         )
 
                         self.workers_by_group_id[group_id].append(w)
                         w.start()
-                self.event("Finished starting worker processes")
-                # FIXME - prune out workers
-                # if len(self.workers) > self.opts.num_workers:
-                #    killnum = len(self.workers) - self.opts.num_workers
-                #    for w in self.workers[:killnum]:
-                # insert a poison pill? Kill after something? I dunno.
+                    self.event("Finished starting worker processes")
+
+                # idle worker takes the pill from the queue and exits
+                elif active > desired:
+                    self.event("Retiring {0} worker(s) in {1}"
+                               .format(active - desired, group["name"]))
+                    for _ in range(active - desired):
+                        queue.enqueue(poison_pill())
+                        self.retiring_by_group_id[group_id] += 1
+
                 # FIXME - if a worker bombs out - we need to check them
                 # and startup a new one if it happens
                 # check for dead workers and abort
                 preserved_workers = []
                 for w in self.workers_by_group_id[group_id]:
                     if not w.is_alive():
+                        if w.exitcode == 0 and self.retiring_by_group_id[group_id]:
+                            self.event("Worker {0} retired".format(w.worker_num))
+                            self.retiring_by_group_id[group_id] -= 1
+                            continue
+
                         self.event("Worker {0} died unexpectedly".format(w.worker_num))
                         if self.opts.exit_on_worker:
                             raise CoprBackendError(
@@ -321,6 +541,12 @@ class CoprBackend(object):
             for w in self.workers_by_group_id[group_id]:
                 self.workers_by_group_id[group_id].remove(w)
                 w.terminate()
+        for manager in self.pool_managers:
+            manager.terminate()
+        self._action_executor.terminate()
+        if self._createrepo_service:
+            self._createrepo_service.terminate()
+        self._trash_reaper.terminate()
         self.clean_task_queues()
 
 
@@ -4,71 +4,81 @@ from __future__ import division
 from __future__ import absolute_import
 
 import os
+import time
 import logging
-from subprocess import Popen, PIPE
+import multiprocessing
 
 from copr.client.exceptions import CoprException, CoprRequestException
 
 from backend.helpers import BackendConfigReader, get_auto_createrepo_status
-from backend.createrepo import createrepo_unsafe
+from backend.prune import DEF_DAYS, PruneIndex, newest_build_time
+from backend.prune import prune_project as prune_project_dir
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
-DEF_DAYS = 14
-DEF_PRUNE_SCRIPT = "copr_prune_old_builds.sh"
-DEF_PRUNE_SCRIPT = "/usr/sbin/copr_prune_old_builds.sh"
+# save the index every N pruned projects, so an interrupted run isn't lost
+INDEX_SAVE_INTERVAL = 100
 
 
 def list_subdir(path):
-    dir_names = [d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d))]
+    dir_names = [d for d in os.listdir(path)
+                 if not d.startswith(".") and os.path.isdir(os.path.join(path, d))]
     return dir_names, map(lambda x: os.path.join(path, x), dir_names)
 
 
 def prune_project(opts, path, username, projectname):
+    """
+    Executed in the pool worker process
+
+    :return tuple: (project, pruned_on, newest build time, auto_createrepo)
+        for the index, None when the project wasn't pruned
+    """
     log.debug("Going to prune {}/{}".format(username, projectname))
     # get ACR
     try:
-        if not get_auto_createrepo_status(opts.frontend_base_url, username, projectname):
+        checked_on = time.time()
+        if not get_auto_createrepo_status(opts.frontend_base_url, username, projectname,
+                                          opts.auto_createrepo_cache_ttl):
             log.debug("Skipped {}/{} since auto createrepo option is disabled"
                       .format(username, projectname))
-            return
+            # remembered, so the frontend isn't asked on every run
+            return ("{}/{}".format(username, projectname), checked_on,
+                    newest_build_time(path), False)
     except (CoprException, CoprRequestException) as exception:
         log.debug("Failed to get project details for {}/{} with error: {}".format(
             username, projectname, exception))
-        return
+        return None
 
-    # run prune project sh
-    days = getattr(opts, "prune_days", DEF_DAYS)
-    prune_script = getattr(opts, "prune_script", DEF_PRUNE_SCRIPT)
+    days = opts.prune_days or DEF_DAYS
+    pruned_on = time.time()
+    try:
+        removed, errors = prune_project_dir(
+            path, days, coalesce=bool(opts.createrepo_debounce),
+            trash_dir=opts.trash_dir)
+    except Exception as exception:
+        print("Failed to prune old builds for copr {}/{}: {}"
+              .format(username, projectname, exception))
+        return None
 
-    cmd = map(str, [prune_script, path, days])
+    log.debug("Prune done for {}/{}, removed {} directories"
+              .format(username, projectname, len(removed)))
+    if errors:
+        print("Createrepo for {}/{} failed".format(username, projectname))
+        print("STDERR: \n{}".format("\n".join(errors)))
+        return None
 
-    handle = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = handle.communicate()
+    return "{}/{}".format(username, projectname), pruned_on, newest_build_time(path), True
 
-    if handle.returncode != 0:
-        print("Failed to prune old builds for copr {}/{}".format(username, projectname))
-        print("STDOUT: \n{}".format(stdout.decode()))
-        print("STDERR: \n{}".format(stderr.decode()))
-        return
 
-    # run createrepo
-    log.debug("Prune done for {}/{}".format(username, projectname))
-    try:
-        retcode, stdout, stderr = createrepo_unsafe(path)
-        if retcode != 0:
-            print("Createrepo for {}/{} failed".format(username, projectname))
-            print("STDOUT: \n{}".format(stdout.decode()))
-            print("STDERR: \n{}".format(stderr.decode()))
-    except Exception as exception:
-        print("Createrepo for {}/{} failed with error: {}"
-              .format(username, projectname, exception))
+def _prune_project_star(args):
+    return prune_project(*args)
 
 
 def main():
     config_file = os.environ.get("BACKEND_CONFIG", "/etc/copr/copr-be.conf")
     opts = BackendConfigReader(config_file).read()
+    days = opts.prune_days or DEF_DAYS
 
     results_dir = opts.destdir
     log.info("Pruning results dir: {} ".format(results_dir))
@@ -77,15 +87,35 @@ def main():
     print("Going to process total number: {} of user's directories".format(len(user_dir_names)))
     log.info("Going to process user's directories: {}".format(user_dir_names))
 
-    counter = 0
+    index = PruneIndex(opts.prune_index).load()
+
+    tasks = []
+    skipped = 0
     for username, subpath in zip(user_dir_names, user_dirs):
         log.debug("For user `{}` exploring path: {}".format(username, subpath))
         for projectname, project_path in zip(*list_subdir(subpath)):
-            log.debug("Exploring project `{}` with path: {}".format(projectname, project_path))
-            prune_project(opts, project_path, username, projectname)
+            project = "{}/{}".format(username, projectname)
+            if index.is_untouched(project, newest_build_time(project_path), days):
+                skipped += 1
+                continue
+            tasks.append((opts, project_path, username, projectname))
 
+    print("Skipped {} untouched projects, going to prune {} projects"
+          .format(skipped, len(tasks)))
+
+    pool = multiprocessing.Pool(opts.prune_workers)
+    counter = 0
+    try:
+        for result in pool.imap_unordered(_prune_project_star, tasks):
             counter += 1
-            print("Pruned {} projects".format(counter))
+            if result:
+                index.update(*result)
+            if counter % INDEX_SAVE_INTERVAL == 0:
+                index.save()
+                print("Pruned {} projects".format(counter))
+    finally:
+        pool.terminate()
+        index.save()
 
     print("Pruning finished")
 
@@ -29,7 +29,7 @@ import logging
 # log = logging.getLogger()
 # log.info("Logger initiated")
 
-from backend.actions import Action, ActionType, ActionResult
+from backend.actions import Action, ActionType, ActionResult, DeleteBuildsBatch
 
 import multiprocessing
 if six.PY3:
@@ -300,6 +300,27 @@ class TestAction(object):
 
         assert not os.path.exists(os.path.join(tmp_dir, "old_dir"))
 
+    @mock.patch("backend.actions.invalidate_pubkey")
+    def test_action_run_delete_copr_pubkey(self, mc_invalidate, mc_time):
+        mc_time.time.return_value = self.test_time
+        tmp_dir = self.make_temp_dir()
+
+        test_action = Action(
+            action={
+                "action_type": ActionType.DELETE,
+                "object_type": "copr",
+                "id": 6,
+                "old_value": "foo/bar",
+            },
+            events=self.test_q, lock=None,
+            frontend_callback=MagicMock(),
+            destdir=tmp_dir,
+            front_url=None,
+            results_root_url=RESULTS_ROOT_URL
+        )
+        test_action.run()
+        assert mc_invalidate.call_args == mock.call("foo", "bar")
+
     def test_delete_no_chroot_dirs(self, mc_time):
         mc_time.time.return_value = self.test_time
         mc_front_cb = MagicMock()
@@ -402,7 +423,6 @@ class TestAction(object):
             assert_what_from_queue(self.test_q, msg_list=[
                 "Removing build ",
                 "Package bar dir not found in chroot fedora20",
-                "Running createrepo",
             ])
 
         ev = self.test_q.get_nowait()
@@ -420,6 +440,8 @@ class TestAction(object):
             assert_what_from_queue(self.test_q, msg_list=["In chroot epel7"])
             assert_epel7()
 
+        assert_what_from_queue(self.test_q, msg_list=["Running createrepo"])
+
         with pytest.raises(EmptyQueue):
             self.test_q.get_nowait()
 
@@ -429,7 +451,9 @@ class TestAction(object):
             base_url=u'http://example.com/results/foo/bar/fedora20',
             lock=None,
             path='{}/old_dir/fedora20'.format(self.tmp_dir_name),
-            front_url=None
+            front_url=None,
+            coalesce=False,
+            cache_ttl=0
         )
         assert mc_createrepo.call_args == create_repo_expected_call
 
@@ -479,6 +503,44 @@ class TestAction(object):
 
         assert error_event_recorded
 
+    @mock.patch("backend.actions.createrepo")
+    def test_delete_builds_batch(self, mc_createrepo, mc_time):
+        mc_time.time.return_value = self.test_time
+        mc_front_cb = MagicMock()
+        mc_createrepo.return_value = (0, "", "")
+
+        tmp_dir = self.make_temp_dir()
+        for chroot in ["fedora20", "epel7"]:
+            for pkg in ["foo", "bar", "baz"]:
+                os.makedirs(os.path.join(tmp_dir, "old_dir", chroot, pkg))
+
+        actions = [{
+            "action_type": ActionType.DELETE,
+            "object_type": "build-succeeded",
+            "id": action_id,
+            "old_value": "old_dir",
+            "data": json.dumps({"pkgs": pkgs, "username": "foo", "projectname": "bar"}),
+            "object_id": action_id,
+        } for action_id, pkgs in [(7, "foo.src.rpm"), (8, "bar.src.rpm"),
+                                  (9, "missing.src.rpm")]]
+
+        DeleteBuildsBatch(self.test_q, actions, None, frontend_callback=mc_front_cb,
+                          destdir=tmp_dir, front_url=None,
+                          results_root_url=RESULTS_ROOT_URL).run()
+
+        for chroot in ["fedora20", "epel7"]:
+            assert os.path.isdir(os.path.join(tmp_dir, "old_dir", chroot, "baz"))
+            assert not os.path.exists(os.path.join(tmp_dir, "old_dir", chroot, "foo"))
+            assert not os.path.exists(os.path.join(tmp_dir, "old_dir", chroot, "bar"))
+
+        assert sorted(call[1]["path"] for call in mc_createrepo.call_args_list) == [
+            os.path.join(tmp_dir, "old_dir", chroot) for chroot in ["epel7", "fedora20"]]
+
+        assert mc_front_cb.update.call_count == 1
+        results = mc_front_cb.update.call_args[0][0]["actions"]
+        assert [(r.id, r.result) for r in results] == \
+            [(7, ActionResult.SUCCESS), (8, ActionResult.SUCCESS), (9, ActionResult.SUCCESS)]
+
 
 def assert_what_from_queue(q, msg_list, who="action"):
     for msg in msg_list:
@@ -0,0 +1,182 @@
+import json
+
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+from bunch import Bunch
+from retask.task import Task
+
+from backend.actions import ActionType
+from backend.action_executor import ActionExecutor, action_projects, run_action, \
+    run_delete_builds
+
+if six.PY3:
+    import queue
+else:
+    import Queue as queue
+
+
+def make_action(action_id, action_type=ActionType.DELETE, old_value="foo/bar",
+                new_value=None, data=None, object_type="copr"):
+    return {"id": action_id, "action_type": action_type, "object_type": object_type,
+            "old_value": old_value, "new_value": new_value, "data": data}
+
+
+def make_build_deletion(action_id, old_value="foo/bar"):
+    return make_action(action_id, old_value=old_value, object_type="build-succeeded")
+
+
+def test_action_projects():
+    assert action_projects(make_action(1)) == {"foo/bar"}
+    assert action_projects(make_action(
+        1, ActionType.RENAME, "foo/bar", "foo/baz")) == {"foo/bar", "foo/baz"}
+    assert action_projects(make_action(
+        1, ActionType.CREATEREPO, old_value=None,
+        data=json.dumps({"username": "foo", "projectname": "bar",
+                         "chroots": []}))) == {"foo/bar"}
+    assert action_projects(make_action(1, ActionType.LEGAL_FLAG, None)) == set()
+
+
+class TestActionExecutor(object):
+
+    def setup_method(self, method):
+        self.opts = Bunch(
+            sleeptime=1,
+            actions_workers=2,
+            actions_stats_interval=300,
+        )
+        self.events = queue.Queue()
+        with mock.patch("backend.action_executor.Queue"):
+            self.executor = ActionExecutor(self.opts, self.events)
+        self.executor.pool = MagicMock()
+
+    def add_pending(self, *actions):
+        for action in actions:
+            self.executor.pending.append({"action": action, "enqueued_on": 0})
+
+    def started_ids(self):
+        return [call[0][1][0]["id"]
+                for call in self.executor.pool.apply_async.call_args_list]
+
+    def test_fetch_actions(self):
+        self.opts.actions_workers = 1
+        task = Task({"action": make_action(1), "enqueued_on": 0})
+        self.executor.queue.dequeue.return_value = task
+
+        self.executor.fetch_actions()
+        # stops at max_pending
+        assert len(self.executor.pending) == self.executor.PENDING_PER_WORKER
+
+    def test_start_runnable_serializes_project(self):
+        self.add_pending(make_action(1, old_value="foo/bar"),
+                         make_action(2, old_value="foo/bar"),
+                         make_action(3, old_value="foo/baz"))
+        self.executor.start_runnable()
+
+        assert self.started_ids() == [1, 3]
+        assert [item["action"]["id"] for item in self.executor.pending] == [2]
+        assert self.executor.busy_projects == {"foo/bar", "foo/baz"}
+
+    def test_start_runnable_worker_limit(self):
+        self.add_pending(make_action(1, old_value="a/a"),
+                         make_action(2, old_value="b/b"),
+                         make_action(3, old_value="c/c"))
+        self.executor.start_runnable()
+        assert self.started_ids() == [1, 2]
+
+    def test_start_runnable_keeps_order(self):
+        # rename a -> b must wait for a, so a later action on b must wait too
+        self.executor.busy_projects = {"foo/a"}
+        self.add_pending(make_action(1, ActionType.RENAME, "foo/a", "foo/b"),
+                         make_action(2, old_value="foo/b"),
+                         make_action(3, ActionType.LEGAL_FLAG, None))
+        self.executor.start_runnable()
+        assert self.started_ids() == [3]
+
+    def test_start_runnable_batches_build_deletions(self):
+        self.add_pending(make_build_deletion(1),
+                         make_build_deletion(2, old_value="foo/baz"),
+                         make_build_deletion(3),
+                         make_action(4, ActionType.LEGAL_FLAG, None),
+                         make_build_deletion(5),
+                         make_action(6, ActionType.CREATEREPO, None, data=json.dumps(
+                             {"username": "foo", "projectname": "bar", "chroots": []})),
+                         make_build_deletion(7))
+        self.executor.start_runnable()
+
+        calls = self.executor.pool.apply_async.call_args_list
+        assert calls[0] == mock.call(run_delete_builds, ([make_build_deletion(1),
+                                                          make_build_deletion(3),
+                                                          make_build_deletion(5)],))
+        assert calls[1] == mock.call(run_action, (make_build_deletion(2, "foo/baz"),))
+        # createrepo in between keeps the later deletion out of the batch
+        assert [item["action"]["id"] for item in self.executor.pending] == [4, 6, 7]
+
+        result = self.executor.pool.apply_async.return_value
+        result.ready.return_value = True
+        result.get.return_value = 1.0
+        self.executor.collect_finished()
+        assert self.executor.stats["done"] == 4
+        assert len(self.executor.stats["wait"]) == 4
+
+    def test_collect_finished(self):
+        self.add_pending(make_action(1), make_action(2))
+        self.executor.start_runnable()
+        result = self.executor.pool.apply_async.return_value
+        result.ready.return_value = True
+        result.get.return_value = 2.5
+
+        self.executor.collect_finished()
+        assert self.executor.running == {}
+        assert self.executor.busy_projects == set()
+        assert self.executor.stats["done"] == 1
+        assert self.executor.stats["run"] == [2.5]
+
+        self.executor.start_runnable()
+        result.get.side_effect = OSError("rmtree failed")
+        self.executor.collect_finished()
+        assert self.executor.stats["failed"] == 1
+        assert self.executor.stats["done"] == 1
+        assert self.executor.busy_projects == set()
+        # job grabber is asked to fetch the failed action again
+        message = self.executor.jobgrab_wakeup.enqueue.call_args[0][0].data
+        assert message["failed_actions"] == [2]
+
+    def test_report_stats(self):
+        self.executor.stats["wait"] = [1.0, 3.0]
+        self.executor.stats["run"] = [10.0]
+        self.executor.stats["done"] = 2
+        self.executor.queue.length = 5
+
+        self.executor.report_stats(now=self.executor.stats["since"] + 10)
+        assert self.events.empty()
+
+        self.executor.report_stats(now=self.executor.stats["since"] + 300)
+        what = self.events.get()["what"]
+        assert "done: 2" in what
+        assert "wait avg/max: 2.0/3.0s" in what
+        assert "queued: 5" in what
+        assert self.executor.stats["done"] == 0
+
+
+@mock.patch("backend.action_executor.get_redis_connection")
+@mock.patch("backend.action_executor.Action")
+def test_run_action(mc_action, mc_rdb):
+    opts = Bunch(destdir="/tmp", frontend_url="http://example.com/backend",
+                 frontend_auth="secret", frontend_base_url="http://example.com",
+                 results_baseurl="http://example.com/results", createrepo_debounce=5,
+                 auto_createrepo_cache_ttl=600, trash_dir=None)
+    with mock.patch.dict("backend.action_executor._pool_state",
+                         {"opts": opts, "events": queue.Queue()}):
+        assert run_action(make_action(1)) >= 0
+    assert mc_action.return_value.run.called
+    assert mc_action.call_args[0][1] == make_action(1)
+    # settings are read again only after the action has run
+    assert mc_rdb.return_value.delete.call_args == \
+        mock.call("copr-be-auto-createrepo-foo/bar")
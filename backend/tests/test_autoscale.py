@@ -0,0 +1,55 @@
+import six
+
+if six.PY3:
+    from unittest.mock import MagicMock
+else:
+    from mock import MagicMock
+
+from bunch import Bunch
+from retask.task import Task
+
+from backend.autoscale import WorkerAutoscaler, poison_pill, is_poison_pill, \
+    record_job_duration, DURATION_HISTORY
+
+
+class TestWorkerAutoscaler(object):
+
+    def setup_method(self, method):
+        self.opts = Bunch(autoscale_drain_time=3600, autoscale_idle_time=600)
+        self.group = {"id": 0, "min_workers": 2, "max_workers": 10}
+        self.scaler = WorkerAutoscaler(self.opts, self.group)
+
+    def test_disabled(self):
+        self.group["min_workers"] = 10
+        assert self.scaler.desired_workers(3, 0, [], now=1000) == 10
+
+    def test_scale_up(self):
+        # 20 jobs * 30 min = 10 hours of work, 3600 s to drain
+        assert self.scaler.desired_workers(2, 20, [1800] * 5, now=1000) == 10
+        assert self.scaler.desired_workers(2, 8, [1800] * 5, now=1000) == 4
+        # never scale down while there is a backlog
+        assert self.scaler.desired_workers(6, 1, [60], now=1000) == 6
+
+    def test_scale_down_after_idle_time(self):
+        assert self.scaler.desired_workers(5, 0, [], now=1000) == 5
+        assert self.scaler.desired_workers(5, 0, [], now=1500) == 5
+        assert self.scaler.desired_workers(5, 0, [], now=1700) == 4
+        assert self.scaler.desired_workers(4, 0, [], now=1710) == 3
+        assert self.scaler.desired_workers(2, 0, [], now=1720) == 2
+
+    def test_backlog_resets_idle_timer(self):
+        self.scaler.desired_workers(5, 0, [], now=1000)
+        self.scaler.desired_workers(5, 3, [], now=1500)
+        assert self.scaler.desired_workers(5, 0, [], now=1700) == 5
+
+
+def test_poison_pill():
+    assert is_poison_pill(poison_pill())
+    assert not is_poison_pill(Task({"build_id": 1}))
+
+
+def test_record_job_duration():
+    rdb = MagicMock()
+    record_job_duration(rdb, 1, 42.0)
+    assert rdb.lpush.call_args[0] == ("copr-be-1-durations", 42.0)
+    assert rdb.ltrim.call_args[0] == ("copr-be-1-durations", 0, DURATION_HISTORY - 1)
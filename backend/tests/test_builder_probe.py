@@ -0,0 +1,115 @@
+import os
+import json
+import shutil
+import tempfile
+
+import pytest
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+from backend import builder_probe
+from backend.exceptions import BuilderError
+from backend.mockremote import Builder, PROBE_MISSING_RC, _deployed_probes
+
+
+def fake_rpm_query(path, queryformat):
+    name = os.path.basename(path)
+    if name.endswith(".src.rpm"):
+        return "1.0\n"
+    return "{0} 1.0\n".format(name.split("-")[0])
+
+
+class TestPostBuild(object):
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        for name in ["foo-1.0-1.src.rpm", "foo-1.0-1.x86_64.rpm",
+                     "bar-1.0-1.x86_64.rpm", "build.log"]:
+            open(os.path.join(self.tmp_dir, name), "w").close()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    @mock.patch("backend.builder_probe.rpm_query", side_effect=fake_rpm_query)
+    def test_success(self, mc_rpm_query):
+        open(os.path.join(self.tmp_dir, "success"), "w").close()
+        facts = builder_probe.post_build("/tmp/foo-1.0-1.src.rpm", self.tmp_dir)
+        assert facts == {
+            "pkg_version": "1.0",
+            "success": True,
+            "built_packages": "bar 1.0\nfoo 1.0",
+        }
+
+    @mock.patch("backend.builder_probe.rpm_query")
+    def test_fail(self, mc_rpm_query):
+        mc_rpm_query.return_value = None
+        facts = builder_probe.post_build("/tmp/foo-1.0-1.src.rpm", self.tmp_dir)
+        assert facts == {"pkg_version": None, "success": False,
+                         "built_packages": None}
+        assert mc_rpm_query.call_count == 1
+
+    def test_usage(self, capsys):
+        assert builder_probe.main(["unknown"]) == 2
+
+
+def ans_results(hostname, **result):
+    return {"contacted": {hostname: result}, "dark": {}}
+
+
+class TestBuilderProbe(object):
+
+    def setup_method(self, method):
+        _deployed_probes.clear()
+        self.mockremote = MagicMock(remote_basedir="/var/tmp", remote_tempdir=None)
+        with mock.patch("backend.mockremote._create_ans_conn"), \
+                mock.patch.object(Builder, "check"):
+            self.builder = Builder("builder.example.com", "mockbuilder", 60,
+                                   "fedora-22-x86_64", self.mockremote, None)
+        self.conn = self.builder.conn
+
+    def test_probe(self):
+        facts = {"pkg_version": "1.0", "success": True, "built_packages": "foo 1.0"}
+        self.conn.run.side_effect = [
+            ans_results("builder.example.com", rc=0),
+            ans_results("builder.example.com", rc=0, stdout=json.dumps(facts)),
+            ans_results("builder.example.com", rc=0, stdout=json.dumps(facts)),
+        ]
+        assert self.builder.probe("post-build", "foo.src.rpm", "/res") == facts
+        # copied once per builder
+        assert self.builder.probe("post-build", "foo.src.rpm", "/res") == facts
+        assert self.conn.run.call_count == 3
+        assert self.conn.module_args.endswith("post-build foo.src.rpm /res")
+        assert self.builder.probe_path.startswith("/var/tmp/copr-builder-probe-")
+
+    def test_probe_redeploy(self):
+        _deployed_probes.add(("builder.example.com", "mockbuilder",
+                              self.builder.probe_path))
+        self.conn.run.side_effect = [
+            ans_results("builder.example.com", rc=PROBE_MISSING_RC),
+            ans_results("builder.example.com", rc=0),
+            ans_results("builder.example.com", rc=0, stdout="{}"),
+        ]
+        assert self.builder.probe("post-build", "foo.src.rpm", "/res") == {}
+        assert self.conn.run.call_count == 3
+
+    def test_probe_invalid_output(self):
+        self.conn.run.side_effect = [
+            ans_results("builder.example.com", rc=0),
+            ans_results("builder.example.com", rc=0, stdout="Traceback"),
+        ]
+        with pytest.raises(BuilderError):
+            self.builder.probe("post-build", "foo.src.rpm", "/res")
+
+    def test_tempdir_one_call(self):
+        self.conn.run.return_value = ans_results(
+            "builder.example.com", rc=0, stdout="/var/tmp/mockremote-abcde")
+        assert self.builder.tempdir == "/var/tmp/mockremote-abcde"
+        assert self.builder.tempdir == "/var/tmp/mockremote-abcde"
+        assert self.conn.run.call_count == 1
+        assert "chmod 755" in self.conn.module_args
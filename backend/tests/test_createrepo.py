@@ -22,7 +22,14 @@ else:
     from mock import MagicMock
 
 
-from backend.createrepo import createrepo, createrepo_unsafe
+from bunch import Bunch
+from retask.task import Task
+
+import fcntl
+
+from backend.createrepo import createrepo, createrepo_unsafe, CreaterepoService, \
+    RepoLock, BindingsEngine
+from backend.manifest import ChrootManifest
 
 
 @mock.patch('backend.createrepo.createrepo_unsafe')
@@ -52,7 +59,8 @@ def test_createrepo_conditional_false(mc_client, mc_create_unsafe):
     createrepo(path="/tmp/", front_url="http://example.com/api",
                username="foo", projectname="bar", base_url=base_url, lock=None)
 
-    assert mc_create_unsafe.call_args == mock.call('/tmp/', None, dest_dir='devel', base_url=base_url)
+    assert mc_create_unsafe.call_args == mock.call('/tmp/', None, dest_dir='devel', base_url=base_url,
+                                                   coalesce=False)
 
 
 @mock.patch('backend.createrepo.Popen')
@@ -178,3 +186,205 @@ class TestCreaterepoUnsafe(object):
     #
     #         createrepo_unsafe(path, lock=None, base_url=self.base_url, dest_dir="devel")
     #         assert os.path.exists(os.path.join(path, "devel"))
+
+
+def test_repo_lock():
+    tmp_dir = tempfile.mkdtemp()
+    lock_dir = os.path.join(tmp_dir, "locks")
+    repo = os.path.join(tmp_dir, "repo")
+    os.mkdir(repo)
+    try:
+        with mock.patch("backend.createrepo.REPO_LOCK_DIR", lock_dir):
+            lock = RepoLock(repo)
+            with lock:
+                with open(lock.lock_path) as handle:
+                    with pytest.raises(IOError):
+                        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+                # other repositories are not blocked
+                other = os.path.join(tmp_dir, "other")
+                os.mkdir(other)
+                with RepoLock(other):
+                    pass
+
+            with open(lock.lock_path) as handle:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # nothing is left in the (public) repository
+            assert os.listdir(repo) == []
+
+            # missing directory is not locked nor created
+            with RepoLock(os.path.join(tmp_dir, "missing")):
+                assert not os.path.exists(os.path.join(tmp_dir, "missing"))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@mock.patch('backend.createrepo.request_createrepo')
+@mock.patch('backend.createrepo.Popen')
+def test_createrepo_unsafe_coalesce(mc_popen, mc_request):
+    mc_request.return_value = (0, "out", "")
+    assert createrepo_unsafe("/tmp/", coalesce=True) == (0, "out", "")
+    assert mc_request.call_args == mock.call("/tmp/", None, None)
+    assert not mc_popen.called
+
+    # service didn't answer
+    mc_request.return_value = None
+    mc_popen.return_value.communicate.return_value = ("", "")
+    mc_popen.return_value.returncode = 0
+    assert createrepo_unsafe("/tmp/", coalesce=True) == (0, "", "")
+    assert mc_popen.called
+
+
+class TestCreaterepoService(object):
+
+    def setup_method(self, method):
+        self.opts = Bunch(sleeptime=10, createrepo_debounce=5,
+                          createrepo_engine="subprocess", createrepo_cache_repos=10)
+        self.events = MagicMock()
+        with mock.patch("backend.createrepo.Queue"):
+            self.service = CreaterepoService(self.opts, self.events)
+
+    @staticmethod
+    def request(path, dest_dir=None):
+        return Task({"path": path, "dest_dir": dest_dir, "base_url": None})
+
+    def test_debounce(self):
+        self.service.add_request(self.request("/a"), now=100)
+        self.service.add_request(self.request("/b"), now=103)
+        self.service.add_request(self.request("/a"), now=104)
+        self.service.add_request(self.request("/a", "devel"), now=104)
+
+        assert self.service.due_requests(now=104) == []
+        assert self.service.next_timeout(now=104) == 1
+        assert self.service.due_requests(now=105) == [("/a", None, None)]
+        assert self.service.next_timeout(now=101.5) == 4
+
+        assert len(self.service.pending[("/a", None, None)]["tasks"]) == 2
+
+    def test_next_timeout_empty(self):
+        assert self.service.next_timeout() == 10
+
+    @mock.patch("backend.createrepo.createrepo_unsafe")
+    def test_regenerate(self, mc_createrepo):
+        mc_createrepo.return_value = (0, "out", "")
+        tasks = [self.request("/a"), self.request("/a")]
+
+        self.service.regenerate(("/a", None, None), tasks)
+
+        assert mc_createrepo.call_count == 1
+        assert mc_createrepo.call_args == \
+            mock.call("/a", dest_dir=None, base_url=None)
+        assert self.service.queue.send.call_args_list == \
+            [mock.call(task, [0, "out", ""]) for task in tasks]
+
+    @mock.patch("backend.createrepo.createrepo_unsafe")
+    def test_regenerate_error(self, mc_createrepo):
+        mc_createrepo.side_effect = OSError("no createrepo_c")
+        task = self.request("/a")
+
+        self.service.regenerate(("/a", None, None), [task])
+        assert self.service.queue.send.call_args == \
+            mock.call(task, [1, "", "no createrepo_c"])
+
+    def test_bindings_engine(self):
+        self.opts.createrepo_engine = "bindings"
+        with mock.patch("backend.createrepo.Queue"):
+            service = CreaterepoService(self.opts, self.events)
+        service.engine = MagicMock()
+        service.engine.createrepo.return_value = (0, "", "")
+
+        service.regenerate(("/a", "devel", "http://example.com"), [self.request("/a")])
+        assert service.engine.createrepo.call_args == \
+            mock.call("/a", "devel", "http://example.com")
+
+
+@mock.patch("backend.createrepo.createrepo_unsafe")
+@mock.patch("backend.createrepo.cr")
+class TestBindingsEngine(object):
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.tmp_dir, "fedora-21-x86_64")
+        self.log = MagicMock()
+        self.engine = BindingsEngine(2, self.log)
+        for pkg in ["foo-1.0-1", "bar-1.0-1"]:
+            self.add_rpm(pkg)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def add_rpm(self, name):
+        pkg_dir = os.path.join(self.repo, name)
+        os.makedirs(pkg_dir)
+        for rpm in [name + ".src.rpm", name + ".x86_64.rpm"]:
+            with open(os.path.join(pkg_dir, rpm), "w") as handle:
+                handle.write(rpm)
+
+    @staticmethod
+    def read_rpms(mc_cr):
+        return sorted(call[1]["location_href"]
+                      for call in mc_cr.package_from_rpm.call_args_list)
+
+    def test_list_rpms_ignores_manifest(self, mc_cr, mc_unsafe):
+        ChrootManifest(self.repo).record_dir("foo-1.0-1")
+        assert sorted(self.engine.list_rpms(self.repo)) == [
+            "bar-1.0-1/bar-1.0-1.src.rpm", "bar-1.0-1/bar-1.0-1.x86_64.rpm",
+            "foo-1.0-1/foo-1.0-1.src.rpm", "foo-1.0-1/foo-1.0-1.x86_64.rpm"]
+
+    def test_incremental(self, mc_cr, mc_unsafe):
+        mc_cr.Repomd.return_value.xml_dump.return_value = "<repomd/>"
+        assert self.engine.createrepo(self.repo)[0] == 0
+        assert len(self.read_rpms(mc_cr)) == 4
+        assert os.path.exists(os.path.join(self.repo, "repodata", "repomd.xml"))
+
+        mc_cr.package_from_rpm.reset_mock()
+        self.add_rpm("baz-1.0-1")
+        assert self.engine.createrepo(self.repo)[0] == 0
+        assert self.read_rpms(mc_cr) == ["baz-1.0-1/baz-1.0-1.src.rpm",
+                                         "baz-1.0-1/baz-1.0-1.x86_64.rpm"]
+        # all six packages written into primary.xml
+        primary = mc_cr.PrimaryXmlFile.return_value
+        assert primary.set_num_of_pkgs.call_args == mock.call(6)
+        assert not mc_unsafe.called
+
+    def test_removed_rpms(self, mc_cr, mc_unsafe):
+        mc_cr.Repomd.return_value.xml_dump.return_value = "<repomd/>"
+        self.engine.createrepo(self.repo)
+        shutil.rmtree(os.path.join(self.repo, "foo-1.0-1"))
+
+        packages, read = self.engine.update_packages(self.repo)
+        assert len(packages) == 2
+        assert read == 0
+
+    def test_dest_dir(self, mc_cr, mc_unsafe):
+        mc_cr.Repomd.return_value.xml_dump.return_value = "<repomd/>"
+        self.engine.createrepo(self.repo, "devel", "http://example.com/repo")
+        assert os.path.exists(os.path.join(self.repo, "devel", "repodata", "repomd.xml"))
+        assert not os.path.exists(os.path.join(self.repo, "repodata"))
+
+    def test_cache_limit(self, mc_cr, mc_unsafe):
+        for name in ["a", "b", "c"]:
+            self.engine.get_cached(name)
+        assert list(self.engine.cache) == ["b", "c"]
+
+    def test_fallback(self, mc_cr, mc_unsafe):
+        mc_unsafe.return_value = (0, "", "")
+        mc_cr.package_from_rpm.side_effect = RuntimeError("broken rpm")
+
+        assert self.engine.createrepo(self.repo, "devel", "http://example.com") == (0, "", "")
+        assert mc_unsafe.call_args == mock.call(self.repo, dest_dir="devel",
+                                                base_url="http://example.com")
+        assert self.repo not in self.engine.cache
+        assert self.log.called
+
+    def test_fallback_epel_5(self, mc_cr, mc_unsafe):
+        self.engine.createrepo("/tmp/epel-5-x86_64")
+        assert mc_unsafe.called
+        assert not mc_cr.package_from_rpm.called
+
+
+@mock.patch("backend.createrepo.createrepo_unsafe")
+@mock.patch("backend.createrepo.cr", None)
+def test_bindings_engine_missing(mc_unsafe):
+    BindingsEngine(2, MagicMock()).createrepo("/tmp/foo")
+    assert mc_unsafe.call_args == mock.call("/tmp/foo", dest_dir=None, base_url=None)
@@ -0,0 +1,146 @@
+import json
+
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+from bunch import Bunch
+from retask.task import Task
+
+from backend.dispatcher import Worker
+
+if six.PY3:
+    import queue
+else:
+    import Queue as queue
+
+
+def raw_task(data):
+    return json.dumps(Task(data).__dict__)
+
+
+class TestBuilderReuse(object):
+
+    def setup_method(self, method):
+        self.opts = Bunch(
+            sleeptime=1,
+            blocking_dequeue=True,
+            spawn_in_advance=False,
+            frontend_url="http://example.com/backend",
+            frontend_auth="secret",
+            builder_reuse_max_jobs=3,
+            builder_reuse_max_time=1800,
+            ssh_control_dir="/tmp/ssh",
+            ssh_control_persist=600,
+            build_groups=[{"id": 0, "name": "PC", "pool_min_idle": 0}],
+        )
+        with mock.patch("backend.dispatcher.Queue"):
+            self.worker = Worker(self.opts, queue.Queue(), 1, 0,
+                                 callback=MagicMock())
+        self.worker.vm_provisioner = MagicMock()
+        self.worker.vm_provisioner.clean_builder.return_value = True
+
+        self.job = Bunch(chroot="fedora-21-x86_64", project_owner="foo")
+
+    def test_keep_builder(self):
+        assert self.worker.keep_builder(self.job, "1.2.3.4")
+        assert self.worker.kept_builder["ip"] == "1.2.3.4"
+        assert self.worker.vm_provisioner.clean_builder.call_args == \
+            mock.call("1.2.3.4")
+
+        assert self.worker.take_kept_builder(self.job) == "1.2.3.4"
+        assert self.worker.keep_builder(self.job, "1.2.3.4")
+        # third job is the last one
+        assert self.worker.take_kept_builder(self.job) == "1.2.3.4"
+        assert not self.worker.keep_builder(self.job, "1.2.3.4")
+        assert self.worker.kept_builder is None
+
+    def test_keep_builder_disabled(self):
+        self.opts.builder_reuse_max_jobs = 1
+        assert not self.worker.keep_builder(self.job, "1.2.3.4")
+        assert not self.worker.vm_provisioner.clean_builder.called
+
+    def test_keep_builder_clean_failed(self):
+        self.worker.vm_provisioner.clean_builder.return_value = False
+        assert not self.worker.keep_builder(self.job, "1.2.3.4")
+        assert self.worker.kept_builder is None
+
+    def test_take_kept_builder_other_owner(self):
+        self.worker.keep_builder(self.job, "1.2.3.4")
+        other = Bunch(chroot="fedora-21-x86_64", project_owner="bar")
+
+        assert self.worker.take_kept_builder(other) is None
+        assert self.worker.kept_builder is None
+        assert self.worker.vm_provisioner.terminate_instance.called
+
+    def test_take_kept_builder_expired(self):
+        self.worker.keep_builder(self.job, "1.2.3.4")
+        self.worker.kept_builder["since"] -= 3600
+        assert self.worker.take_kept_builder(self.job) is None
+
+    def test_take_matching_task(self):
+        self.worker.keep_builder(self.job, "1.2.3.4")
+        other_owner = {"chroot": "fedora-21-x86_64", "project_owner": "bar"}
+        other_chroot = {"chroot": "fedora-20-x86_64", "project_owner": "foo"}
+        matching = {"chroot": "fedora-21-x86_64", "project_owner": "foo"}
+
+        # the oldest task is at the end of the list
+        rdb = self.worker.task_queue.rdb
+        rdb.lrange.return_value = [raw_task(matching), raw_task(other_chroot),
+                                   raw_task(other_owner)]
+        rdb.execute_command.return_value = 1
+
+        task = self.worker.take_matching_task()
+        assert task.data == matching
+        assert rdb.execute_command.call_args[0][-1] == raw_task(matching)
+
+    def test_take_matching_task_none(self):
+        self.worker.keep_builder(self.job, "1.2.3.4")
+        rdb = self.worker.task_queue.rdb
+        rdb.lrange.return_value = [
+            raw_task({"chroot": "fedora-21-x86_64", "project_owner": "bar"}),
+            raw_task({"poison_pill": True}),
+        ]
+        assert self.worker.take_matching_task() is None
+        assert not rdb.execute_command.called
+
+        # task taken by another worker meanwhile
+        rdb.lrange.return_value = [
+            raw_task({"chroot": "fedora-21-x86_64", "project_owner": "foo"})]
+        rdb.execute_command.return_value = 0
+        assert self.worker.take_matching_task() is None
+
+
+@mock.patch("backend.dispatcher.record_job_duration")
+class TestAnnounceEnd(object):
+
+    def setup_method(self, method):
+        opts = Bunch(
+            sleeptime=1,
+            blocking_dequeue=True,
+            spawn_in_advance=False,
+            frontend_url="http://example.com/backend",
+            frontend_auth="secret",
+            build_groups=[{"id": 0, "name": "PC", "pool_min_idle": 0}],
+        )
+        with mock.patch("backend.dispatcher.Queue"):
+            self.worker = Worker(opts, queue.Queue(), 1, 0, callback=MagicMock())
+        self.worker.return_results = MagicMock()
+        self.job = MagicMock(started_on=1000.0)
+
+    def test_duration_recorded(self, mc_record):
+        self.job.status = 1
+        self.worker._announce_end(self.job, "1.2.3.4", ran_build=True)
+        assert mc_record.called
+        assert mc_record.call_args[0][1] == 0
+
+    def test_skipped_not_recorded(self, mc_record):
+        self.job.status = 5
+        self.worker._announce_end(self.job, ran_build=False)
+        assert not mc_record.called
+        assert self.worker.return_results.called
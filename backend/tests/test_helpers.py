@@ -0,0 +1,110 @@
+import six
+
+if six.PY3:
+    from unittest import mock
+else:
+    import mock
+
+import redis
+
+from backend.helpers import BoundedIdSet, get_auto_createrepo_status, \
+    invalidate_auto_createrepo_status
+
+
+class TestBoundedIdSet(object):
+
+    def test_add_contains(self):
+        ids = BoundedIdSet(max_size=10)
+        ids.add("1-fedora-21-x86_64")
+        assert "1-fedora-21-x86_64" in ids
+        assert "2-fedora-21-x86_64" not in ids
+        assert len(ids) == 1
+
+    def test_size_eviction(self):
+        ids = BoundedIdSet(max_size=3)
+        for i in range(5):
+            ids.add(i)
+
+        assert len(ids) == 3
+        assert 0 not in ids
+        assert 1 not in ids
+        assert all(i in ids for i in [2, 3, 4])
+
+    def test_readd_refreshes_position(self):
+        ids = BoundedIdSet(max_size=2)
+        ids.add(1)
+        ids.add(2)
+        ids.add(1)
+        ids.add(3)
+        assert 1 in ids
+        assert 2 not in ids
+
+    @mock.patch("backend.helpers.time")
+    def test_age_eviction(self, mc_time):
+        ids = BoundedIdSet(max_size=10, max_age=100)
+        mc_time.time.return_value = 1000
+        ids.add(1)
+        mc_time.time.return_value = 1050
+        ids.add(2)
+
+        mc_time.time.return_value = 1120
+        assert 1 not in ids
+        assert 2 in ids
+
+        mc_time.time.return_value = 1200
+        ids.add(3)
+        assert len(ids) == 1
+
+    def test_retain_and_discard(self):
+        ids = BoundedIdSet(max_size=10)
+        for i in range(5):
+            ids.add(i)
+
+        ids.retain([1, 3, 7])
+        assert sorted(ids._items) == [1, 3]
+
+        ids.discard(1)
+        ids.discard(42)
+        assert 1 not in ids
+        assert len(ids) == 1
+
+
+@mock.patch("backend.helpers.CoprClient")
+@mock.patch("backend.helpers.get_redis_connection")
+class TestAutoCreaterepoStatus(object):
+
+    def set_detail(self, mc_client, detail):
+        mc_client.return_value.get_project_details.return_value = \
+            mock.MagicMock(data={"detail": detail})
+
+    def test_no_cache(self, mc_redis, mc_client):
+        self.set_detail(mc_client, {"auto_createrepo": False})
+        assert not get_auto_createrepo_status("http://example.com", "foo", "bar")
+        assert not mc_redis.called
+
+    def test_cached(self, mc_redis, mc_client):
+        mc_redis.return_value.get.return_value = "0"
+        assert not get_auto_createrepo_status("http://example.com", "foo", "bar", 600)
+        assert not mc_client.called
+
+    def test_cache_miss(self, mc_redis, mc_client):
+        rdb = mc_redis.return_value
+        rdb.get.return_value = None
+        self.set_detail(mc_client, {})
+
+        assert get_auto_createrepo_status("http://example.com", "foo", "bar", 600)
+        assert rdb.set.call_args == mock.call(
+            "copr-be-auto-createrepo-foo/bar", 1, ex=600)
+
+    def test_redis_down(self, mc_redis, mc_client):
+        rdb = mc_redis.return_value
+        rdb.get.side_effect = redis.ConnectionError()
+        self.set_detail(mc_client, {"auto_createrepo": True})
+
+        assert get_auto_createrepo_status("http://example.com", "foo", "bar", 600)
+        assert not rdb.set.called
+
+    def test_invalidate(self, mc_redis, mc_client):
+        rdb = mock.MagicMock()
+        invalidate_auto_createrepo_status(rdb, "foo", "bar")
+        assert rdb.delete.call_args == mock.call("copr-be-auto-createrepo-foo/bar")
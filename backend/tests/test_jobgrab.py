@@ -0,0 +1,120 @@
+import imp
+import os
+
+import six
+from bunch import Bunch
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+
+copr_be = imp.load_source(
+    "copr_be", os.path.join(os.path.dirname(__file__), "..", "run", "copr-be.py"))
+
+
+def make_build(num, owner, project="proj"):
+    # task as listed by frontend /backend/waiting/
+    return {
+        "task_id": "{0}-fedora-21-x86_64".format(num),
+        "build_id": num,
+        "project_owner": owner,
+        "project_name": project,
+        "submitter": owner,
+        "pkgs": "http://example.com/foo.src.rpm",
+        "chroot": "fedora-21-x86_64",
+        "buildroot_pkgs": "",
+        "repos": "",
+        "memory_reqs": 2048,
+        "timeout": 3600,
+    }
+
+
+class TestCoprJobGrab(object):
+
+    def setup_method(self, method):
+        self.opts = Bunch(
+            frontend_url="http://example.com/backend",
+            frontend_auth="secret",
+            build_groups=[{"id": 0, "archs": ["i386", "x86_64"], "max_workers": 2}],
+            added_jobs_max_size=1000,
+            added_jobs_max_age=3600,
+            scheduler_owner_weights="bulk:10",
+            scheduler_owner_limit=0,
+            scheduler_queue_depth=0,
+            scheduler_bulk_threshold=2,
+            waiting_resync_interval=3600,
+            actions_queue_limit=100,
+            timeout=3600,
+        )
+        self.queues = {}
+        self.queue_patcher = mock.patch("copr_be.Queue", side_effect=self.make_queue)
+        self.queue_patcher.start()
+        self.jobgrab = copr_be.CoprJobGrab(self.opts, MagicMock())
+
+    def teardown_method(self, method):
+        self.queue_patcher.stop()
+
+    def make_queue(self, name):
+        queue = MagicMock(length=0)
+        self.queues[name] = queue
+        return queue
+
+    def enqueued(self, name):
+        return [call[0][0].data for call in self.queues[name].enqueue.call_args_list]
+
+    @mock.patch("copr_be.requests")
+    def test_small_owner_goes_before_bulk(self, mc_requests):
+        builds = [make_build(num, "bulk") for num in range(30)]
+        builds.extend(make_build(num, "small") for num in range(30, 32))
+        mc_requests.get.return_value = MagicMock(
+            status_code=200, headers={},
+            json=MagicMock(return_value={"builds": builds, "actions": []}))
+
+        self.jobgrab.load_tasks()
+        self.jobgrab.feed_queues()
+
+        owners = [task["project_owner"]
+                  for task in self.enqueued("copr-be-0")]
+        # frontend sends no priority, only the first two tasks of "bulk"
+        # compete with "small" despite the weight of "bulk"
+        assert owners[:4] == ["bulk", "small", "bulk", "small"]
+        assert len(owners) == 32
+
+    def test_failed_action_is_fetched_again(self):
+        self.jobgrab.actions_cursor = 10
+        self.jobgrab.etag = "etag"
+        for action_id in [5, 6, 7]:
+            self.jobgrab.added_actions.add(action_id)
+
+        self.jobgrab.handle_wakeup({"who": "action-executor",
+                                    "failed_actions": [6]})
+        assert 6 not in self.jobgrab.added_actions
+        assert 5 in self.jobgrab.added_actions
+        assert self.jobgrab.actions_cursor == 5
+        assert self.jobgrab.etag is None
+
+    @mock.patch("copr_be.requests")
+    def test_running_task_not_forgotten(self, mc_requests):
+        response = MagicMock(status_code=200, headers={})
+        mc_requests.get.return_value = response
+        build = make_build(1, "foo")
+
+        response.json.return_value = {"builds": [build], "actions": []}
+        self.jobgrab.load_tasks()
+        self.jobgrab.feed_queues()
+
+        # running task is missing in the full list, it must not be queued
+        # again once frontend lists it as running for too long
+        response.json.return_value = {"builds": [], "actions": []}
+        self.jobgrab.last_full_fetch = 0
+        self.jobgrab.load_tasks()
+        assert build["task_id"] in self.jobgrab.added_jobs
+
+        self.jobgrab.handle_wakeup({"group_id": 0, "task_id": build["task_id"]})
+        self.jobgrab.last_full_fetch = 0
+        self.jobgrab.load_tasks()
+        assert build["task_id"] not in self.jobgrab.added_jobs
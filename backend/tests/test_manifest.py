@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+
+import six
+
+if six.PY3:
+    from unittest import mock
+else:
+    import mock
+
+from backend import manifest
+from backend.manifest import ChrootManifest, get_manifest, lookup_package, \
+    file_checksum, MANIFEST_FILE
+
+
+class TestManifest(object):
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.chroot = os.path.join(self.tmp_dir, "fedora-22-x86_64")
+        os.makedirs(self.chroot)
+        manifest._manifests.clear()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+        manifest._manifests.clear()
+
+    def add_pkg(self, pkg, state):
+        pkg_path = os.path.join(self.chroot, pkg)
+        os.makedirs(pkg_path)
+        with open(os.path.join(pkg_path, pkg + ".x86_64.rpm"), "w") as handle:
+            handle.write("rpm")
+        open(os.path.join(pkg_path, "build.log"), "w").close()
+        if state:
+            open(os.path.join(pkg_path, state), "w").close()
+        return pkg_path
+
+    def test_lookup_without_manifest(self):
+        self.add_pkg("foo-1.0-1", "success")
+        self.add_pkg("bar-1.0-1", None)
+
+        assert lookup_package(self.chroot, "foo-1.0-1") == {
+            "exists": True, "state": "success", "rpms": ["foo-1.0-1.x86_64.rpm"]}
+        assert lookup_package(self.chroot, "bar-1.0-1")["state"] is None
+        assert lookup_package(self.chroot, "baz-1.0-1") == {
+            "exists": False, "state": None, "rpms": []}
+        assert not os.path.exists(os.path.join(self.chroot, MANIFEST_FILE))
+
+    def test_record_dir(self):
+        pkg_path = self.add_pkg("foo-1.0-1", "fail")
+        get_manifest(self.chroot).record_dir("foo-1.0-1")
+
+        entry = ChrootManifest(self.chroot).get("foo-1.0-1")
+        assert entry["state"] == "fail"
+        assert entry["rpms"] == {"foo-1.0-1.x86_64.rpm": file_checksum(
+            os.path.join(pkg_path, "foo-1.0-1.x86_64.rpm"))}
+
+        # answered from the manifest, no stat of the package dir
+        with mock.patch("backend.manifest.os.listdir") as mc_listdir:
+            assert lookup_package(self.chroot, "foo-1.0-1")["state"] == "fail"
+            assert not mc_listdir.called
+
+    def test_records_of_other_processes(self):
+        self.add_pkg("foo-1.0-1", "success")
+        reader = ChrootManifest(self.chroot)
+        writer = ChrootManifest(self.chroot)
+
+        assert reader.get("foo-1.0-1") is None
+        writer.record_dir("foo-1.0-1")
+        assert reader.get("foo-1.0-1")["state"] == "success"
+
+        writer.record_deleted(["foo-1.0-1"])
+        assert reader.get("foo-1.0-1")["state"] == "deleted"
+        assert lookup_package(self.chroot, "foo-1.0-1")["exists"] is False
+
+        # package being rebuilt is looked up on filesystem
+        writer.forget("foo-1.0-1")
+        assert reader.get("foo-1.0-1") is None
+        assert lookup_package(self.chroot, "foo-1.0-1")["exists"] is True
+
+    def test_partial_line_ignored(self):
+        mft = ChrootManifest(self.chroot)
+        mft.record("foo-1.0-1", "success")
+        with open(mft.path, "a") as handle:
+            handle.write('{"pkg": "bar-1.0-1", "sta')
+
+        assert mft.get("foo-1.0-1")["state"] == "success"
+        assert mft.get("bar-1.0-1") is None
+
+    def test_compact(self):
+        mft = ChrootManifest(self.chroot)
+        reader = ChrootManifest(self.chroot)
+        with mock.patch("backend.manifest.COMPACT_SLACK", 5):
+            for _ in range(10):
+                mft.record("foo-1.0-1", "success")
+            mft.record("bar-1.0-1", "fail")
+
+        with open(mft.path) as handle:
+            assert len(handle.readlines()) < 6
+        assert reader.get("foo-1.0-1")["state"] == "success"
+        assert reader.get("bar-1.0-1")["state"] == "fail"
+
+    def test_record_missing_chroot(self):
+        mft = ChrootManifest(os.path.join(self.tmp_dir, "missing"))
+        mft.record("foo-1.0-1", "success")
+        assert mft.get("foo-1.0-1") is None
+
+    def test_get_manifest_bounded(self):
+        with mock.patch("backend.manifest.MAX_CACHED_MANIFESTS", 2):
+            first = get_manifest(os.path.join(self.tmp_dir, "a"))
+            get_manifest(os.path.join(self.tmp_dir, "b"))
+            assert get_manifest(os.path.join(self.tmp_dir, "a")) is first
+            get_manifest(os.path.join(self.tmp_dir, "c"))
+
+        assert list(manifest._manifests) == [
+            os.path.join(self.tmp_dir, name) for name in ["a", "c"]]
@@ -0,0 +1,48 @@
+import itertools
+
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+from backend.mockremote import Builder, poll_intervals
+
+
+def test_poll_intervals():
+    intervals = poll_intervals(first=1, maximum=10)
+    assert list(itertools.islice(intervals, 6)) == [1, 2, 4, 8, 10, 10]
+
+
+class TestWaitForAsync(object):
+
+    def setup_method(self, method):
+        self.mockremote = MagicMock(poll_max_interval=5)
+        with mock.patch("backend.mockremote._create_ans_conn"), \
+                mock.patch.object(Builder, "check"):
+            self.builder = Builder("builder.example.com", "mockbuilder", 60,
+                                   "fedora-22-x86_64", self.mockremote, None)
+        self.poller = MagicMock()
+        self.running = {"contacted": {}, "dark": {}}
+        self.finished = {"contacted": {"builder.example.com": {"rc": 0}}, "dark": {}}
+
+    @mock.patch("backend.mockremote.time")
+    def test_backoff(self, mc_time):
+        mc_time.time.return_value = 1000
+        self.poller.poll.side_effect = [self.running] * 5 + [self.finished]
+
+        assert self.builder.wait_for_async(self.poller) == self.finished
+        assert [call[0][0] for call in mc_time.sleep.call_args_list] == \
+            [1, 2, 4, 5, 5]
+
+    @mock.patch("backend.mockremote.time")
+    def test_timeout(self, mc_time):
+        mc_time.time.side_effect = [1000, 1000, 1059, 1061]
+        self.poller.poll.return_value = self.running
+
+        assert self.builder.wait_for_async(self.poller) is None
+        # the last wait is cut to the timeout
+        assert [call[0][0] for call in mc_time.sleep.call_args_list] == [1, 1]
@@ -0,0 +1,178 @@
+import os
+import gzip
+import time
+import shutil
+import tempfile
+
+import pytest
+import six
+
+if six.PY3:
+    from unittest import mock
+else:
+    import mock
+
+from backend.prune import PruneIndex, prune_chroot, prune_project, latest_packages, \
+    label_compare, newest_build_time
+
+DAY = 24 * 3600
+
+REPOMD = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo">
+  <data type="primary">
+    <location href="repodata/primary.xml.gz"/>
+  </data>
+</repomd>
+"""
+
+PRIMARY_PKG = """
+  <package type="rpm">
+    <name>{name}</name>
+    <arch>x86_64</arch>
+    <version epoch="0" ver="{ver}" rel="1"/>
+    <location href="{build}/{name}-{ver}-1.x86_64.rpm"/>
+  </package>"""
+
+
+def add_build(chroot_path, build, name, ver, state, age_days):
+    build_path = os.path.join(chroot_path, build)
+    os.makedirs(build_path)
+    open(os.path.join(build_path, "{0}-{1}-1.x86_64.rpm".format(name, ver)), "w").close()
+    state_path = os.path.join(build_path, state)
+    open(state_path, "w").close()
+    finished = time.time() - age_days * DAY
+    os.utime(state_path, (finished, finished))
+
+
+def write_repodata(chroot_path, packages):
+    os.makedirs(os.path.join(chroot_path, "repodata"))
+    with open(os.path.join(chroot_path, "repodata", "repomd.xml"), "w") as handle:
+        handle.write(REPOMD)
+    primary = '<metadata xmlns="http://linux.duke.edu/metadata/common">{0}\n</metadata>'.format(
+        "".join(PRIMARY_PKG.format(build=b, name=n, ver=v) for b, n, v in packages))
+    with gzip.open(os.path.join(chroot_path, "repodata", "primary.xml.gz"), "wb") as handle:
+        handle.write(primary.encode("utf-8"))
+
+
+class TestPrune(object):
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.project = os.path.join(self.tmp_dir, "foo", "bar")
+        self.chroot = os.path.join(self.project, "fedora-22-x86_64")
+        os.makedirs(self.chroot)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def builds(self):
+        return sorted(d for d in os.listdir(self.chroot)
+                      if d != "repodata" and not d.startswith("."))
+
+    @pytest.mark.parametrize("evr1,evr2,expected", [
+        (("0", "1.0", "1"), ("0", "1.0", "1"), 0),
+        (("0", "1.10", "1"), ("0", "1.9", "1"), 1),
+        (("1", "1.0", "1"), ("0", "2.0", "1"), 1),
+        (("0", "1.0~rc1", "1"), ("0", "1.0", "1"), -1),
+        (("0", "1.0^git1", "1"), ("0", "1.0", "1"), 1),
+        (("0", "1.0a", "1"), ("0", "1.0.1", "1"), -1),
+        ((None, "2", "1.fc22"), ("0", "2", "1.fc21"), 1),
+    ])
+    def test_label_compare(self, evr1, evr2, expected):
+        with mock.patch("backend.prune.rpm", None):
+            assert label_compare(evr1, evr2) == expected
+
+    def test_latest_packages(self):
+        packages = [
+            {"name": "foo", "arch": "x86_64", "evr": ("0", "1.9", "1"), "location": "a/foo-1.9.rpm"},
+            {"name": "foo", "arch": "x86_64", "evr": ("0", "1.10", "1"), "location": "b/foo-1.10.rpm"},
+            {"name": "foo", "arch": "i686", "evr": ("0", "1.9", "1"), "location": "a/foo-1.9.i686.rpm"},
+        ]
+        with mock.patch("backend.prune.rpm", None):
+            assert latest_packages(packages) == {"foo-1.10.rpm", "foo-1.9.i686.rpm"}
+
+    def test_prune_chroot(self):
+        add_build(self.chroot, "01-foo", "foo", "1.0", "success", 30)
+        add_build(self.chroot, "02-foo", "foo", "1.1", "success", 20)
+        add_build(self.chroot, "03-foo", "foo", "1.2", "fail", 20)
+        add_build(self.chroot, "04-bar", "bar", "1.0", "success", 20)
+        add_build(self.chroot, "05-foo", "foo", "1.3", "fail", 1)
+        add_build(self.chroot, "06-baz", "baz", "1.0", "success", 1)
+        add_build(self.chroot, "07-baz", "baz", "1.1", "success", 1)
+        write_repodata(self.chroot, [("01-foo", "foo", "1.0"), ("02-foo", "foo", "1.1"),
+                                     ("04-bar", "bar", "1.0"), ("06-baz", "baz", "1.0"),
+                                     ("07-baz", "baz", "1.1")])
+
+        removed = prune_chroot(self.chroot, time.time() - 14 * DAY)
+        assert sorted(os.path.basename(p) for p in removed) == ["01-foo", "03-foo"]
+        assert self.builds() == ["02-foo", "04-bar", "05-foo", "06-baz", "07-baz"]
+
+    def test_prune_chroot_without_repodata(self):
+        add_build(self.chroot, "01-foo", "foo", "1.0", "success", 30)
+        assert prune_chroot(self.chroot, time.time() - 14 * DAY) == []
+
+        old = time.time() - 30 * DAY
+        os.utime(self.chroot, (old, old))
+        os.makedirs(os.path.join(self.chroot, "devel"))
+        os.utime(self.chroot, (old, old))
+        assert prune_chroot(self.chroot, time.time() - 14 * DAY) == []
+
+        shutil.rmtree(os.path.join(self.chroot, "devel"))
+        os.utime(self.chroot, (old, old))
+        assert prune_chroot(self.chroot, time.time() - 14 * DAY) == [self.chroot]
+        assert not os.path.exists(self.chroot)
+
+    @mock.patch("backend.prune.createrepo_unsafe")
+    def test_prune_project_createrepo_only_when_removed(self, mc_createrepo):
+        mc_createrepo.return_value = (0, "", "")
+        other = os.path.join(self.project, "epel-7-x86_64")
+        add_build(self.chroot, "01-foo", "foo", "1.0", "fail", 30)
+        write_repodata(self.chroot, [])
+        add_build(other, "01-foo", "foo", "1.0", "success", 30)
+        write_repodata(other, [("01-foo", "foo", "1.0")])
+
+        removed, errors = prune_project(self.project, 14, coalesce=True)
+        assert removed == [os.path.join(self.chroot, "01-foo")]
+        assert errors == []
+        assert mc_createrepo.call_args_list == [mock.call(self.chroot, coalesce=True)]
+
+        mc_createrepo.reset_mock()
+        assert prune_project(self.project, 14) == ([], [])
+        assert not mc_createrepo.called
+
+    def test_prune_index(self):
+        path = os.path.join(self.tmp_dir, "index.json")
+        index = PruneIndex(path).load()
+        newest = newest_build_time(self.project)
+        assert not index.is_untouched("foo/bar", newest, 14)
+
+        # recent build could become prunable later
+        index.update("foo/bar", time.time(), newest)
+        assert not index.is_untouched("foo/bar", newest, 14)
+
+        index.update("foo/bar", newest + 15 * DAY, newest)
+        index.save()
+        index = PruneIndex(path).load()
+        assert index.is_untouched("foo/bar", newest, 14)
+        # new build arrived
+        assert not index.is_untouched("foo/bar", newest + 1, 14)
+
+    def test_prune_index_skipped(self):
+        index = PruneIndex(os.path.join(self.tmp_dir, "index.json"))
+        newest = newest_build_time(self.project)
+
+        index.update("foo/bar", time.time(), newest, auto_createrepo=False)
+        assert index.is_untouched("foo/bar", newest, 14)
+        # new build arrived
+        assert not index.is_untouched("foo/bar", newest + 1, 14)
+
+        # settings are checked again after a while
+        index.update("foo/bar", time.time() - 8 * DAY, newest, auto_createrepo=False)
+        assert not index.is_untouched("foo/bar", newest, 14)
+
+    def test_prune_index_broken(self):
+        path = os.path.join(self.tmp_dir, "index.json")
+        with open(path, "w") as handle:
+            handle.write("{broken")
+        assert PruneIndex(path).load().projects == {}
+        assert PruneIndex(path + ".missing").load().projects == {}
@@ -0,0 +1,166 @@
+import six
+
+if six.PY3:
+    from unittest import mock
+else:
+    import mock
+
+from backend.scheduler import FairShareScheduler, parse_owner_weights
+
+
+def make_task(num, owner, project="proj", **kwargs):
+    task = {
+        "task_id": "{0}-fedora-21-x86_64".format(num),
+        "build_id": num,
+        "project_owner": owner,
+        "project_name": project,
+    }
+    task.update(kwargs)
+    return task
+
+
+def pop_owners(scheduler, count):
+    return [scheduler.pop()["project_owner"] for _ in range(count)]
+
+
+def test_parse_owner_weights():
+    assert parse_owner_weights(None) == {}
+    assert parse_owner_weights("foo:2, bar:0.5,") == {"foo": 2.0, "bar": 0.5}
+
+
+class TestFairShareScheduler(object):
+
+    def test_fifo_for_single_owner(self):
+        scheduler = FairShareScheduler()
+        for num in range(3):
+            scheduler.add(make_task(num, "foo"))
+
+        assert len(scheduler) == 3
+        assert [scheduler.pop()["build_id"] for _ in range(3)] == [0, 1, 2]
+        assert scheduler.pop() is None
+        assert len(scheduler) == 0
+
+    def test_owners_interleave(self):
+        scheduler = FairShareScheduler()
+        for num in range(100):
+            scheduler.add(make_task(num, "big"))
+        scheduler.add(make_task(100, "small"))
+        scheduler.add(make_task(101, "small"))
+
+        assert pop_owners(scheduler, 4) == ["big", "small", "big", "small"]
+
+    def test_late_owner_does_not_wait_for_backlog(self):
+        scheduler = FairShareScheduler()
+        for num in range(100):
+            scheduler.add(make_task(num, "big"))
+        pop_owners(scheduler, 50)
+
+        scheduler.add(make_task(100, "small"))
+        assert pop_owners(scheduler, 2) == ["small", "big"]
+
+    def test_returning_owner_gets_no_credit(self):
+        scheduler = FairShareScheduler()
+        scheduler.add(make_task(0, "small"))
+        scheduler.pop()
+        for num in range(1, 20):
+            scheduler.add(make_task(num, "big"))
+        pop_owners(scheduler, 10)
+
+        for num in range(20, 25):
+            scheduler.add(make_task(num, "small"))
+        # "small" starts from the current virtual time, not from its past share
+        assert pop_owners(scheduler, 4) == ["small", "big", "small", "big"]
+
+    def test_weights(self):
+        scheduler = FairShareScheduler(owner_weights={"vip": 2})
+        for num in range(30):
+            scheduler.add(make_task(num, "vip"))
+            scheduler.add(make_task(100 + num, "normal"))
+
+        owners = pop_owners(scheduler, 30)
+        assert owners.count("vip") == 20
+        assert owners.count("normal") == 10
+
+    def test_projects_interleave(self):
+        scheduler = FairShareScheduler()
+        for num in range(10):
+            scheduler.add(make_task(num, "foo", "first"))
+        scheduler.add(make_task(10, "foo", "second"))
+
+        projects = [scheduler.pop()["project_name"] for _ in range(3)]
+        assert projects == ["first", "second", "first"]
+
+    def test_priority(self):
+        scheduler = FairShareScheduler()
+        scheduler.add(make_task(0, "foo"))
+        scheduler.add(make_task(1, "bar", priority=-1))
+
+        assert scheduler.pop()["build_id"] == 1
+        assert scheduler.pop()["build_id"] == 0
+
+    def test_owner_limit(self):
+        scheduler = FairShareScheduler(owner_limit=2)
+        for num in range(5):
+            scheduler.add(make_task(num, "foo"))
+
+        first = scheduler.pop()
+        scheduler.pop()
+        assert scheduler.pop() is None
+
+        scheduler.task_finished(first["task_id"])
+        assert scheduler.pop()["build_id"] == 2
+        assert scheduler.pop() is None
+
+    @mock.patch("backend.scheduler.time")
+    def test_expire_running(self, mc_time):
+        scheduler = FairShareScheduler(owner_limit=1)
+        scheduler.add(make_task(0, "foo"))
+        scheduler.add(make_task(1, "foo"))
+
+        mc_time.time.return_value = 1000
+        scheduler.pop()
+        assert scheduler.pop() is None
+
+        mc_time.time.return_value = 5000
+        scheduler.expire_running(3600)
+        assert scheduler.pop()["build_id"] == 1
+
+    def test_bulk_priority(self):
+        scheduler = FairShareScheduler(bulk_threshold=5)
+        for num in range(10):
+            scheduler.add(make_task(num, "bulk"))
+        pop_owners(scheduler, 5)
+        scheduler.add(make_task(10, "small"))
+        scheduler.add(make_task(11, "small"))
+
+        # tasks added after the backlog reached the threshold go last
+        assert pop_owners(scheduler, 4) == ["small", "small", "bulk", "bulk"]
+
+    def test_forget_idle_owners(self):
+        scheduler = FairShareScheduler()
+        scheduler.add(make_task(0, "foo", "first"))
+        scheduler.add(make_task(1, "foo", "second"))
+        scheduler.add(make_task(2, "zed"))
+
+        first = scheduler.pop()
+        assert first["project_owner"] == "foo"
+        assert ("foo", "first") not in scheduler.project_vtime
+        assert "foo" in scheduler.owner_vtime
+
+        tasks = [scheduler.pop(), scheduler.pop()]
+        for task in [first] + tasks:
+            scheduler.task_finished(task["task_id"])
+
+        assert not scheduler.owner_vtime
+        assert not scheduler.project_vtime
+        assert not scheduler.project_vclock
+
+    def test_task_ids(self):
+        scheduler = FairShareScheduler()
+        scheduler.add(make_task(0, "foo"))
+        scheduler.add(make_task(1, "bar", priority=1))
+        running = scheduler.pop()
+
+        assert scheduler.task_ids() == set(["0-fedora-21-x86_64", "1-fedora-21-x86_64"])
+        scheduler.task_finished(running["task_id"])
+        assert scheduler.task_ids() == set(["1-fedora-21-x86_64"])
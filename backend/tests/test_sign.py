@@ -0,0 +1,359 @@
+import os
+import json
+import shutil
+import struct
+import tempfile
+import threading
+
+import pytest
+import redis
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+from backend.exceptions import CoprSignError, MockRemoteError, \
+    CoprKeygenRequestError
+from backend.sign import sign_rpms_in_dir, get_signer_host, SignRateLimiter, \
+    get_pubkey, pubkey_fingerprint, PUBKEY_CACHE_KEY, PUBKEY_CACHE_TTL, \
+    COPR_KEYGEN_URL, request_user_keys, wait_for_user_keys, create_user_keys, \
+    rpm_is_signed, _sign_batch
+
+PUBKEY = """-----BEGIN PGP PUBLIC KEY BLOCK-----
+
+mI0EatUdXgEEAMdk+iU3IiXkf22soL1qXdY17lPMjck2/TnVU8gdnb2HxXVD3TZ9
+1GuWQ/kwgfPR8emsSkB598kqqi2fMEM46pQOuPirwXmVT5vkrV3e7TsW278HQO0V
+soHUUKK4BMwbB4uoeI3nNOMIRxuzujWRfGZlRxrLWlJuqGFP2fqr4UfJABEBAAG0
+J2Zvb19iYXIgPGZvb19iYXJAY29wci5mZWRvcmFob3N0ZWQub3JnPojOBBMBCgA4
+FiEEku23plCuNP89xXKYkPXCUZ2LJxYFAmrVHV4CGwMFCwkIBwIGFQoJCAsCBBYC
+AwECHgECF4AACgkQkPXCUZ2LJxZlxwP/YXIQ7O0DavoDSeoeZOgxP445Q2RFSTuV
+ohbPDB+DijG5WzeST05KTWSKVmkyNXBUKd6Y/bjMlCYr5tbStNHuuGxlVKvQ9JyC
+R08wqNurf3RII4cUvjSBusFlp5U5hqH2EGEH+jxk8sNYc8XRdZFGvhOAxsftKbQz
+dEcVezvsn6w=
+=nCwd
+-----END PGP PUBLIC KEY BLOCK-----
+"""
+PUBKEY_FINGERPRINT = "92EDB7A650AE34FF3DC5729890F5C2519D8B2716"
+
+
+class TestSignRpmsInDir(object):
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pkg_dir = os.path.join(self.tmp_dir, "fedora-22-x86_64", "foo-1.0-1")
+        os.makedirs(self.pkg_dir)
+        self.rpms = ["foo-{0}.rpm".format(i) for i in range(6)]
+        for name in self.rpms + ["build.log"]:
+            open(os.path.join(self.pkg_dir, name), "w").close()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    @pytest.mark.parametrize("workers", [1, 4])
+    @mock.patch("backend.sign.get_pubkey")
+    @mock.patch("backend.sign._sign_one")
+    def test_sign_all(self, mc_sign_one, mc_get_pubkey, workers):
+        threads = set()
+        mc_sign_one.side_effect = lambda *args: threads.add(threading.current_thread())
+
+        sign_rpms_in_dir("foo", "bar", self.pkg_dir, workers=workers)
+        assert sorted(os.path.basename(call[0][0])
+                      for call in mc_sign_one.call_args_list) == self.rpms
+        if workers == 1:
+            assert threads == {threading.current_thread()}
+
+    @mock.patch("backend.sign.get_pubkey")
+    @mock.patch("backend.sign._sign_one")
+    def test_errors_aggregated(self, mc_sign_one, mc_get_pubkey):
+        def sign_one(path, *args):
+            if path.endswith(("foo-1.rpm", "foo-4.rpm")):
+                raise CoprSignError("sign failed")
+        mc_sign_one.side_effect = sign_one
+
+        with pytest.raises(MockRemoteError) as err:
+            sign_rpms_in_dir("foo", "bar", self.pkg_dir, workers=3)
+        assert "foo-1.rpm" in str(err.value)
+        assert "foo-4.rpm" in str(err.value)
+        # failures don't stop signing of the others
+        assert len(mc_sign_one.call_args_list) == len(self.rpms)
+
+    @mock.patch("backend.sign.SignRateLimiter")
+    @mock.patch("backend.sign.get_pubkey")
+    @mock.patch("backend.sign._sign_one")
+    def test_rate_limit(self, mc_sign_one, mc_get_pubkey, mc_limiter):
+        # mock call counting is not thread safe
+        waits = []
+        lock = threading.Lock()
+
+        def wait():
+            with lock:
+                waits.append(1)
+        mc_limiter.return_value.wait = wait
+
+        sign_rpms_in_dir("foo", "bar", self.pkg_dir, workers=2, rate_limit=5)
+        assert mc_limiter.call_args == mock.call(5)
+        assert len(waits) == len(self.rpms)
+
+    @pytest.mark.parametrize("workers,batch_size,batches", [
+        (1, 50, [6]),
+        (2, 50, [3, 3]),
+        (1, 4, [4, 2]),
+    ])
+    @mock.patch("backend.sign.get_pubkey")
+    @mock.patch("backend.sign._sign_one")
+    @mock.patch("backend.sign._sign_batch")
+    def test_sign_batches(self, mc_sign_batch, mc_sign_one, mc_get_pubkey,
+                          workers, batch_size, batches):
+        sign_rpms_in_dir("foo", "bar", self.pkg_dir, workers=workers,
+                         batch_size=batch_size)
+        assert not mc_sign_one.called
+        calls = [call[0][0] for call in mc_sign_batch.call_args_list]
+        assert sorted(len(paths) for paths in calls) == sorted(batches)
+        assert sorted(os.path.basename(path) for paths in calls
+                      for path in paths) == self.rpms
+
+    @mock.patch("backend.sign.rpm_is_signed")
+    @mock.patch("backend.sign.get_pubkey")
+    @mock.patch("backend.sign._sign_one")
+    @mock.patch("backend.sign._sign_batch")
+    def test_sign_batch_fallback(self, mc_sign_batch, mc_sign_one, mc_get_pubkey,
+                                 mc_signed):
+        mc_sign_batch.side_effect = CoprSignError("sign failed")
+        # failed batches signed some rpms before they failed
+        mc_signed.side_effect = lambda path: not path.endswith(("foo-1.rpm", "foo-4.rpm"))
+
+        def sign_one(path, *args):
+            if path.endswith("foo-4.rpm"):
+                raise CoprSignError("sign failed")
+        mc_sign_one.side_effect = sign_one
+
+        with pytest.raises(MockRemoteError) as err:
+            sign_rpms_in_dir("foo", "bar", self.pkg_dir, batch_size=3)
+        assert "foo-4.rpm" in str(err.value)
+        assert "foo-1.rpm" not in str(err.value)
+        assert mc_sign_batch.call_count == 2
+        assert sorted(os.path.basename(call[0][0])
+                      for call in mc_sign_one.call_args_list) == \
+            ["foo-1.rpm", "foo-4.rpm"]
+
+    @mock.patch("backend.sign.Popen")
+    def test_sign_batch_cmd(self, mc_popen):
+        mc_popen.return_value.communicate.return_value = ("", "")
+        mc_popen.return_value.returncode = 0
+        _sign_batch(["/a.rpm", "/b.rpm"], "foo_bar@copr.fedorahosted.org")
+        assert mc_popen.call_args[0][0][-5:] == [
+            "-u", "foo_bar@copr.fedorahosted.org", "-r", "/a.rpm", "/b.rpm"]
+
+        mc_popen.return_value.returncode = 1
+        with pytest.raises(CoprSignError):
+            _sign_batch(["/a.rpm", "/b.rpm"], "foo_bar@copr.fedorahosted.org")
+
+
+def make_rpm(path, tags):
+    """ rpm lead and signature header index with `tags`, nothing else """
+    with open(path, "wb") as handle:
+        handle.write(b"\0" * 96 + b"\x8e\xad\xe8\x01" + b"\0" * 4 +
+                     struct.pack(">II", len(tags), 0))
+        for tag in tags:
+            handle.write(struct.pack(">IIII", tag, 7, 0, 1))
+
+
+def test_rpm_is_signed(tmpdir):
+    signed = str(tmpdir.join("signed.rpm"))
+    make_rpm(signed, [62, 268, 1004])
+    assert rpm_is_signed(signed)
+
+    unsigned = str(tmpdir.join("unsigned.rpm"))
+    make_rpm(unsigned, [62, 269, 1000, 1004])
+    assert not rpm_is_signed(unsigned)
+
+    broken = tmpdir.join("broken.rpm")
+    broken.write("rpm")
+    assert not rpm_is_signed(str(broken))
+    assert not rpm_is_signed(str(tmpdir.join("missing.rpm")))
+
+
+def test_get_signer_host(tmpdir):
+    conf = tmpdir.join("sign.conf")
+    conf.write("user: copr\nserver: 10.0.0.1\nallowuser: copr\n")
+    assert get_signer_host(str(conf)) == "10.0.0.1"
+    assert get_signer_host(str(tmpdir.join("missing"))) == "localhost"
+
+
+class TestSignRateLimiter(object):
+
+    def setup_method(self, method):
+        self.rdb = MagicMock()
+        self.pipe = self.rdb.pipeline.return_value
+        self.limiter = SignRateLimiter(2, host="signer", rdb=self.rdb)
+
+    @mock.patch("backend.sign.time")
+    def test_wait(self, mc_time):
+        mc_time.time.side_effect = [100.25, 101.0]
+        self.pipe.execute.side_effect = [[3, True], [1, True]]
+
+        self.limiter.wait()
+        assert mc_time.sleep.call_args == mock.call(0.75)
+        assert self.pipe.incr.call_args_list == [
+            mock.call("copr-be-sign-rate-signer-100"),
+            mock.call("copr-be-sign-rate-signer-101")]
+
+    @mock.patch("backend.sign.time")
+    def test_wait_redis_down(self, mc_time):
+        mc_time.time.return_value = 100.0
+        self.pipe.execute.side_effect = redis.ConnectionError()
+        self.limiter.wait()
+        assert not mc_time.sleep.called
+
+
+def test_pubkey_fingerprint():
+    assert pubkey_fingerprint(PUBKEY) == PUBKEY_FINGERPRINT
+    assert pubkey_fingerprint("garbage") is None
+    assert pubkey_fingerprint("") is None
+
+
+class TestPubkeyCache(object):
+
+    def setup_method(self, method):
+        self.cache = {}
+        self.rdb = MagicMock()
+        self.rdb.hget.side_effect = lambda key, field: self.cache.get((key, field))
+        self.rdb.hset.side_effect = \
+            lambda key, field, value: self.cache.__setitem__((key, field), value)
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.outfile = os.path.join(self.tmp_dir, "pubkey.gpg")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    @mock.patch("backend.sign.Popen")
+    @mock.patch("backend.sign.get_redis_connection")
+    def test_get_pubkey_cached(self, mc_rdb, mc_popen):
+        mc_rdb.return_value = self.rdb
+        mc_popen.return_value.communicate.return_value = (PUBKEY, "")
+        mc_popen.return_value.returncode = 0
+
+        assert get_pubkey("foo", "bar", self.outfile) == PUBKEY
+        assert mc_popen.call_count == 1
+        cached = json.loads(self.cache[(PUBKEY_CACHE_KEY, "foo_bar@copr.fedorahosted.org")])
+        assert cached["fingerprint"] == PUBKEY_FINGERPRINT
+
+        with open(self.outfile) as handle:
+            assert handle.read() == PUBKEY
+
+        # key is served from the cache, unchanged file is not rewritten
+        with mock.patch("backend.sign.open", create=True,
+                        side_effect=open) as mc_open:
+            assert get_pubkey("foo", "bar", self.outfile) == PUBKEY
+            assert [call[0][1:] for call in mc_open.call_args_list] == [()]
+        assert mc_popen.call_count == 1
+
+        os.unlink(self.outfile)
+        get_pubkey("foo", "bar", self.outfile)
+        assert os.path.exists(self.outfile)
+
+    @mock.patch("backend.sign.Popen")
+    @mock.patch("backend.sign.get_redis_connection")
+    def test_get_pubkey_expired(self, mc_rdb, mc_popen):
+        mc_rdb.return_value = self.rdb
+        mc_popen.return_value.communicate.return_value = (PUBKEY, "")
+        mc_popen.return_value.returncode = 0
+
+        with mock.patch("backend.sign.time") as mc_time:
+            mc_time.time.return_value = 1000
+            get_pubkey("foo", "bar")
+            mc_time.time.return_value = 1000 + PUBKEY_CACHE_TTL - 1
+            get_pubkey("foo", "bar")
+            assert mc_popen.call_count == 1
+
+            mc_time.time.return_value = 1000 + PUBKEY_CACHE_TTL + 1
+            get_pubkey("foo", "bar")
+            assert mc_popen.call_count == 2
+
+    @mock.patch("backend.sign.Popen")
+    @mock.patch("backend.sign.get_redis_connection")
+    def test_get_pubkey_redis_down(self, mc_rdb, mc_popen):
+        mc_rdb.return_value.hget.side_effect = redis.ConnectionError()
+        mc_rdb.return_value.hset.side_effect = redis.ConnectionError()
+        mc_popen.return_value.communicate.return_value = (PUBKEY, "")
+        mc_popen.return_value.returncode = 0
+
+        assert get_pubkey("foo", "bar") == PUBKEY
+        assert get_pubkey("foo", "bar") == PUBKEY
+        assert mc_popen.call_count == 2
+
+
+def keygen_response(status_code, data=None):
+    response = MagicMock(status_code=status_code)
+    response.json.return_value = data
+    return response
+
+
+class TestKeygenJobs(object):
+
+    @mock.patch("backend.sign.request")
+    def test_request_user_keys(self, mc_request):
+        mc_request.return_value = keygen_response(202, {"id": "abc", "state": "queued"})
+        assert request_user_keys("foo", "bar") == COPR_KEYGEN_URL + "/abc"
+        data = json.loads(mc_request.call_args[1]["data"])
+        assert data["async"]
+        assert data["name_email"] == "foo_bar@copr.fedorahosted.org"
+
+        # key exists
+        mc_request.return_value = keygen_response(200)
+        assert request_user_keys("foo", "bar") is None
+
+        mc_request.return_value = keygen_response(500)
+        with pytest.raises(CoprKeygenRequestError):
+            request_user_keys("foo", "bar")
+
+    @mock.patch("backend.sign.time")
+    @mock.patch("backend.sign.request")
+    def test_wait_for_user_keys(self, mc_request, mc_time):
+        mc_time.time.return_value = 100
+        mc_request.side_effect = [
+            keygen_response(200, {"state": "queued"}),
+            keygen_response(200, {"state": "running"}),
+            keygen_response(200, {"state": "done"}),
+        ]
+        wait_for_user_keys(COPR_KEYGEN_URL + "/abc", poll_interval=3)
+        assert mc_time.sleep.call_args_list == [mock.call(3), mock.call(3)]
+
+    @mock.patch("backend.sign.time")
+    @mock.patch("backend.sign.request")
+    def test_wait_for_user_keys_failed(self, mc_request, mc_time):
+        mc_time.time.return_value = 100
+        mc_request.return_value = keygen_response(
+            200, {"state": "failed", "error": "gpg failed"})
+        with pytest.raises(CoprKeygenRequestError) as err:
+            wait_for_user_keys(COPR_KEYGEN_URL + "/abc")
+        assert "gpg failed" in str(err.value)
+
+    @mock.patch("backend.sign.time")
+    @mock.patch("backend.sign.request")
+    def test_wait_for_user_keys_timeout(self, mc_request, mc_time):
+        mc_time.time.side_effect = [100, 101, 108, 115]
+        mc_request.return_value = keygen_response(200, {"state": "running"})
+        with pytest.raises(CoprKeygenRequestError):
+            wait_for_user_keys(COPR_KEYGEN_URL + "/abc", timeout=15, poll_interval=5)
+        assert mc_time.sleep.call_count == 2
+
+    @mock.patch("backend.sign.get_redis_connection")
+    @mock.patch("backend.sign.wait_for_user_keys")
+    @mock.patch("backend.sign.request_user_keys")
+    def test_create_user_keys(self, mc_request_keys, mc_wait, mc_rdb):
+        mc_request_keys.return_value = None
+        create_user_keys("foo", "bar")
+        assert not mc_wait.called
+
+        mc_request_keys.return_value = COPR_KEYGEN_URL + "/abc"
+        create_user_keys("foo", "bar")
+        assert mc_wait.call_args == mock.call(COPR_KEYGEN_URL + "/abc")
+        # new key is not hidden by the cached one
+        assert mc_rdb.return_value.hdel.call_args == \
+            mock.call(PUBKEY_CACHE_KEY, "foo_bar@copr.fedorahosted.org")
@@ -0,0 +1,60 @@
+import os
+import shlex
+import shutil
+import tempfile
+
+import six
+
+if six.PY3:
+    from unittest import mock
+else:
+    import mock
+
+import ansible.constants
+
+from backend.sshcontrol import ssh_options, ssh_command, setup_ssh_control, \
+    close_connections
+
+
+class TestSshControl(object):
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.control_dir = os.path.join(self.tmp_dir, "ssh")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_ssh_options(self):
+        options = ssh_options(self.control_dir, 600)
+        assert "ControlMaster=auto" in options
+        assert "ControlPersist=600s" in options
+        assert "ControlPath={0}/%r@%h:%p".format(self.control_dir) in options
+
+        # usable as a single `rsync -e` argument
+        assert shlex.split(ssh_command(self.control_dir, 600)) == ["ssh"] + options
+
+    @mock.patch.dict(os.environ, {})
+    @mock.patch.object(ansible.constants, "ANSIBLE_SSH_ARGS", None)
+    def test_setup(self):
+        setup_ssh_control(self.control_dir, 600)
+        assert os.path.isdir(self.control_dir)
+        assert ansible.constants.ANSIBLE_SSH_ARGS == os.environ["ANSIBLE_SSH_ARGS"]
+        assert shlex.split(ansible.constants.ANSIBLE_SSH_ARGS) == \
+            ssh_options(self.control_dir, 600)
+
+    @mock.patch("backend.sshcontrol.subprocess.call")
+    def test_close_connections(self, mc_call):
+        os.mkdir(self.control_dir)
+        for name in ["root@1.2.3.4:22", "mockbuilder@1.2.3.4:22", "root@1.2.3.5:22"]:
+            open(os.path.join(self.control_dir, name), "w").close()
+        mc_call.return_value = 0
+
+        assert close_connections(self.control_dir, "1.2.3.4") == 2
+        paths = sorted(call[0][0][2] for call in mc_call.call_args_list)
+        assert paths == [
+            "ControlPath={0}/mockbuilder@1.2.3.4:22".format(self.control_dir),
+            "ControlPath={0}/root@1.2.3.4:22".format(self.control_dir),
+        ]
+        assert all(call[0][0][-3:] == ["-O", "exit", "1.2.3.4"]
+                   for call in mc_call.call_args_list)
@@ -0,0 +1,98 @@
+import os
+import errno
+import shutil
+import tempfile
+
+import pytest
+
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+from bunch import Bunch
+
+from backend.trash import move_to_trash, TrashReaper, TRASH_STATS_KEY
+
+
+class TestTrash(object):
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.trash_dir = os.path.join(self.tmp_dir, ".trash")
+        self.project = os.path.join(self.tmp_dir, "foo", "bar")
+        for chroot in ["fedora-22-x86_64", "epel-7-x86_64"]:
+            os.makedirs(os.path.join(self.project, chroot, "pkg"))
+            with open(os.path.join(self.project, chroot, "pkg", "pkg.rpm"), "w") as handle:
+                handle.write("x" * 10)
+        os.symlink("pkg", os.path.join(self.project, "fedora-22-x86_64", "link"))
+
+        self.opts = Bunch(trash_dir=self.trash_dir, trash_reap_rate=0, sleeptime=1)
+        self.events = MagicMock()
+        self.reaper = TrashReaper(self.opts, self.events)
+        self.reaper.rdb = MagicMock()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_move_to_trash(self):
+        first = move_to_trash(self.trash_dir, os.path.join(self.project, "epel-7-x86_64"))
+        second = move_to_trash(self.trash_dir, self.project + "/")
+
+        assert not os.path.exists(self.project)
+        assert first.endswith("-epel-7-x86_64")
+        assert second.endswith("-bar")
+        assert sorted(os.listdir(self.trash_dir)) == \
+            [os.path.basename(first), os.path.basename(second)]
+        assert move_to_trash(self.trash_dir, self.project) is None
+
+    def test_move_to_trash_without_trash_dir(self):
+        assert move_to_trash(None, self.project) is None
+        assert not os.path.exists(self.project)
+        # already removed
+        assert move_to_trash(None, self.project) is None
+
+    @mock.patch("backend.trash.shutil.rmtree")
+    def test_move_to_trash_without_trash_dir_error(self, mc_rmtree):
+        mc_rmtree.side_effect = OSError(errno.EACCES, "Permission denied")
+        with pytest.raises(OSError):
+            move_to_trash(None, self.project)
+
+    def test_reap_once(self):
+        move_to_trash(self.trash_dir, self.project)
+        move_to_trash(self.trash_dir, os.path.join(self.tmp_dir, "foo"))
+
+        self.reaper.reap_once()
+        assert os.listdir(self.trash_dir) == []
+        assert self.reaper.stats["reclaimed_files"] == 3
+        assert self.reaper.stats["reclaimed_bytes"] == 20 + len("pkg")
+        assert self.reaper.stats["reaped_dirs"] == 2
+        assert self.reaper.stats["pending_dirs"] == 0
+
+        published = self.reaper.rdb.hmset.call_args_list
+        assert published[0][0][0] == TRASH_STATS_KEY
+        assert [call[0][1]["pending_dirs"] for call in published] == [2, 1, 0]
+
+    def test_reap_once_missing_trash(self):
+        self.reaper.reap_once()
+        assert self.reaper.stats["reaped_dirs"] == 0
+
+    @mock.patch("backend.trash.time")
+    def test_throttle(self, mc_time):
+        self.opts.trash_reap_rate = 2
+        mc_time.time.return_value = 100.0
+
+        for _ in range(4):
+            self.reaper.throttle()
+        sleeps = [call[0][0] for call in mc_time.sleep.call_args_list]
+        assert sleeps == [0.5, 1.0, 1.5, 2.0]
+
+        # long idle starts a new window
+        mc_time.time.return_value = 200.0
+        mc_time.sleep.reset_mock()
+        self.reaper.throttle()
+        assert mc_time.sleep.call_args_list == [mock.call(0.5)]
@@ -0,0 +1,141 @@
+import pytest
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+from bunch import Bunch
+from retask.task import Task
+
+from backend.vm_manage import VmProvisioner, BuilderPool, BuilderPoolManager, \
+    ans_extra_vars_encode
+
+if six.PY3:
+    import queue
+else:
+    import Queue as queue
+
+
+def test_ans_extra_vars_encode():
+    assert ans_extra_vars_encode({}, "copr_task") == ""
+    assert ans_extra_vars_encode({"ip": "1.2.3.4"}, "copr_task") == \
+        "--extra-vars='{\"copr_task\": {\"ip\": \"1.2.3.4\"}}'"
+
+
+@mock.patch("backend.vm_manage.close_connections")
+def test_terminate_closes_ssh_connections(mc_close):
+    opts = Bunch(
+        build_groups=[{"terminate_playbook": "terminate.yml"}],
+        terminate_vars="ip",
+        ssh_control_dir="/tmp/ssh",
+        ssh_control_persist=600,
+    )
+    provisioner = VmProvisioner(opts, 0, MagicMock())
+    with mock.patch.object(provisioner, "run_ansible_playbook") as mc_run:
+        provisioner.terminate_instance("1.2.3.4", "foo")
+    assert mc_run.called
+    assert mc_close.call_args == mock.call("/tmp/ssh", "1.2.3.4")
+
+    opts.ssh_control_persist = 0
+    mc_close.reset_mock()
+    with mock.patch.object(provisioner, "run_ansible_playbook"):
+        provisioner.terminate_instance("1.2.3.4", "foo")
+    assert not mc_close.called
+
+
+@mock.patch("backend.vm_manage.Queue")
+class TestBuilderPool(object):
+
+    def test_lease(self, mc_queue):
+        pool = BuilderPool(0)
+        vm = {"ip": "1.2.3.4", "vm_name": "foo"}
+        pool.idle_queue.wait.return_value = Task(vm)
+        assert pool.lease(10) == vm
+        assert pool.idle_queue.wait.call_args == mock.call(10)
+
+        pool.idle_queue.wait.return_value = False
+        assert pool.lease(10) is None
+
+    def test_add_and_dispose(self, mc_queue):
+        pool = BuilderPool(0)
+        vm = {"ip": "1.2.3.4", "vm_name": "foo"}
+
+        pool.add(vm)
+        assert pool.rdb.hset.call_args[0][:2] == ("copr-vm-pool-0-vms", "1.2.3.4")
+        assert pool.idle_queue.enqueue.call_args[0][0].data == vm
+
+        pool.dispose(vm)
+        assert pool.dispose_queue.enqueue.call_args[0][0].data == vm
+        assert not pool.rdb.hdel.called
+
+
+class TestBuilderPoolManager(object):
+
+    def setup_method(self, method):
+        self.opts = Bunch(
+            sleeptime=1,
+            pool_check_interval=60,
+            spawn_vars=None,
+            terminate_vars=None,
+            build_groups=[{
+                "id": 0, "name": "PC", "max_workers": 2,
+                "pool_min_idle": 2, "pool_max_total": 3,
+            }]
+        )
+        with mock.patch("backend.vm_manage.Queue"):
+            self.manager = BuilderPoolManager(self.opts, queue.Queue(), 0)
+        self.manager.pool = MagicMock()
+        self.manager.provisioner = MagicMock()
+
+    def test_refill(self):
+        self.manager.pool.idle = 1
+        self.manager.pool.total = 1
+        self.manager.provisioner.spawn_instance.return_value = ("1.2.3.4", "foo")
+        self.manager.refill()
+
+        vm = self.manager.pool.add.call_args[0][0]
+        assert vm["ip"] == "1.2.3.4"
+        assert vm["vm_name"] == "foo"
+
+    @pytest.mark.parametrize("idle,total", [(2, 2), (1, 3)])
+    def test_refill_not_needed(self, idle, total):
+        self.manager.pool.idle = idle
+        self.manager.pool.total = total
+        self.manager.refill()
+
+        assert not self.manager.provisioner.spawn_instance.called
+        assert not self.manager.pool.add.called
+
+    def test_recheck_idle(self):
+        healthy = {"ip": "1.1.1.1", "vm_name": None}
+        broken = {"ip": "2.2.2.2", "vm_name": "bar"}
+
+        self.manager.pool.idle = 2
+        self.manager.pool.take_idle.side_effect = [healthy, broken]
+        self.manager.provisioner.is_healthy.side_effect = lambda ip: ip == "1.1.1.1"
+
+        self.manager.recheck_idle()
+
+        assert self.manager.pool.give_back.call_args == mock.call(healthy)
+        assert self.manager.provisioner.terminate_instance.call_args == \
+            mock.call("2.2.2.2", "bar")
+        assert self.manager.pool.forget.call_args == mock.call(broken)
+
+    def test_recheck_idle_not_yet(self):
+        self.manager.last_check = 10 ** 12
+        self.manager.recheck_idle()
+        assert not self.manager.pool.take_idle.called
+
+    def test_terminate_disposed(self):
+        vm = {"ip": "1.1.1.1", "vm_name": "foo"}
+        self.manager.pool.dispose_queue.dequeue.side_effect = [Task(vm), None]
+
+        self.manager.terminate_disposed()
+
+        assert self.manager.provisioner.terminate_instance.call_args == \
+            mock.call("1.1.1.1", "foo")
+        assert self.manager.pool.forget.call_args == mock.call(vm)
@@ -17,20 +17,36 @@ class ActionsLogic(object):
         return query
 
     @classmethod
-    def get_waiting(cls):
+    def get_waiting(cls, since=None):
         """
         Return actions that aren't finished
+
+        :param int since: [optional] return only actions with greater id
         """
 
         query = (models.Action.query
                  .filter(models.Action.result ==
                          helpers.BackendResultEnum("waiting"))
                  .filter(models.Action.action_type !=
-                         helpers.ActionTypeEnum("legal-flag"))
-                 .order_by(models.Action.created_on.asc()))
+                         helpers.ActionTypeEnum("legal-flag")))
+        if since is not None:
+            query = query.filter(models.Action.id > since)
+        query = query.order_by(models.Action.created_on.asc())
 
         return query
 
+    @classmethod
+    def get_waiting_summary(cls, since=None):
+        """
+        Returns tuple (count, max id, sum of ids) describing waiting actions
+        """
+        query = cls.get_waiting(since).order_by(None)
+        return query.with_entities(
+            db.func.count(models.Action.id),
+            db.func.max(models.Action.id),
+            db.func.sum(models.Action.id),
+        ).one()
+
     @classmethod
     def get_by_ids(cls, ids):
         """
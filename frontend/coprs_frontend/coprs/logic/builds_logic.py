@@ -44,23 +44,45 @@ class BuildsLogic(object):
         return query
 
     @classmethod
-    def get_build_task_queue(cls):
+    def get_build_task_queue(cls, since=None):
         """
         Returns BuildChroots which are - waiting to be built or
                                        - older than 2 hours and unfinished
+
+        :param int since: [optional] return only waiting tasks of builds
+            with greater id, old unfinished tasks are returned regardless
+            of their build id
         """
-        query = models.BuildChroot.query.join(models.Build).filter(or_(
+        waiting = or_(
             models.BuildChroot.status == helpers.StatusEnum("pending"),
             models.BuildChroot.status == helpers.StatusEnum("starting"),
-            and_(
-                models.BuildChroot.status == helpers.StatusEnum("running"),
-                models.Build.started_on < int(time.time() - 7200),
-                models.Build.ended_on is None
-            )
-        ))
-        query = query.order_by(models.BuildChroot.build_id.asc())
+        )
+        stale_running = and_(
+            models.BuildChroot.status == helpers.StatusEnum("running"),
+            models.Build.started_on < int(time.time() - 7200),
+            models.Build.ended_on == None
+        )
+        if since is not None:
+            waiting = and_(waiting, models.BuildChroot.build_id > since)
+
+        query = models.BuildChroot.query.join(models.Build) \
+            .filter(or_(waiting, stale_running)) \
+            .order_by(models.BuildChroot.build_id.asc())
         return query
 
+    @classmethod
+    def get_build_task_queue_summary(cls, since=None):
+        """
+        Returns tuple (count, max build id, sum of build ids) describing
+        the task queue without loading it
+        """
+        query = cls.get_build_task_queue(since).order_by(None)
+        return query.with_entities(
+            db.func.count(models.BuildChroot.build_id),
+            db.func.max(models.BuildChroot.build_id),
+            db.func.sum(models.BuildChroot.build_id + models.BuildChroot.mock_chroot_id),
+        ).one()
+
     @classmethod
     def get_multiple(cls, user, **kwargs):
         copr = kwargs.get("copr", None)
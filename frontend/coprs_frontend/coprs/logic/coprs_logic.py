@@ -1,5 +1,6 @@
 import time
 from sqlalchemy import and_
+from sqlalchemy.orm.attributes import get_history
 
 from coprs import db
 from coprs import exceptions
@@ -7,6 +8,7 @@ from coprs import helpers
 from coprs import models
 from coprs import signals
 from coprs.logic import users_logic
+from coprs.logic.actions_logic import ActionsLogic
 
 
 class CoprsLogic(object):
@@ -184,6 +186,12 @@ class CoprsLogic(object):
                                                               copr.name),
                                    created_on=int(time.time()))
             db.session.add(action)
+
+        if get_history(copr, "auto_createrepo").has_changes():
+            # backend drops its cached setting once the action runs,
+            # switching auto_createrepo on brings the repos up to date
+            chroots = [c.name for c in copr.active_chroots] if copr.auto_createrepo else []
+            ActionsLogic.send_createrepo(copr.owner.name, copr.name, chroots)
         db.session.add(copr)
 
     @classmethod
@@ -1,4 +1,5 @@
 import flask
+import hashlib
 import sys
 import time
 
@@ -16,14 +17,34 @@ from whoosh.index import LockError
 def waiting():
     """
     Return list of waiting actions and builds.
+
+    Optional query arguments `builds_since` and `actions_since` limit
+    the response to tasks of builds and actions with greater ids,
+    response fields `builds_cursor` and `actions_cursor` hold values
+    for the next request.
+
+    Response carries an ETag computed without loading the queue,
+    request with matching If-None-Match gets 304 Not Modified.
     """
 
+    builds_since = flask.request.args.get("builds_since", None, type=int)
+    actions_since = flask.request.args.get("actions_since", None, type=int)
+
+    builds_summary = builds_logic.BuildsLogic.get_build_task_queue_summary(builds_since)
+    actions_summary = actions_logic.ActionsLogic.get_waiting_summary(actions_since)
+    etag = hashlib.md5("{0}:{1}".format(builds_summary, actions_summary)).hexdigest()
+
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+        return response
+
     # models.Actions
     actions_list = [
         action.to_dict(options={
             "__columns_except__": ["result", "message", "ended_on"]
         })
-        for action in actions_logic.ActionsLogic.get_waiting()
+        for action in actions_logic.ActionsLogic.get_waiting(actions_since)
     ]
 
     # tasks represented by models.BuildChroot with some other stuff
@@ -41,10 +62,17 @@ def waiting():
             "memory_reqs": task.build.memory_reqs,
             "timeout": task.build.timeout
         }
-        for task in builds_logic.BuildsLogic.get_build_task_queue()
+        for task in builds_logic.BuildsLogic.get_build_task_queue(builds_since)
     ]
 
-    return flask.jsonify({"actions": actions_list, "builds": builds_list})
+    builds_cursor = max([builds_since or 0] + [b["build_id"] for b in builds_list])
+    actions_cursor = max([actions_since or 0] + [a["id"] for a in actions_list])
+
+    response = flask.jsonify({"actions": actions_list, "builds": builds_list,
+                              "builds_cursor": builds_cursor,
+                              "actions_cursor": actions_cursor})
+    response.set_etag(etag)
+    return response
 
 
 @backend_ns.route("/update/", methods=["POST", "PUT"])
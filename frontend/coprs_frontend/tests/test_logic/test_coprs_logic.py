@@ -1,3 +1,5 @@
+import json
+
 import pytest
 
 from coprs.exceptions import ActionInProgressException
@@ -18,6 +20,22 @@ class TestCoprsLogic(CoprsTestCase):
             CoprsLogic.update(self.u1, self.c1)
         self.db.session.rollback()
 
+    def test_update_auto_createrepo_sends_createrepo(self, f_users, f_coprs,
+                                                     f_mock_chroots, f_db):
+        CoprsLogic.update(self.u1, self.c1)
+        assert models.Action.query.count() == 0
+
+        self.c1.auto_createrepo = False
+        CoprsLogic.update(self.u1, self.c1)
+        self.db.session.commit()
+
+        action = models.Action.query.one()
+        assert action.action_type == ActionTypeEnum("createrepo")
+        data = json.loads(action.data)
+        assert data["username"] == self.c1.owner.name
+        assert data["projectname"] == self.c1.name
+        assert data["chroots"] == []
+
     def test_legal_flag_doesnt_block_copr_functionality(self, f_users,
                                                         f_coprs, f_db):
         self.db.session.add(self.models.Action(
@@ -1,4 +1,5 @@
 import json
+import time
 
 from coprs.signals import build_finished
 from tests.coprs_test_case import CoprsTestCase
@@ -16,6 +17,52 @@ class TestWaitingBuilds(CoprsTestCase):
         r = self.tc.get("/backend/waiting/", headers=self.auth_header)
         assert len(json.loads(r.data)["builds"]) == 5
 
+    def test_waiting_builds_since(
+            self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+
+        r = self.tc.get("/backend/waiting/?builds_since={0}".format(self.b3.id),
+                        headers=self.auth_header)
+        data = json.loads(r.data)
+        assert [b["build_id"] for b in data["builds"]] == [self.b4.id]
+        assert data["builds_cursor"] == self.b4.id
+
+        r = self.tc.get("/backend/waiting/?builds_since={0}".format(self.b4.id),
+                        headers=self.auth_header)
+        data = json.loads(r.data)
+        assert data["builds"] == []
+        assert data["builds_cursor"] == self.b4.id
+
+    def test_waiting_builds_since_stale_running(
+            self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+
+        # b1 runs for too long, its worker probably died
+        self.b1.started_on = int(time.time()) - 3 * 3600
+        self.b1.build_chroots[0].status = 3
+        self.db.session.commit()
+
+        r = self.tc.get("/backend/waiting/?builds_since={0}".format(self.b4.id),
+                        headers=self.auth_header)
+        data = json.loads(r.data)
+        assert [b["build_id"] for b in data["builds"]] == [self.b1.id]
+        assert data["builds_cursor"] == self.b4.id
+
+    def test_waiting_not_modified(
+            self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+
+        r = self.tc.get("/backend/waiting/", headers=self.auth_header)
+        etag = r.headers["ETag"]
+
+        headers = dict(self.auth_header)
+        headers["If-None-Match"] = etag
+        r = self.tc.get("/backend/waiting/", headers=headers)
+        assert r.status_code == 304
+
+        self.b4.build_chroots[0].status = 1
+        self.db.session.commit()
+        r = self.tc.get("/backend/waiting/", headers=headers)
+        assert r.status_code == 200
+        assert r.headers["ETag"] != etag
+
 
 # status = 0 # failure
 # status = 1 # succeeded
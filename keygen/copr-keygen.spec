@@ -119,12 +119,18 @@ install -d %{buildroot}%{_datadir}/copr-keygen
 install -d %{buildroot}%{_bindir}
 install -d -m 500 %{buildroot}%{_sharedstatedir}/copr-keygen/phrases
 install -d -m 500 %{buildroot}%{_sharedstatedir}/copr-keygen/gnupg
+install -d -m 500 %{buildroot}%{_sharedstatedir}/copr-keygen/pool-gnupg
+install -d -m 500 %{buildroot}%{_sharedstatedir}/copr-keygen/locks
+install -d -m 500 %{buildroot}%{_sharedstatedir}/copr-keygen/jobs
+install -d %{buildroot}%{_unitdir}
 install -d %{buildroot}%{_localstatedir}/log/copr-keygen
 install -d %{buildroot}%{_sysconfdir}/logrotate.d/
 
 %{__install} -p -m 0755 run/gpg_copr.sh %{buildroot}/%{_bindir}/gpg_copr.sh
 
 %{__install} -p -m 0755 run/application.py %{buildroot}%{_datadir}/copr-keygen/
+%{__install} -p -m 0755 run/copr-keygen-pool.py %{buildroot}%{_datadir}/copr-keygen/
+%{__install} -p -m 0644 run/copr-keygen-pool.service %{buildroot}%{_unitdir}/
 %{__install} -p -m 0644 configs/httpd/copr-keygen.conf.example %{buildroot}%{_pkgdocdir}/httpd/
 %{__install} -p -m 0644 configs/logrotate %{buildroot}%{_sysconfdir}/logrotate.d/copr-keygen
 
@@ -163,6 +169,7 @@ service httpd condrestart
 %{python3_sitelib}/*
 
 %{_bindir}/gpg_copr.sh
+%{_unitdir}/copr-keygen-pool.service
 %config(noreplace)  %{_sysconfdir}/sudoers.d/copr_signer
 
 %defattr(600, copr-signer, copr-signer, 700)
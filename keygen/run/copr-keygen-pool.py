@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+"""
+Keeps the pool of pre-generated keys (KEY_POOL_SIZE) filled
+"""
+
+import logging
+import os
+import sys
+import time
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from copr_keygen import app
+from copr_keygen.exceptions import KeygenServiceBaseException
+from copr_keygen.pool import KeyPool
+
+log = logging.getLogger("copr-keygen-pool")
+
+
+def main():
+    pool = KeyPool(app)
+    if not os.path.exists(pool.homedir):
+        os.makedirs(pool.homedir, 0o700)
+
+    while True:
+        try:
+            generated = pool.refill()
+            if generated:
+                log.info("Generated {} pool keys".format(generated))
+        except KeygenServiceBaseException as e:
+            log.error("Failed to refill key pool: {}".format(e))
+        time.sleep(app.config["KEY_POOL_CHECK_INTERVAL"])
+
+
+if __name__ == "__main__":
+    main()
@@ -12,7 +12,7 @@ from logging import FileHandler
 from flask import Flask, request, Response
 import os
 from copr_keygen.exceptions import BadRequestException, \
-    KeygenServiceBaseException
+    KeygenServiceBaseException, NotFoundException
 
 app = Flask(__name__)
 app.config.from_object("copr_keygen.default_settings")
@@ -38,9 +38,12 @@ if not app.config["DEBUG"] or app.config["DEBUG_WITH_LOG"]:
 
 
 from .logic import create_new_key, user_exists
+from .jobs import JobQueue
 
 log = logging.getLogger(__name__)
 
+job_queue = JobQueue(app, create_new_key)
+
 
 @app.route('/ping')
 def ping():
@@ -75,10 +78,13 @@ def gen_key():
         - **name_real, name_email, name_comment**: for key identification
         - **key_length**: now supports 1024 or 2048 bytes
         - **expire**: [optional] key expire in days, default 0  means never
+        - **async**: [optional] don't wait for the key, generate it
+          in background and return the job, see :py:func:`gen_key_status`
 
-    :return: Http response with plain text content
+    :return: Http response with plain text content, json job for async
 
     :status 201: on success, returns empty data
+    :status 202: async key generation queued, `Location` of the job status
     :status 200: key already exists, nothing done
     :status 400: incorrect request
     :status 500: internal server error
@@ -106,8 +112,7 @@ def gen_key():
         response.status_code = 200
         return response
 
-    create_new_key(
-        app,
+    kwargs = dict(
         name_real=query["name_real"],
         name_email=name_email,
         name_comment=query.get("name_comment", None),
@@ -115,11 +120,53 @@ def gen_key():
         expire=query.get("expire", app.config["GPG_EXPIRE"]),
     )
 
+    if query.get("async"):
+        job = job_queue.submit(**kwargs)
+        response = Response(json.dumps(job), content_type="application/json")
+        response.status_code = 202
+        response.headers["Location"] = "/gen_key/{}".format(job["id"])
+        return response
+
+    create_new_key(app, **kwargs)
+
     response = Response("", content_type="text/plain;charset=UTF-8")
     response.status_code = 201
     return response
 
 
+@app.route('/gen_key/<job_id>')
+def gen_key_status(job_id):
+    """
+    State of the asynchronous key generation job
+
+     **Example response**:
+
+    .. sourcecode:: http
+
+      HTTP/1.1 200 OK
+      Content-Type: application/json
+
+      {
+        "id": "9c2d...",
+        "name_email": "foo_bar@example.com",
+        "state": "running",
+        "created": 1460000000.0,
+        "started": 1460000001.2,
+        "finished": null,
+        "error": null
+      }
+
+    `state` is one of `queued`, `running`, `done` or `failed`
+
+    :status 200: job found
+    :status 404: unknown job
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        raise NotFoundException("No key generation job {}".format(job_id))
+    return Response(json.dumps(job), content_type="application/json")
+
+
 @app.errorhandler(KeygenServiceBaseException)
 def handle_invalid_usage(error):
     response = Response(error.msg, content_type="text/plain;charset=UTF-8")
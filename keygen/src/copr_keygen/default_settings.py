@@ -3,10 +3,28 @@ DEBUG = False
 PHRASES_DIR = "/var/lib/copr-keygen/phrases/"
 GPG_BINARY = "/bin/gpg2"
 GNUPG_HOMEDIR = "/var/lib/copr-keygen/gnupg"
+# lock files preventing concurrent generation of the same key
+LOCK_DIR = "/var/lib/copr-keygen/locks"
+# state of the asynchronous /gen_key jobs
+GEN_KEY_JOBS_DIR = "/var/lib/copr-keygen/jobs"
+# keys generated at once by asynchronous jobs, in each service process
+GEN_KEY_WORKERS = 2
+# seconds after which an unfinished job is considered abandoned
+GEN_KEY_JOB_TIMEOUT = 3600
+# seconds to keep the state of finished jobs
+GEN_KEY_JOB_TTL = 86400
 
 GPG_KEY_LENGTH = 2048
 GPG_EXPIRE = "5y"
 
+# keys generated in advance by copr-keygen-pool, 0 disables the pool
+KEY_POOL_SIZE = 20
+KEY_POOL_HOMEDIR = "/var/lib/copr-keygen/pool-gnupg"
+# seconds between generating two pool keys
+KEY_POOL_REFILL_DELAY = 10
+# seconds between checks whether the pool needs refill
+KEY_POOL_CHECK_INTERVAL = 60
+
 LOG_DIR = "/var/log/copr-keygen"
 import logging
 LOG_LEVEL = logging.INFO
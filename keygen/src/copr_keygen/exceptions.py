@@ -20,5 +20,9 @@ class BadRequestException(KeygenServiceBaseException):
     status_code = 400
 
 
+class NotFoundException(KeygenServiceBaseException):
+    status_code = 404
+
+
 class GpgErrorException(KeygenServiceBaseException):
     status_code = 500
@@ -0,0 +1,151 @@
+"""
+Asynchronous key generation jobs.
+
+Jobs run in a bounded pool of threads (GEN_KEY_WORKERS) of the process
+which accepted the request.  The job state is stored in GEN_KEY_JOBS_DIR,
+so that any of the service processes can report it.
+
+The job id is derived from the key email, so repeated requests for the
+same key share one job.
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+from .exceptions import KeygenServiceBaseException
+
+log = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+JOB_ID_RE = re.compile(r"^[0-9a-f]{40}$")
+
+
+def get_job_id(name_email):
+    return hashlib.sha1(name_email.encode("utf-8")).hexdigest()
+
+
+class JobQueue(object):
+    """
+    :param app: Flask application object, uses GEN_KEY_* config options
+    :param create_key: function generating the key, called with the same
+        arguments as :py:func:`copr_keygen.logic.create_new_key`
+    """
+
+    def __init__(self, app, create_key):
+        self.app = app
+        self.create_key = create_key
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def jobs_dir(self):
+        return self.app.config["GEN_KEY_JOBS_DIR"]
+
+    @property
+    def pool(self):
+        # created lazily, threads don't survive fork of the service workers
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.app.config["GEN_KEY_WORKERS"])
+            return self._pool
+
+    def _path(self, job_id):
+        return os.path.join(self.jobs_dir, "{}.json".format(job_id))
+
+    def get(self, job_id):
+        """
+        :return dict: job state, None when there is no such job
+        """
+        if not JOB_ID_RE.match(job_id):
+            return None
+        try:
+            with open(self._path(job_id)) as handle:
+                return json.load(handle)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save(self, job):
+        job["updated"] = time.time()
+        if not os.path.isdir(self.jobs_dir):
+            os.makedirs(self.jobs_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=self.jobs_dir, prefix=".tmp-")
+        with os.fdopen(fd, "w") as handle:
+            json.dump(job, handle)
+        os.rename(tmp_path, self._path(job["id"]))
+
+    def is_active(self, job):
+        """ Queued or running, and not abandoned by a died process """
+        return job["state"] in [QUEUED, RUNNING] and \
+            time.time() - job["updated"] < self.app.config["GEN_KEY_JOB_TIMEOUT"]
+
+    def submit(self, name_real, name_email, key_length,
+               expire=None, name_comment=None):
+        """
+        Queue key generation, unless the same key is already being generated
+
+        :return dict: job state
+        """
+        job_id = get_job_id(name_email)
+        with self._lock:
+            job = self.get(job_id)
+            if job and self.is_active(job):
+                return job
+
+            job = {
+                "id": job_id,
+                "name_email": name_email,
+                "state": QUEUED,
+                "created": time.time(),
+                "started": None,
+                "finished": None,
+                "error": None,
+            }
+            self._save(job)
+
+        kwargs = dict(name_real=name_real, name_email=name_email,
+                      key_length=key_length, expire=expire,
+                      name_comment=name_comment)
+        self.pool.apply_async(self._run, (job, kwargs))
+        log.info("queued key generation job {} for {}".format(job_id, name_email))
+        self.cleanup()
+        return job
+
+    def _run(self, job, kwargs):
+        job["state"] = RUNNING
+        job["started"] = time.time()
+        self._save(job)
+        try:
+            self.create_key(self.app, **kwargs)
+            job["state"] = DONE
+        except KeygenServiceBaseException as error:
+            log.error("key generation job {} failed: {}".format(job["id"], error))
+            job["state"] = FAILED
+            job["error"] = str(error)
+        except Exception as error:
+            log.exception("key generation job {} failed".format(job["id"]))
+            job["state"] = FAILED
+            job["error"] = repr(error)
+        job["finished"] = time.time()
+        self._save(job)
+
+    def cleanup(self):
+        """ Remove finished jobs older than GEN_KEY_JOB_TTL """
+        deadline = time.time() - self.app.config["GEN_KEY_JOB_TTL"]
+        for name in os.listdir(self.jobs_dir):
+            path = os.path.join(self.jobs_dir, name)
+            try:
+                if os.stat(path).st_mtime < deadline:
+                    os.unlink(path)
+            except OSError:
+                pass
@@ -1,12 +1,17 @@
 import traceback
 import os
+import fcntl
+import hashlib
 import logging
+import threading
+from contextlib import contextmanager
 
 from subprocess import PIPE, Popen
 import tempfile
 import sys
 
 from .exceptions import GpgErrorException, KeygenServiceBaseException
+from .pool import KeyPool
 
 log = logging.getLogger(__name__)
 
@@ -32,38 +37,116 @@ def ensure_passphrase_exist(app, name_email):
         create()
 
 
-def user_exists(app, mail):
+class KeyringIndex(object):
+    """ Emails of the secret keys in the keyring
+
+    Loaded from `gpg --list-secret-keys --with-colons` and loaded again only
+    when GNUPG_HOMEDIR is changed in config or the keyring files change
+    (e.g. key created by another process).
+    """
+
+    KEYRING_FILES = ["pubring.kbx", "pubring.gpg", "secring.gpg",
+                     "private-keys-v1.d"]
+
+    def __init__(self):
+        self.homedir = None
+        self.signature = None
+        self.emails = set()
+        self.lock = threading.Lock()
+
+    def _signature(self, homedir):
+        signature = []
+        for name in self.KEYRING_FILES:
+            try:
+                stat = os.stat(os.path.join(homedir, name))
+            except OSError:
+                continue
+            signature.append((name, stat.st_mtime, stat.st_size, stat.st_ino))
+        return signature
+
+    def _load(self, app, homedir):
+        cmd = [app.config["GPG_BINARY"], "--homedir", homedir,
+               "--list-secret-keys", "--with-colons"]
+        try:
+            handle = Popen(cmd, stdout=PIPE, stderr=PIPE)
+            stdout, stderr = handle.communicate()
+        except Exception as e:
+            log.exception(e)
+            raise GpgErrorException(msg="unhandled exception during gpg call",
+                                    cmd=" ".join(cmd), err=e)
+
+        if handle.returncode != 0:
+            err = GpgErrorException(msg="unhandled error", cmd=cmd,
+                                    stdout=stdout.decode(), stderr=stderr.decode())
+            log.error(err)
+            raise err
+
+        emails = set()
+        for line in stdout.decode().splitlines():
+            fields = line.split(":")
+            if fields[0] in ["sec", "uid"] and len(fields) > 9 and fields[9]:
+                uid = fields[9]
+                if "<" in uid:
+                    uid = uid[uid.rindex("<") + 1:].rstrip(">")
+                emails.add(uid.lower())
+        log.debug("loaded {} keyring emails".format(len(emails)))
+        return emails
+
+    def contains(self, app, mail, reload=False):
+        with self.lock:
+            homedir = app.config["GNUPG_HOMEDIR"]
+            signature = self._signature(homedir)
+            if reload or homedir != self.homedir or signature != self.signature:
+                self.emails = self._load(app, homedir)
+                self.homedir, self.signature = homedir, signature
+            return mail.lower() in self.emails
+
+
+keyring_index = KeyringIndex()
+
+
+def user_exists(app, mail, reload=False):
     """ Checks if the user identified by mail presents in keyring
 
+    :param reload: [optional] don't trust the keyring index, read the keyring
     :return: bool True when user present
     :raises: GpgErrorException
 
     """
-    cmd = [app.config["GPG_BINARY"],
-           "--homedir", app.config["GNUPG_HOMEDIR"],
-           "--list-secret-keys", "--with-colons", mail]
-
-    try:
-        handle = Popen(cmd, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = handle.communicate()
-    except Exception as e:
-        log.exception(e)
-        raise GpgErrorException(msg="unhandled exception during gpg call",
-                                cmd=" ".join(cmd), err=e)
-
-    if handle.returncode == 0:
-        # TODO: validate that we really got exactly one line in stdout
+    if keyring_index.contains(app, mail, reload):
         log.debug("user {} has keys in keyring".format(mail))
         ensure_passphrase_exist(app, mail)
         return True
-    elif "error reading key" in stderr.decode():
-        log.debug("user {} not found in keyring".format(mail))
-        return False
-    else:
-        err = GpgErrorException(msg="unhandled error", cmd=cmd,
-                                stdout=stdout.decode(), stderr=stderr.decode())
-        log.error(err)
-        raise err
+
+    log.debug("user {} not found in keyring".format(mail))
+    return False
+
+
+# emails are spread over a fixed number of locks, so neither the thread
+# locks nor the lock files pile up with every email ever requested
+LOCK_STRIPES = 64
+_email_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+
+def email_lock_stripe(mail):
+    return int(hashlib.sha1(mail.encode("utf-8")).hexdigest(), 16) % LOCK_STRIPES
+
+
+@contextmanager
+def email_lock(app, mail):
+    """ Only one key is generated for `mail` at the same time, across threads
+    and processes (flock of a file in LOCK_DIR).  Emails sharing the lock
+    stripe wait for each other.
+    """
+    stripe = email_lock_stripe(mail)
+    with _email_locks[stripe]:
+        lock_dir = app.config["LOCK_DIR"]
+        if not os.path.isdir(lock_dir):
+            os.makedirs(lock_dir)
+        name = "stripe-{0:02d}".format(stripe)
+        with open(os.path.join(lock_dir, name), "a") as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            yield
 
 
 template = """
@@ -93,11 +176,28 @@ def create_new_key(
     :return: (stdout, stderr) from `gpg` invocation
     """
 
-    # TODO with file lock based on usermail !!!
-
     if user_exists(app, name_email):
         return
 
+    with email_lock(app, name_email):
+        # another request could have created it meanwhile
+        if user_exists(app, name_email, reload=True):
+            return
+        _create_new_key(app, name_real, name_email, key_length,
+                        expire, name_comment)
+
+
+def _create_new_key(app, name_real, name_email, key_length,
+                    expire=None, name_comment=None):
+    if str(key_length or 2048) == str(app.config["GPG_KEY_LENGTH"]) and \
+            str(expire or 0) == str(app.config["GPG_EXPIRE"]) and \
+            KeyPool(app).assign_key(name_real, name_email, name_comment):
+        if not user_exists(app, name_email, reload=True):
+            raise GpgErrorException(
+                msg="Pool key was assigned, but not found in keyring")
+        log.info("Assigned pool key-pair to: {} ".format(name_email))
+        return
+
     try:
         # ! Don't use context manager with delete=True
         #   TemporaryFile deletes file on .close() not on __exit__()
@@ -141,7 +241,7 @@ def create_new_key(
     log.debug("stderr: {}".format(stderr))
     if handle.returncode == 0:
         # TODO: validate that we really got armored gpg key
-        if not user_exists(app, name_email):
+        if not user_exists(app, name_email, reload=True):
             raise GpgErrorException(
                 msg="Key was created, but not found in keyring"
                     "this shouldn't be possible")
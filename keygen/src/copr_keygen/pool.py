@@ -0,0 +1,205 @@
+"""
+Pool of pre-generated key pairs.
+
+Keys are generated in advance into a separate keyring (KEY_POOL_HOMEDIR)
+with a placeholder identity.  When a key is requested, a pool key gets
+the requested identity, is exported without the placeholder uid, imported
+into the main keyring and removed from the pool, which is much faster than
+generating a new key.
+
+Pool keys don't expire, GPG_EXPIRE is applied when the key is assigned.
+Keys not matching the current GPG_KEY_LENGTH are dropped from the pool.
+
+Requires GnuPG >= 2.1.22 (--quick-add-uid, --quick-set-expire and
+--export-filter).
+"""
+
+import os
+import time
+import uuid
+import fcntl
+import logging
+import tempfile
+
+from subprocess import PIPE, Popen
+
+from .exceptions import GpgErrorException
+
+log = logging.getLogger(__name__)
+
+POOL_LOCK_FILE = ".pool.lock"
+POOL_EMAIL_DOMAIN = "copr-keygen.pool"
+
+pool_template = """
+%no-protection
+Key-Type: {key_type}
+Key-Length: {key_length}
+Name-Real: copr-keygen-pool
+Name-Email: {pool_email}
+Expire-Date: 0
+%commit
+"""
+
+
+def run_gpg(app, homedir, args, stdin=None):
+    """
+    :return tuple: (returncode, stdout, stderr)
+    :raises: GpgErrorException when gpg can't be executed
+    """
+    cmd = [app.config["GPG_BINARY"], "--batch", "--homedir", homedir] + args
+    try:
+        handle = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = handle.communicate(stdin)
+    except Exception as e:
+        log.exception(e)
+        raise GpgErrorException(msg="unhandled exception during gpg call",
+                                cmd=" ".join(cmd), err=e)
+    return handle.returncode, stdout, stderr
+
+
+def format_uid(name_real, name_email, name_comment=None):
+    if name_comment:
+        return "{} ({}) <{}>".format(name_real, name_comment, name_email)
+    return "{} <{}>".format(name_real, name_email)
+
+
+class KeyPool(object):
+    """
+    :param app: Flask application object, uses KEY_POOL_* config options
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.homedir = app.config["KEY_POOL_HOMEDIR"]
+        self.size = app.config["KEY_POOL_SIZE"]
+
+    def gpg(self, *args, **kwargs):
+        return run_gpg(self.app, self.homedir, list(args), **kwargs)
+
+    def _list_keys(self):
+        """
+        :return list: (fingerprint, key length) of all the pool keys,
+            oldest first
+        """
+        returncode, stdout, stderr = self.gpg(
+            "--list-secret-keys", "--with-colons", "--with-fingerprint")
+        if returncode != 0:
+            log.error("failed to list pool keys: {}".format(stderr))
+            return []
+
+        keys = []
+        key_length = None
+        for line in stdout.decode().splitlines():
+            fields = line.split(":")
+            if fields[0] == "sec":
+                key_length = int(fields[2] or 0)
+            elif fields[0] == "fpr" and key_length is not None:
+                keys.append((fields[9], key_length))
+                key_length = None
+        return keys
+
+    def list_keys(self):
+        """
+        :return list: fingerprints of the pool keys matching
+            the current GPG_KEY_LENGTH, oldest first
+        """
+        key_length = int(self.app.config["GPG_KEY_LENGTH"])
+        return [fpr for fpr, length in self._list_keys() if length == key_length]
+
+    def drop_stale_keys(self):
+        """
+        Remove pool keys generated with a different GPG_KEY_LENGTH
+
+        :return int: number of removed keys
+        """
+        key_length = int(self.app.config["GPG_KEY_LENGTH"])
+        removed = 0
+        for fpr, length in self._list_keys():
+            if length == key_length:
+                continue
+            returncode, _, stderr = self.gpg(
+                "--yes", "--delete-secret-and-public-key", fpr)
+            if returncode != 0:
+                log.error("Failed to remove stale pool key {}: {}"
+                          .format(fpr, stderr))
+                continue
+            log.info("Removed stale pool key {} ({} bits)".format(fpr, length))
+            removed += 1
+        return removed
+
+    def generate_key(self):
+        """ Add one new key to the pool """
+        pool_email = "pool-{}@{}".format(uuid.uuid4().hex, POOL_EMAIL_DOMAIN)
+        out = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            out.write(pool_template.format(
+                key_type="RSA",
+                key_length=self.app.config["GPG_KEY_LENGTH"],
+                pool_email=pool_email).encode("utf-8"))
+            out.close()
+            returncode, _, stderr = self.gpg("--gen-key", out.name)
+        finally:
+            os.remove(out.name)
+
+        if returncode != 0:
+            raise GpgErrorException(msg="Failed to generate pool key",
+                                    stderr=stderr.decode())
+        log.info("Generated pool key {}".format(pool_email))
+
+    def refill(self):
+        """
+        Drop stale keys and generate new ones until the pool has
+        KEY_POOL_SIZE keys, waiting KEY_POOL_REFILL_DELAY seconds between them
+
+        :return int: number of generated keys
+        """
+        self.drop_stale_keys()
+        missing = self.size - len(self.list_keys())
+        for index in range(max(missing, 0)):
+            if index:
+                time.sleep(self.app.config["KEY_POOL_REFILL_DELAY"])
+            self.generate_key()
+        return max(missing, 0)
+
+    def assign_key(self, name_real, name_email, name_comment=None):
+        """
+        Move a pool key into the main keyring under the `name_email` identity
+
+        :return bool: False when the pool is empty or the key can't be used
+        """
+        if not self.size or not os.path.isdir(self.homedir):
+            return False
+
+        with open(os.path.join(self.homedir, POOL_LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            fingerprints = self.list_keys()
+            if not fingerprints:
+                log.info("Key pool is empty")
+                return False
+
+            fpr = fingerprints[0]
+            uid = format_uid(name_real, name_email, name_comment)
+            returncode, _, stderr = self.gpg("--quick-add-uid", fpr, uid)
+            if returncode == 0:
+                returncode, _, stderr = self.gpg(
+                    "--quick-set-expire", fpr, self.app.config["GPG_EXPIRE"])
+            if returncode == 0:
+                returncode, secret_key, stderr = self.gpg(
+                    "--armor", "--export-secret-keys",
+                    "--export-filter", "keep-uid=mbox = {}".format(name_email),
+                    fpr)
+            if returncode == 0:
+                returncode, _, stderr = run_gpg(
+                    self.app, self.app.config["GNUPG_HOMEDIR"], ["--import"],
+                    stdin=secret_key)
+
+            # the key is unusable for the pool either way
+            self.gpg("--yes", "--delete-secret-and-public-key", fpr)
+
+        if returncode != 0:
+            log.error("Failed to assign pool key {} to {}: {}"
+                      .format(fpr, name_email, stderr))
+            return False
+
+        log.info("Assigned pool key {} to {}".format(fpr, name_email))
+        return True
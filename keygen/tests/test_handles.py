@@ -90,3 +90,50 @@ class TestGenKey(object):
         with app.test_client() as c:
             rv = c.post('/gen_key', data=json_data)
             assert rv.status_code == 500
+
+
+json_data_async = json.dumps({
+    "name_real": "foo_bar",
+    "name_email": "foo_bar@example.com",
+    "async": True,
+})
+
+
+@mock.patch("copr_keygen.job_queue")
+@mock.patch("copr_keygen.create_new_key")
+@mock.patch("copr_keygen.user_exists")
+class TestGenKeyAsync(object):
+
+    def test_gen_key_async(self, user_exists, create_new_key, jobs):
+        user_exists.return_value = False
+        jobs.submit.return_value = {"id": "abc", "state": "queued"}
+
+        with app.test_client() as c:
+            rv = c.post('/gen_key', data=json_data_async)
+            assert rv.status_code == 202
+            assert json.loads(rv.data.decode("utf-8"))["id"] == "abc"
+            assert rv.headers["Location"].endswith("/gen_key/abc")
+
+        assert not create_new_key.called
+        assert jobs.submit.call_args[1]["name_email"] == "foo_bar@example.com"
+
+    def test_gen_key_async_existing_user(self, user_exists, create_new_key, jobs):
+        user_exists.return_value = True
+
+        with app.test_client() as c:
+            rv = c.post('/gen_key', data=json_data_async)
+            assert rv.status_code == 200
+
+        assert not jobs.submit.called
+
+    def test_gen_key_status(self, user_exists, create_new_key, jobs):
+        jobs.get.return_value = {"id": "abc", "state": "running"}
+
+        with app.test_client() as c:
+            rv = c.get('/gen_key/abc')
+            assert rv.status_code == 200
+            assert json.loads(rv.data.decode("utf-8"))["state"] == "running"
+
+            jobs.get.return_value = None
+            rv = c.get('/gen_key/abc')
+            assert rv.status_code == 404
@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+
+import six
+
+if six.PY3:
+    from unittest import mock
+else:
+    import mock
+
+from copr_keygen import app
+from copr_keygen.exceptions import GpgErrorException
+from copr_keygen.jobs import JobQueue, get_job_id, QUEUED, RUNNING, DONE, FAILED
+
+TEST_EMAIL = "foobar@example.com"
+TEST_NAME = "foobar"
+
+
+class TestJobQueue(object):
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = dict(app.config)
+        app.config.update(
+            GEN_KEY_JOBS_DIR=os.path.join(self.tmp_dir, "jobs"),
+            GEN_KEY_WORKERS=2,
+            GEN_KEY_JOB_TIMEOUT=3600,
+            GEN_KEY_JOB_TTL=86400,
+        )
+        self.create_key = mock.MagicMock()
+        self.jobs = JobQueue(app, self.create_key)
+
+    def teardown_method(self, method):
+        app.config.clear()
+        app.config.update(self.config)
+        shutil.rmtree(self.tmp_dir)
+
+    def wait_for(self, job_id, states=(DONE, FAILED)):
+        for _ in range(100):
+            job = self.jobs.get(job_id)
+            if job["state"] in states:
+                return job
+            time.sleep(0.05)
+        raise AssertionError("job {} not finished".format(job_id))
+
+    def test_submit_done(self):
+        job = self.jobs.submit(TEST_NAME, TEST_EMAIL, 2048, expire="5y")
+        assert job["id"] == get_job_id(TEST_EMAIL)
+        assert job["state"] in [QUEUED, RUNNING, DONE]
+
+        job = self.wait_for(job["id"])
+        assert job["state"] == DONE
+        assert job["started"] and job["finished"]
+        assert self.create_key.call_args == mock.call(
+            app, name_real=TEST_NAME, name_email=TEST_EMAIL, key_length=2048,
+            expire="5y", name_comment=None)
+
+    def test_submit_failed(self):
+        self.create_key.side_effect = GpgErrorException(msg="gpg failed")
+        job = self.wait_for(self.jobs.submit(TEST_NAME, TEST_EMAIL, 2048)["id"])
+        assert job["state"] == FAILED
+        assert "gpg failed" in job["error"]
+
+        # failed job can be submitted again
+        self.create_key.side_effect = None
+        job = self.wait_for(self.jobs.submit(TEST_NAME, TEST_EMAIL, 2048)["id"])
+        assert job["state"] == DONE
+
+    def test_submit_same_key_once(self):
+        release = threading.Event()
+        self.create_key.side_effect = lambda *args, **kwargs: release.wait(5)
+
+        first = self.jobs.submit(TEST_NAME, TEST_EMAIL, 2048)
+        second = self.jobs.submit(TEST_NAME, TEST_EMAIL, 2048)
+        assert first["id"] == second["id"]
+        release.set()
+        self.wait_for(first["id"])
+        assert self.create_key.call_count == 1
+
+    def test_abandoned_job_resubmitted(self):
+        job = {"id": get_job_id(TEST_EMAIL), "state": RUNNING}
+        self.jobs._save(job)
+        with mock.patch("copr_keygen.jobs.time.time", return_value=time.time() + 7200):
+            assert not self.jobs.is_active(self.jobs.get(job["id"]))
+        app.config["GEN_KEY_JOB_TIMEOUT"] = -1
+        self.wait_for(self.jobs.submit(TEST_NAME, TEST_EMAIL, 2048)["id"])
+        assert self.create_key.called
+
+    def test_get(self):
+        assert self.jobs.get(get_job_id(TEST_EMAIL)) is None
+        assert self.jobs.get("../../etc/passwd") is None
+
+    def test_cleanup(self):
+        job = self.wait_for(self.jobs.submit(TEST_NAME, TEST_EMAIL, 2048)["id"])
+        path = os.path.join(app.config["GEN_KEY_JOBS_DIR"], "{}.json".format(job["id"]))
+        os.utime(path, (time.time() - 90000, time.time() - 90000))
+        self.jobs.cleanup()
+        assert not os.path.exists(path)
@@ -97,30 +97,93 @@ class MockPopenHandle(object):
         return self.stdout.encode(), self.stderr.encode()
 
 
+LIST_KEYS_OUTPUT = """\
+sec:u:2048:1:90F5C2519D8B2716:1460000000:::u:::scESC:::+:::23::0:
+fpr:::::::::92EDB7A650AE34FF3DC5729890F5C2519D8B2716:
+uid:u::::1460000000::2B2DF8E9D2A2C06E4F4E84E6A1D1B0F1D9C3A7B2::foobar <FooBar@example.com>::::::::::0:
+ssb:u:2048:1:0D2C5D6CE4D1A7A3:1460000000::::::e:::+:::23:
+"""
+
+
+@mock.patch("copr_keygen.logic.keyring_index", new_callable=logic.KeyringIndex)
 @mock.patch("copr_keygen.logic.ensure_passphrase_exist")
 @mock.patch("copr_keygen.logic.Popen")
 class TestUserExists(TestCase):
-    def test_exists(self, popen, ensure_passphrase):
-        popen.return_value = MockPopenHandle(0)
+    def test_exists(self, popen, ensure_passphrase, index):
+        popen.return_value = MockPopenHandle(0, stdout=LIST_KEYS_OUTPUT)
         ensure_passphrase.return_value = True
         assert logic.user_exists(app, TEST_EMAIL)
 
-    def test_not_exists(self, popen, ensure_passphrase):
-        popen.return_value = MockPopenHandle(1, stderr="error reading key")
+    def test_not_exists(self, popen, ensure_passphrase, index):
+        popen.return_value = MockPopenHandle(0, stdout=LIST_KEYS_OUTPUT)
         ensure_passphrase.return_value = True
-        assert not logic.user_exists(app, TEST_EMAIL)
+        assert not logic.user_exists(app, "other@example.com")
+        assert not ensure_passphrase.called
+
+    def test_index_cached(self, popen, ensure_passphrase, index):
+        popen.return_value = MockPopenHandle(0, stdout=LIST_KEYS_OUTPUT)
+        assert logic.user_exists(app, TEST_EMAIL)
+        assert not logic.user_exists(app, "other@example.com")
+        assert popen.call_count == 1
+
+        # key created by somebody else
+        assert not logic.user_exists(app, "other@example.com", reload=True)
+        assert popen.call_count == 2
 
-    def test_gpg_unknown_err(self, popen, ensure_passphrase):
+        with mock.patch.dict(app.config, {"GNUPG_HOMEDIR": "/tmp/other-homedir"}):
+            logic.user_exists(app, TEST_EMAIL)
+        assert popen.call_count == 3
+        assert popen.call_args[0][0][2] == "/tmp/other-homedir"
+
+    def test_index_keyring_changed(self, popen, ensure_passphrase, index):
+        popen.return_value = MockPopenHandle(0, stdout=LIST_KEYS_OUTPUT)
+        homedir = tempfile.mkdtemp()
+        try:
+            with mock.patch.dict(app.config, {"GNUPG_HOMEDIR": homedir}):
+                logic.user_exists(app, TEST_EMAIL)
+                logic.user_exists(app, TEST_EMAIL)
+                assert popen.call_count == 1
+                with open(os.path.join(homedir, "pubring.kbx"), "w") as handle:
+                    handle.write("keys")
+                logic.user_exists(app, TEST_EMAIL)
+                assert popen.call_count == 2
+        finally:
+            shutil.rmtree(homedir)
+
+    def test_gpg_unknown_err(self, popen, ensure_passphrase, index):
         popen.return_value = MockPopenHandle(1)
         with pytest.raises(GpgErrorException):
             logic.user_exists(app, TEST_EMAIL)
 
-    def test_popen_unknown_err(self, popen, ensure_passphrase):
+    def test_popen_unknown_err(self, popen, ensure_passphrase, index):
         popen.side_effect = OSError()
         with pytest.raises(GpgErrorException):
             logic.user_exists(app, TEST_EMAIL)
 
 
+def test_email_lock():
+    lock_dir = tempfile.mkdtemp()
+    try:
+        with mock.patch.dict(app.config, {"LOCK_DIR": os.path.join(lock_dir, "locks")}):
+            stripe = logic.email_lock_stripe(TEST_EMAIL)
+            with logic.email_lock(app, TEST_EMAIL):
+                lock_files = os.listdir(os.path.join(lock_dir, "locks"))
+                assert lock_files == ["stripe-{0:02d}".format(stripe)]
+                assert not logic._email_locks[stripe].acquire(False)
+            assert logic._email_locks[stripe].acquire(False)
+            logic._email_locks[stripe].release()
+
+            # other emails don't add lock files beyond the stripes
+            for num in range(10 * logic.LOCK_STRIPES):
+                with logic.email_lock(app, "{0}@example.com".format(num)):
+                    pass
+            assert len(os.listdir(os.path.join(lock_dir, "locks"))) == \
+                logic.LOCK_STRIPES
+    finally:
+        shutil.rmtree(lock_dir)
+
+
+@mock.patch("copr_keygen.logic.email_lock", mock.MagicMock())
 @mock.patch("copr_keygen.logic.user_exists")
 @mock.patch("copr_keygen.logic.Popen")
 class TestGenKey(TestCase):
@@ -132,7 +195,7 @@ class TestGenKey(TestCase):
         """
 
         with mock.patch("tempfile.NamedTemporaryFile") as tmpfile:
-            user_exists_returns = [False, True]
+            user_exists_returns = [False, False, True]
             user_exists.side_effect = \
                 lambda *args, **kwargs: user_exists_returns.pop(0)
 
@@ -164,6 +227,13 @@ class TestGenKey(TestCase):
         user_exists.assert_called_once()
         assert not popen.called
 
+    def test_skip_creation_created_meanwhile(self, popen, user_exists):
+        user_exists.side_effect = [False, True]
+        logic.create_new_key(app, TEST_NAME, TEST_EMAIL, TEST_KEYLENGTH)
+
+        assert user_exists.call_args == mock.call(app, TEST_EMAIL, reload=True)
+        assert not popen.called
+
     def test_error_popen(self, popen, user_exists):
         user_exists.return_value = False
         popen.side_effect = OSError()
@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+from distutils.spawn import find_executable
+
+import six
+
+if six.PY3:
+    from unittest import mock
+else:
+    import mock
+
+import pytest
+
+from copr_keygen import app
+from copr_keygen.pool import KeyPool, format_uid, run_gpg
+import copr_keygen.logic as logic
+
+TEST_EMAIL = "foobar@example.com"
+TEST_NAME = "foobar"
+
+GPG = find_executable("gpg2") or find_executable("gpg")
+
+
+def test_format_uid():
+    assert format_uid("foo", "foo@example.com") == "foo <foo@example.com>"
+    assert format_uid("foo", "foo@example.com", "bar") == "foo (bar) <foo@example.com>"
+
+
+@mock.patch("copr_keygen.pool.run_gpg")
+def test_list_keys(run_gpg):
+    run_gpg.return_value = (0, b"\n".join([
+        b"sec:u:2048:1:AAAA:1500000000:::u:::scESC:",
+        b"fpr:::::::::AAAAAAAA:",
+        b"uid:u::::1500000000::HASH::pool <pool@copr-keygen.pool>:",
+        b"sec:u:1024:1:BBBB:1500000001:::u:::scESC:",
+        b"fpr:::::::::BBBBBBBB:",
+    ]), b"")
+    pool = KeyPool(app)
+    with mock.patch.dict(app.config, {"GPG_KEY_LENGTH": 2048}):
+        assert pool.list_keys() == ["AAAAAAAA"]
+    assert "--with-fingerprint" in run_gpg.call_args[0][2]
+
+
+@mock.patch("copr_keygen.logic.email_lock", mock.MagicMock())
+@mock.patch("copr_keygen.logic.Popen")
+@mock.patch("copr_keygen.logic.KeyPool")
+@mock.patch("copr_keygen.logic.user_exists")
+class TestCreateFromPool(object):
+
+    def test_assigned(self, user_exists, key_pool, popen):
+        user_exists.side_effect = [False, False, True]
+        key_pool.return_value.assign_key.return_value = True
+
+        logic.create_new_key(app, TEST_NAME, TEST_EMAIL, app.config["GPG_KEY_LENGTH"],
+                             expire=app.config["GPG_EXPIRE"])
+        assert key_pool.return_value.assign_key.call_args == \
+            mock.call(TEST_NAME, TEST_EMAIL, None)
+        assert not popen.called
+
+    def test_empty_pool(self, user_exists, key_pool, popen):
+        user_exists.side_effect = [False, False, True]
+        key_pool.return_value.assign_key.return_value = False
+        popen.return_value.communicate.return_value = (b"", b"")
+        popen.return_value.returncode = 0
+
+        logic.create_new_key(app, TEST_NAME, TEST_EMAIL, app.config["GPG_KEY_LENGTH"],
+                             expire=app.config["GPG_EXPIRE"])
+        assert popen.called
+
+    def test_custom_key_not_from_pool(self, user_exists, key_pool, popen):
+        user_exists.side_effect = [False, False, True]
+        popen.return_value.communicate.return_value = (b"", b"")
+        popen.return_value.returncode = 0
+
+        logic.create_new_key(app, TEST_NAME, TEST_EMAIL, 1024, expire="1y")
+        assert not key_pool.return_value.assign_key.called
+        assert popen.called
+
+
+@pytest.mark.skipif(GPG is None, reason="gpg is not installed")
+class TestKeyPool(object):
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = dict(app.config)
+        app.config.update(
+            GPG_BINARY=GPG,
+            GPG_KEY_LENGTH=1024,
+            GNUPG_HOMEDIR=os.path.join(self.tmp_dir, "gnupg"),
+            KEY_POOL_HOMEDIR=os.path.join(self.tmp_dir, "pool"),
+            KEY_POOL_SIZE=2,
+            KEY_POOL_REFILL_DELAY=0,
+        )
+        for name in ["gnupg", "pool"]:
+            os.mkdir(os.path.join(self.tmp_dir, name), 0o700)
+        self.pool = KeyPool(app)
+
+    def teardown_method(self, method):
+        app.config.clear()
+        app.config.update(self.config)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_refill_and_assign(self):
+        assert self.pool.refill() == 2
+        assert self.pool.refill() == 0
+        fingerprints = self.pool.list_keys()
+        assert len(fingerprints) == 2
+
+        assert self.pool.assign_key(TEST_NAME, TEST_EMAIL)
+        assert self.pool.list_keys() == fingerprints[1:]
+
+        returncode, stdout, _ = run_gpg(app, app.config["GNUPG_HOMEDIR"],
+                                        ["--list-secret-keys", "--with-colons"])
+        assert returncode == 0
+        uids = [line.split(":")[9] for line in stdout.decode().splitlines()
+                if line.startswith("uid:")]
+        assert uids == ["{} <{}>".format(TEST_NAME, TEST_EMAIL)]
+        assert fingerprints[0] in stdout.decode()
+        # expiration starts when the key is assigned, not in the pool
+        expires = [line.split(":")[6] for line in stdout.decode().splitlines()
+                   if line.startswith("sec:")]
+        assert expires[0]
+
+        returncode, stdout, _ = self.pool.gpg("--list-secret-keys", "--with-colons")
+        assert [line.split(":")[6] for line in stdout.decode().splitlines()
+                if line.startswith("sec:")] == [""]
+
+    def test_drop_stale_keys(self):
+        assert self.pool.refill() == 2
+        app.config["GPG_KEY_LENGTH"] = 2048
+        assert self.pool.list_keys() == []
+        assert not self.pool.assign_key(TEST_NAME, TEST_EMAIL)
+
+        assert self.pool.drop_stale_keys() == 2
+        assert self.pool._list_keys() == []
+
+    def test_assign_empty_pool(self):
+        assert not self.pool.assign_key(TEST_NAME, TEST_EMAIL)